@@ -0,0 +1,114 @@
+import os
+from typing import Any, Dict, List, Optional
+from constants import *
+
+# Chooses the fetchmany size of the next batch of query_batch_generator
+# from the measured bytes per row and rows per second of the batches so far.
+#
+# The next size is the largest that keeps a batch within target_batch_bytes
+# of memory and target_batch_seconds of fetch latency, using exponentially
+# smoothed estimates so a single slow batch does not collapse the size.
+# Each step at most doubles or halves the size, within [min_size, max_size].
+#
+# Usage:
+#   sizer = AdaptiveBatchSizer()
+#   for batch_rows in query_batch_generator(query, batch_sizer=sizer):
+#       ...
+#   print(sizer.get_stats())
+#
+class AdaptiveBatchSizer():
+    def __init__(
+        self,
+        initial_size: int=ADAPTIVE_BATCH_INITIAL_SIZE,
+        min_size: int=ADAPTIVE_BATCH_MIN_SIZE,
+        max_size: int=ADAPTIVE_BATCH_MAX_SIZE,
+        target_batch_bytes: int=ADAPTIVE_BATCH_TARGET_BYTES,
+        target_batch_seconds: float=ADAPTIVE_BATCH_TARGET_SECONDS,
+        smoothing: float=0.5,
+        max_history: int=1000):
+        assert 0 < min_size <= max_size, f"ERROR: invalid min_size:{min_size} max_size:{max_size}"
+        self.min_size = min_size
+        self.max_size = max_size
+        self.batch_size = min(max(initial_size, min_size), max_size)
+        self.target_batch_bytes = target_batch_bytes
+        self.target_batch_seconds = target_batch_seconds
+        self.smoothing = smoothing
+        self.max_history = max_history
+        self.bytes_per_row: Optional[float] = None
+        self.rows_per_second: Optional[float] = None
+        self.batch_sizes: List[int] = []
+        self.num_batches = 0
+        self.num_rows = 0
+
+    def smooth(self, previous: Optional[float], value: float) -> float:
+        return value if previous is None else self.smoothing * value + (1 - self.smoothing) * previous
+
+    # Returns the size to pass to the next fetchmany
+    def next_size(self) -> int:
+        return self.batch_size
+
+    # Updates the estimates with a fetched batch of num_rows rows of about
+    # num_bytes that took seconds to fetch, and chooses the next size
+    def update(self, num_rows: int, num_bytes: int, seconds: float) -> int:
+        if len(self.batch_sizes) < self.max_history:
+            self.batch_sizes.append(self.batch_size)
+        self.num_batches += 1
+        self.num_rows += num_rows
+        if num_rows == 0:
+            return self.batch_size
+        self.bytes_per_row = self.smooth(self.bytes_per_row, max(num_bytes, 1) / num_rows)
+        if seconds > 0:
+            self.rows_per_second = self.smooth(self.rows_per_second, num_rows / seconds)
+        size = self.target_batch_bytes / self.bytes_per_row
+        if self.rows_per_second is not None:
+            size = min(size, self.rows_per_second * self.target_batch_seconds)
+        size = min(max(int(size), self.batch_size // 2, self.min_size), self.batch_size * 2, self.max_size)
+        self.batch_size = size
+        return self.batch_size
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "num_batches": self.num_batches,
+            "num_rows": self.num_rows,
+            "batch_size": self.batch_size,
+            "min_batch_size": min(self.batch_sizes) if len(self.batch_sizes) > 0 else None,
+            "max_batch_size": max(self.batch_sizes) if len(self.batch_sizes) > 0 else None,
+            "batch_sizes": list(self.batch_sizes),
+            "bytes_per_row": self.bytes_per_row,
+            "rows_per_second": self.rows_per_second,
+        }
+
+
+################################################
+# Tests
+################################################
+
+def test_grows_to_latency_target():
+    sizer = AdaptiveBatchSizer(initial_size=100, min_size=10, max_size=100000, target_batch_bytes=10**9, target_batch_seconds=1.0)
+    for _ in range(10):
+        size = sizer.next_size()
+        # 5000 rows per second of 100 bytes each
+        sizer.update(size, size * 100, size / 5000)
+    assert sizer.next_size() == 5000, f"ERROR: expected 5000 not {sizer.next_size()}"
+    assert sizer.get_stats()["batch_sizes"][:4] == [100, 200, 400, 800], f"ERROR: size grew more than 2x {sizer.get_stats()}"
+
+def test_shrinks_to_memory_target():
+    sizer = AdaptiveBatchSizer(initial_size=10000, min_size=10, max_size=100000, target_batch_bytes=100000, target_batch_seconds=60.0)
+    for _ in range(10):
+        size = sizer.next_size()
+        # wide rows of 1000 bytes, fetched fast
+        sizer.update(size, size * 1000, 0.01)
+    assert sizer.next_size() == 100, f"ERROR: expected 100 not {sizer.next_size()}"
+    stats = sizer.get_stats()
+    assert stats["max_batch_size"] == 10000 and stats["min_batch_size"] == 100 and stats["num_batches"] == 10, f"ERROR: unexpected stats {stats}"
+
+def tests():
+    test_grows_to_latency_target()
+    test_shrinks_to_memory_target()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import time
+import asyncio
+import snowflake.connector as connector
+from snowflake.connector import ProgrammingError
+from constants import *
+from query_generator import get_connection_pool, clean_query
+from timefunc import timefunc
+from metrics import query_kind, record_query
+from tracing import get_tracer
+from utils import estimate_rows_bytes
+from metrics import get_metrics_registry
+from typing import Any, AsyncIterator, List, Optional
+
+# Async counterparts of the query_generator helpers.
+#
+# Queries are submitted with the connector's execute_async and their status
+# is polled every poll_seconds with asyncio.sleep in between, so many
+# warehouse queries can be in flight at once from one event loop.
+# Blocking connector calls (submit, status, fetchmany) run in worker threads.
+
+# Cancels the running query with the given query_id, ignoring errors
+def cancel_query(conn: connector, query_id: str) -> None:
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT SYSTEM$CANCEL_QUERY('{query_id}')")
+    except Exception:
+        pass
+    finally:
+        cur.close()
+
+# Returns an async generator that
+# 1. submits a query with execute_async
+# 2. polls the query status without blocking the event loop
+# 3. fetches a max of batch_size rows from the total query result at a time
+# 4. yields each batch of rows until all rows are processed
+# prints timeout error and cancels the query when it runs longer than timeout_seconds
+# borrows a connection from get_connection_pool() if conn is None
+# records the same per query metrics as query_batch_generator
+#
+# Usage:
+#   async for batch_rows in async_query_batch_generator(query):
+#       ...
+#
+async def async_query_batch_generator(
+    query: str,
+    conn: connector=None,
+    batch_size: int=DEFAULT_BATCH_SIZE,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    poll_seconds: float=ASYNC_POLL_SECONDS,
+    verbose: bool=False) -> AsyncIterator[List[Any]]:
+    cur = None
+    pool = None
+    start = time.perf_counter()
+    status = "ok"
+    num_batches = 0
+    total_rows = 0
+    total_bytes = 0
+    kind = query_kind(query)
+    # async queries overlap on the event loop thread so each gets its own track
+    query_span = get_tracer().start_span("async_query", cat="query", is_async=True, kind=kind, query=(query or "")[:200])
+    try:
+        if conn is None:
+            pool = get_connection_pool()
+            conn = await asyncio.to_thread(pool.acquire)
+        cur = conn.cursor()
+
+        assert query is not None, "ERROR: undefined query"
+
+        await asyncio.to_thread(cur.execute_async, query)
+        query_id = cur.sfqid
+        query_span.set(sfqid=query_id)
+
+        loop = asyncio.get_running_loop()
+        poll_start = loop.time()
+        while True:
+            query_status = await asyncio.to_thread(conn.get_query_status_throw_if_error, query_id)
+            if not conn.is_still_running(query_status):
+                break
+            if loop.time() - poll_start > timeout_seconds:
+                await asyncio.to_thread(cancel_query, conn, query_id)
+                raise ProgrammingError(msg=f"query {query_id} exceeded {timeout_seconds} seconds", errno=604)
+            await asyncio.sleep(poll_seconds)
+
+        await asyncio.to_thread(cur.get_results_from_sfqid, query_id)
+
+        while True:
+            batch_rows = await asyncio.to_thread(cur.fetchmany, batch_size)
+            num_batch_rows = len(batch_rows)
+            if num_batch_rows == 0:
+                break
+
+            total_rows += num_batch_rows
+            num_batches += 1
+            total_bytes += estimate_rows_bytes(batch_rows)
+
+            yield batch_rows
+
+        if verbose:
+            print(f"yielded {total_rows} total_rows in {num_batches} batches")
+
+    except ProgrammingError as err:
+        if err.errno == 604:
+            status = "timeout"
+            print(timeout_seconds, "second timeout for query:\n", query)
+        else:
+            status = "error"
+            print(f"Error: {type(err)} {str(err)}")
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        record_query(kind, status, time.perf_counter() - start, total_rows, num_batches, total_bytes)
+        query_span.set(status=status, rows=total_rows, batches=num_batches)
+        query_span.end()
+        if cur is not None:
+            cur.close()
+        if pool is not None:
+            pool.release(conn)
+
+# Async version of execute_single_query for queries with no processed result rows
+# like create, clone, alter, drop, update
+async def async_execute_single_query(
+    single_query: str,
+    conn: connector=None,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    verbose: bool=False) -> Optional[Any]:
+    exc = None
+    single_query = clean_query(single_query)
+    if verbose:
+        print(f"async_execute_single_query:\n{single_query};")
+    try:
+        async for _ in async_query_batch_generator(single_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose):
+            pass
+        exc = StopIteration()
+    except Exception as e:
+        exc = e
+    return exc
+
+# Async version of execute_simple_query that returns all result rows at once
+async def async_execute_simple_query(
+    query: str,
+    conn: connector=None,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    verbose: bool=False) -> List[Any]:
+    if verbose:
+        print(f"async_execute_simple_query:\n{query};")
+    result_rows = []
+    async for batch_rows in async_query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1000, verbose=verbose):
+        result_rows.extend(batch_rows)
+    return result_rows
+
+# Async version of execute_count_query
+async def async_execute_count_query(
+    count_query: str,
+    conn: connector=None,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    verbose: bool=False) -> int:
+    count = 0
+    if verbose:
+        print(f"async_execute_count_query.count_query:\n{clean_query(count_query)};")
+    async for batch_rows in async_query_batch_generator(count_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose):
+        for result_row in batch_rows:
+            count = result_row[0]
+    if verbose:
+        print(f"async_execute_count_query.count:\n{count:,};")
+    return count
+
+# Runs all count_queries concurrently with at most max_in_flight queries
+# submitted at once and returns their counts in the same order.
+# All queries share conn, or a single connection borrowed from the pool,
+# since one Snowflake session can run many async queries at the same time.
+async def async_execute_count_queries(
+    count_queries: List[str],
+    conn: connector=None,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    max_in_flight: int=ASYNC_MAX_IN_FLIGHT,
+    verbose: bool=False) -> List[int]:
+    pool = None
+    if conn is None:
+        pool = get_connection_pool()
+        conn = await asyncio.to_thread(pool.acquire)
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def run_count_query(count_query: str) -> int:
+        async with semaphore:
+            return await async_execute_count_query(count_query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+
+    try:
+        return await asyncio.gather(*[run_count_query(x) for x in count_queries])
+    finally:
+        if pool is not None:
+            pool.release(conn)
+
+
+################################################
+# Tests
+################################################
+
+@timefunc
+def test_async_count_queries():
+    count_queries = [f"SELECT COUNT(*) FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS WHERE ORDINAL_POSITION = {x}" for x in range(1, 6)]
+    counts = asyncio.run(async_execute_count_queries(count_queries))
+    assert len(counts) == len(count_queries), f"ERROR: expected {len(count_queries)} counts not {len(counts)}"
+    for count_query, count in zip(count_queries, counts):
+        print(f"{count:,} {count_query}")
+
+@timefunc
+def test_async_simple_query():
+    query = "SELECT TABLE_NAME, COLUMN_NAME FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS LIMIT 10"
+    rows = asyncio.run(async_execute_simple_query(query))
+    assert len(rows) == 10, f"ERROR: expected 10 rows not {len(rows)}"
+
+def test_async_query_metrics():
+    from fake_connector import connect_fake
+    conn = connect_fake()
+    conn.load_rows("A.B.T", ["ID"], [(i,) for i in range(10)])
+    registry = get_metrics_registry()
+    num_ok = registry.get_counter("queries_total", kind="count", status="ok")
+    assert asyncio.run(async_execute_count_query("SELECT COUNT(*) FROM A.B.T", conn=conn)) == 10, "ERROR: unexpected count"
+    assert registry.get_counter("queries_total", kind="count", status="ok") == num_ok + 1, f"ERROR: unexpected status labels {registry.to_dict()['counters']['queries_total']}"
+    conn.close()
+
+def test_async_simple_query_fake():
+    from fake_connector import connect_fake
+    conn = connect_fake()
+    conn.load_rows("A.B.T", ["ID", "X"], [(str(i), f"x{i}") for i in range(3)])
+    rows = asyncio.run(async_execute_simple_query("SELECT ID, X FROM A.B.T ORDER BY ID", conn=conn))
+    assert rows == [("0", "x0"), ("1", "x1"), ("2", "x2")], f"ERROR: unexpected rows {rows}"
+    conn.close()
+
+def test_async_query_timeout_fake():
+    from fake_connector import connect_fake
+    conn = connect_fake()
+    registry = get_metrics_registry()
+    num_timeouts = registry.get_counter("queries_total", kind="with", status="timeout")
+    endless_query = "WITH RECURSIVE r(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM r) SELECT COUNT(*) FROM r"
+    start = time.perf_counter()
+    rows = asyncio.run(async_execute_simple_query(endless_query, conn=conn, timeout_seconds=1))
+    assert rows == [], f"ERROR: unexpected rows {rows}"
+    assert time.perf_counter() - start < 5, "ERROR: timed out query not cancelled"
+    assert registry.get_counter("queries_total", kind="with", status="timeout") == num_timeouts + 1, f"ERROR: unexpected status labels {registry.to_dict()['counters']['queries_total']}"
+    assert len(conn.cancelled) == 1, f"ERROR: expected 1 cancelled query not {conn.cancelled}"
+    # the cancelled query no longer holds the connection
+    assert asyncio.run(async_execute_count_query("SELECT 1", conn=conn, timeout_seconds=1)) == 1, "ERROR: connection blocked after cancel"
+    conn.close()
+
+def test_async_count_queries_fake():
+    from fake_connector import connect_fake
+    conn = connect_fake()
+    for i in range(1, 6):
+        conn.load_rows(f"A.B.T{i}", ["ID"], [(str(j),) for j in range(i * 10)])
+    count_queries = [f"SELECT COUNT(*) FROM A.B.T{i}" for i in range(1, 6)]
+    counts = asyncio.run(async_execute_count_queries(count_queries, conn=conn, max_in_flight=2))
+    assert counts == [10, 20, 30, 40, 50], f"ERROR: unexpected counts {counts}"
+    conn.close()
+
+def tests():
+    test_async_query_metrics()
+    test_async_simple_query_fake()
+    test_async_query_timeout_fake()
+    test_async_count_queries_fake()
+    test_async_simple_query()
+    test_async_count_queries()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import time
+import queue
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+# Fetches the batches of a query_batch_generator on a background thread
+# into a bounded queue, so the network fetch of the next batches overlaps
+# with the consumer's processing of the current one.
+#
+# At most max_prefetch batches wait in the queue, which bounds the extra memory.
+# An exception raised by the batch_iterator (e.g. a ProgrammingError errno 604
+# with raise_errors=True) is re-raised to the consumer after the batches
+# fetched before it. If the consumer stops early (break, exception or close())
+# the thread is told to stop and closes the batch_iterator, which releases its
+# cursor and connection.
+#
+# Usage:
+#   prefetcher = BatchPrefetcher(query_batch_generator(query), max_prefetch=2)
+#   for batch_rows in prefetcher:
+#       ...
+#   print(prefetcher.get_stats())
+#
+class BatchPrefetcher():
+    # marks the end of the batches in the queue
+    DONE = object()
+
+    def __init__(self, batch_iterator: Iterator[Any], max_prefetch: int=2, put_poll_seconds: float=0.1):
+        assert max_prefetch > 0, f"ERROR: invalid max_prefetch: {max_prefetch}"
+        self.batch_iterator = batch_iterator
+        self.queue: queue.Queue = queue.Queue(maxsize=max_prefetch)
+        self.put_poll_seconds = put_poll_seconds
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {
+            "num_batches": 0,
+            "consumer_wait_seconds": 0.0,
+            "producer_wait_seconds": 0.0,
+        }
+
+    # Puts item in the queue unless the consumer stopped, returns False if it did
+    def put(self, item: Any) -> bool:
+        start = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=self.put_poll_seconds)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self.stats["producer_wait_seconds"] += time.perf_counter() - start
+
+    # Runs on the background thread
+    def produce(self) -> None:
+        try:
+            for batch in self.batch_iterator:
+                if not self.put((batch, None)):
+                    return
+            self.put((BatchPrefetcher.DONE, None))
+        except BaseException as err:
+            self.put((BatchPrefetcher.DONE, err))
+        finally:
+            close = getattr(self.batch_iterator, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self) -> Iterator[Any]:
+        assert self.thread is None, "ERROR: a BatchPrefetcher can only be iterated once"
+        self.thread = threading.Thread(target=self.produce, name="batch_prefetcher", daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch, err = self.queue.get()
+                self.stats["consumer_wait_seconds"] += time.perf_counter() - start
+                if batch is BatchPrefetcher.DONE:
+                    if err is not None:
+                        raise err
+                    return
+                self.stats["num_batches"] += 1
+                yield batch
+        finally:
+            self.close()
+
+    # Stops the background thread and waits for it to close the batch_iterator
+    def close(self, timeout_seconds: Optional[float]=None) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=timeout_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats)
+
+
+################################################
+# Tests
+################################################
+
+def test_overlap_and_order():
+    def slow_batches():
+        for i in range(5):
+            time.sleep(0.02)
+            yield [i]
+
+    start = time.perf_counter()
+    batches = []
+    prefetcher = BatchPrefetcher(slow_batches(), max_prefetch=2)
+    for batch in prefetcher:
+        time.sleep(0.02)
+        batches.append(batch)
+    seconds = time.perf_counter() - start
+    assert batches == [[i] for i in range(5)], f"ERROR: unexpected batches {batches}"
+    assert seconds < 0.18, f"ERROR: fetch and processing did not overlap in {seconds} seconds"
+    assert prefetcher.get_stats()["num_batches"] == 5, f"ERROR: unexpected stats {prefetcher.get_stats()}"
+
+def test_errors_and_early_close():
+    def failing_batches():
+        yield [1]
+        raise ValueError("expected")
+
+    batches = []
+    try:
+        for batch in BatchPrefetcher(failing_batches()):
+            batches.append(batch)
+        assert False, "ERROR: error not propagated"
+    except ValueError:
+        pass
+    assert batches == [[1]], f"ERROR: unexpected batches {batches}"
+
+    closed = threading.Event()
+    def endless_batches():
+        try:
+            i = 0
+            while True:
+                i += 1
+                yield [i]
+        finally:
+            closed.set()
+
+    prefetcher = BatchPrefetcher(endless_batches(), max_prefetch=1)
+    for batch in prefetcher:
+        break
+    assert closed.is_set() and not prefetcher.thread.is_alive(), "ERROR: batch_iterator not closed on early stop"
+
+def tests():
+    test_overlap_and_order()
+    test_errors_and_early_close()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
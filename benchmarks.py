@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+from constants import *
+from fake_connector import FakeConnection, connect_fake, get_fake_connector_stats
+from query_generator import query_batch_generator, execute_batched_select_query, execute_count_query
+from metadata_tables import MetadataTable, get_catalog_cache
+from identity_resolution import IdentityReferenceTables, resolve_metadata_table_locally
+
+# Repeatable benchmarks of the query helpers over synthetic data in a fake_connector database.
+#
+# Each benchmark is run at several scales (rows of the synthetic IDENTIFIES table) and reports
+# seconds, rows_per_second, the peak Python heap bytes measured with tracemalloc and the number
+# of connector round_trips. Results can be saved as a baseline json file and later runs are
+# compared to it, flagging rows_per_second drops and peak_bytes growth beyond the tolerance
+# and any increase in round_trips.
+#
+# Usage:
+#   python benchmarks.py --scales 1000,10000 --save-baseline
+#   python benchmarks.py --scales 1000,10000
+
+BENCHMARK_SEGMENT_TABLE = "SEGMENT.BENCH_APP.IDENTIFIES"
+BENCHMARK_METADATA_TABLE = "SEGMENT__BENCH_APP__IDENTIFIES"
+BENCHMARK_IDENTIFIES_COLUMNS = ["ID", "RECEIVED_AT", "USER_ID", "SENT_AT", "TIMESTAMP", "EMAIL", "ANONYMOUS_ID", "RID"]
+BENCHMARK_SCALES = [1000, 10000, 50000]
+
+# Fills conn with a synthetic IDENTIFIES table of num_rows rows and the
+# ELLIS_ISLAND, PERSONAS and WATCHTIME tables its uuids are resolved from
+def create_synthetic_tables(conn: FakeConnection, num_rows: int, seed: int=0) -> None:
+    rng = random.Random(seed)
+    num_users = max(1, num_rows // 4)
+    users = [f"user-{i:08d}" for i in range(num_users)]
+    identifies_rows = []
+    for i in range(num_rows):
+        user = users[rng.randrange(num_users)]
+        user_id = None if rng.random() < 0.1 else user
+        timestamp = f"2022-07-{1 + i % 28:02d} 12:00:00"
+        identifies_rows.append((str(i), timestamp, user_id, timestamp, timestamp, f"{user}@example.com", f"anon-{i}", f"rid-{rng.randrange(num_users)}"))
+    conn.load_rows(BENCHMARK_SEGMENT_TABLE, BENCHMARK_IDENTIFIES_COLUMNS, identifies_rows)
+    ellis_island_users = [x for x in users if rng.random() < 0.8]
+    conn.load_rows("STITCH_LANDING.ELLIS_ISLAND.USER", ["UUID", "USERNAME"], [(x, f"{x}@example.com") for x in ellis_island_users])
+    conn.load_rows("SEGMENT.PERSONAS_THE_CHOSEN_WEB.USERS", ["ID"], [(x,) for x in users if rng.random() < 0.5])
+    conn.load_rows("STITCH_LANDING.CHOSENHYDRA.WATCHTIME", ["RID", "USER_ID"], [(f"rid-{i}", users[rng.randrange(num_users)]) for i in range(num_users)])
+
+def get_benchmark_segment_table_dict() -> Dict[str, str]:
+    return {
+        'segment_table': BENCHMARK_SEGMENT_TABLE,
+        'metadata_table': BENCHMARK_METADATA_TABLE,
+        'columns': "-".join(BENCHMARK_IDENTIFIES_COLUMNS),
+    }
+
+# Each benchmark runs against conn and returns the number of rows it processed
+
+def bench_query_batch_generator(conn: FakeConnection, num_rows: int) -> int:
+    total_rows = 0
+    for batch_rows in query_batch_generator(f"SELECT * FROM {BENCHMARK_SEGMENT_TABLE}", conn=conn, batch_size=DEFAULT_BATCH_SIZE):
+        total_rows += len(batch_rows)
+    return total_rows
+
+def bench_batched_select_rows(conn: FakeConnection, num_rows: int) -> int:
+    df = execute_batched_select_query(f"SELECT * FROM {BENCHMARK_SEGMENT_TABLE}", BENCHMARK_IDENTIFIES_COLUMNS, conn=conn, verbose=False, batch_dot=None)
+    return len(df)
+
+def bench_batched_select_arrow(conn: FakeConnection, num_rows: int) -> int:
+    df = execute_batched_select_query(f"SELECT * FROM {BENCHMARK_SEGMENT_TABLE}", BENCHMARK_IDENTIFIES_COLUMNS, conn=conn, verbose=False, batch_dot=None, use_arrow=True)
+    return len(df)
+
+def bench_count_queries(conn: FakeConnection, num_rows: int) -> int:
+    total_rows = 0
+    for uuid_column in ["USER_ID", "EMAIL", "RID", "ANONYMOUS_ID"]:
+        execute_count_query(f"SELECT count(*) FROM {BENCHMARK_SEGMENT_TABLE} WHERE {uuid_column} IS NOT NULL", conn=conn)
+        total_rows += num_rows
+    return total_rows
+
+def bench_metadata_table_pipeline(conn: FakeConnection, num_rows: int) -> int:
+    conn.cursor().execute(f"DROP TABLE IF EXISTS SEGMENT.IDENTIFIES_METADATA.{BENCHMARK_METADATA_TABLE}")
+    get_catalog_cache().invalidate()
+    metadata_table_obj = MetadataTable(get_benchmark_segment_table_dict())
+    metadata_table_obj.clone_metadata_table(conn=conn, verbose=False, preview_only=False)
+    metadata_table_obj.add_query_dicts()
+    df = metadata_table_obj.run_query_dicts(conn=conn, verbose=False, preview_only=False)
+    return int(df['total'].iloc[0] or 0)
+
+def bench_local_identity_resolution(conn: FakeConnection, num_rows: int) -> int:
+    refs = IdentityReferenceTables.fetch(conn=conn, verbose=False)
+    [counts_df, resolved_df] = resolve_metadata_table_locally(get_benchmark_segment_table_dict(), refs, conn=conn, verbose=False)
+    return int(counts_df['total'].iloc[0])
+
+BENCHMARKS: Dict[str, Callable[[FakeConnection, int], int]] = {
+    "query_batch_generator": bench_query_batch_generator,
+    "batched_select_rows": bench_batched_select_rows,
+    "batched_select_arrow": bench_batched_select_arrow,
+    "count_queries": bench_count_queries,
+    "metadata_table_pipeline": bench_metadata_table_pipeline,
+    "local_identity_resolution": bench_local_identity_resolution,
+}
+
+# Returns the seconds, rows_per_second, peak_bytes and round_trips of one run of benchmark
+def run_benchmark(benchmark: Callable[[FakeConnection, int], int], conn: FakeConnection, num_rows: int) -> Dict[str, Any]:
+    round_trips = get_fake_connector_stats()["round_trips"]
+    tracemalloc.start()
+    start = time.perf_counter()
+    processed_rows = benchmark(conn, num_rows)
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "rows": processed_rows,
+        "seconds": seconds,
+        "rows_per_second": processed_rows / seconds if seconds > 0 else 0.0,
+        "peak_bytes": peak_bytes,
+        "round_trips": get_fake_connector_stats()["round_trips"] - round_trips,
+    }
+
+# Runs all benchmarks (or the given names) at each scale on a fresh synthetic database.
+# Returns results keyed by "name@num_rows".
+def run_benchmarks(scales: List[int]=BENCHMARK_SCALES, names: Optional[List[str]]=None, verbose: bool=True) -> Dict[str, Dict[str, Any]]:
+    names = list(BENCHMARKS) if names is None else names
+    results = {}
+    for num_rows in scales:
+        db_dir = tempfile.mkdtemp(prefix="benchmarks-")
+        conn = connect_fake(os.path.join(db_dir, "fake_snowflake.db"))
+        try:
+            create_synthetic_tables(conn, num_rows)
+            for name in names:
+                result = run_benchmark(BENCHMARKS[name], conn, num_rows)
+                results[f"{name}@{num_rows}"] = result
+                if verbose:
+                    print(f"{name}@{num_rows}: {result['rows_per_second']:,.0f} rows/s {result['seconds']:.3f}s peak:{result['peak_bytes']:,} bytes round_trips:{result['round_trips']:,}")
+        finally:
+            conn.close()
+            shutil.rmtree(db_dir)
+    return results
+
+# Returns a description of each result that regressed compared to its baseline:
+# rows_per_second or peak_bytes worse by more than tolerance, or more round_trips
+def compare_to_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float=BENCHMARK_REGRESSION_TOLERANCE) -> List[str]:
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["rows_per_second"] < base["rows_per_second"] * (1.0 - tolerance):
+            regressions.append(f"{key}: rows_per_second {result['rows_per_second']:,.0f} < baseline {base['rows_per_second']:,.0f}")
+        if result["peak_bytes"] > base["peak_bytes"] * (1.0 + tolerance):
+            regressions.append(f"{key}: peak_bytes {result['peak_bytes']:,} > baseline {base['peak_bytes']:,}")
+        if result["round_trips"] > base["round_trips"]:
+            regressions.append(f"{key}: round_trips {result['round_trips']:,} > baseline {base['round_trips']:,}")
+    return regressions
+
+def load_baseline(baseline_file: str=BENCHMARK_BASELINE_FILE) -> Optional[Dict[str, Dict[str, Any]]]:
+    if not os.path.isfile(baseline_file):
+        return None
+    with open(baseline_file) as f:
+        return json.load(f)
+
+def save_baseline(results: Dict[str, Dict[str, Any]], baseline_file: str=BENCHMARK_BASELINE_FILE) -> None:
+    with open(baseline_file, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+################################################
+# Tests
+################################################
+
+def test_compare_to_baseline():
+    baseline = {"a@10": {"rows_per_second": 1000.0, "peak_bytes": 1000, "round_trips": 5}}
+    assert compare_to_baseline({"a@10": {"rows_per_second": 900.0, "peak_bytes": 1100, "round_trips": 5}}, baseline) == [], "ERROR: unexpected regression"
+    regressions = compare_to_baseline({"a@10": {"rows_per_second": 500.0, "peak_bytes": 2000, "round_trips": 6}, "b@10": {}}, baseline)
+    assert len(regressions) == 3, f"ERROR: expected 3 regressions not {regressions}"
+
+def test_run_benchmarks():
+    results = run_benchmarks(scales=[200], verbose=False)
+    assert sorted(results) == sorted([f"{x}@200" for x in BENCHMARKS]), f"ERROR: unexpected results {sorted(results)}"
+    for key, result in results.items():
+        if key.startswith("metadata_table_pipeline") or key.startswith("local_identity_resolution"):
+            assert result["rows"] == 200, f"ERROR: {key} processed {result['rows']} rows"
+        assert result["round_trips"] > 0, f"ERROR: {key} made no round trips"
+
+def tests():
+    test_compare_to_baseline()
+    test_run_benchmarks()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the query helpers on a fake_connector database")
+    parser.add_argument("--scales", default=",".join([str(x) for x in BENCHMARK_SCALES]), help="comma separated numbers of IDENTIFIES rows")
+    parser.add_argument("--names", default=None, help=f"comma separated subset of {','.join(BENCHMARKS)}")
+    parser.add_argument("--baseline-file", default=BENCHMARK_BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tests", action="store_true", help="run the tests of this module")
+    args = parser.parse_args()
+    if args.tests:
+        tests()
+        return
+
+    scales = [int(x) for x in args.scales.split(",")]
+    names = None if args.names is None else args.names.split(",")
+    results = run_benchmarks(scales=scales, names=names)
+    if args.save_baseline:
+        save_baseline(results, args.baseline_file)
+        print(f"baseline saved to {args.baseline_file}")
+        return
+
+    baseline = load_baseline(args.baseline_file)
+    if baseline is None:
+        print(f"no baseline found at {args.baseline_file}, run with --save-baseline first")
+        return
+    regressions = compare_to_baseline(results, baseline)
+    for regression in regressions:
+        print("REGRESSION:", regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+    print("no regressions")
+
+if __name__ == "__main__":
+    main()
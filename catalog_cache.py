@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+from constants import *
+
+
+# A thread-safe cache of catalog lookups (SHOW TABLES, DESCRIBE TABLE, ...)
+# whose entries expire ttl_seconds after they were loaded.
+#
+# Entries are loaded on a miss by the given loader and can be updated
+# in place after our own CREATE/CLONE/ALTER statements so the catalog
+# does not need to be queried again.
+#
+# Usage:
+#   cache = get_catalog_cache()
+#   tables = cache.get(("show_tables", schema), lambda: run_show_tables(schema))
+#   cache.update(("show_tables", schema), lambda tables: [*tables, new_table])
+#   print(cache.get_stats())
+#
+class CatalogCache():
+    def __init__(self, ttl_seconds: float=600.0):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries: Dict[Hashable, Any] = {}
+        self.expires_at: Dict[Hashable, float] = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "updates": 0,
+            "invalidations": 0,
+        }
+
+    # Returns True if key has an entry that has not expired, must be called with self.lock held
+    def is_fresh(self, key: Hashable) -> bool:
+        if key not in self.entries:
+            return False
+        if time.monotonic() >= self.expires_at[key]:
+            del self.entries[key]
+            del self.expires_at[key]
+            self.stats["expired"] += 1
+            return False
+        return True
+
+    # Returns the cached value for key, or loads it with loader() on a miss.
+    # None values are returned but never cached.
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self.lock:
+            if self.is_fresh(key):
+                self.stats["hits"] += 1
+                return self.entries[key]
+            self.stats["misses"] += 1
+        value = loader()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    # Stores value for key with a new ttl
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.expires_at[key] = time.monotonic() + self.ttl_seconds
+
+    # Replaces the cached value for key with update_fn(value) without changing
+    # its expiry. Returns False if key is not cached, in which case the next get()
+    # simply loads the current catalog state.
+    def update(self, key: Hashable, update_fn: Callable[[Any], Any]) -> bool:
+        with self.lock:
+            if not self.is_fresh(key):
+                return False
+            self.entries[key] = update_fn(self.entries[key])
+            self.stats["updates"] += 1
+            return True
+
+    # Removes the entry for key, or all entries if key is None
+    def invalidate(self, key: Optional[Hashable]=None) -> None:
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.expires_at.clear()
+            else:
+                self.entries.pop(key, None)
+                self.expires_at.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    # Returns a copy of the cache counters with the current number of entries
+    # and the hit_ratio of all lookups
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+
+_catalog_cache = None
+_catalog_cache_lock = threading.Lock()
+
+# Returns the process-wide CatalogCache shared by metadata_tables and segment_tables
+def get_catalog_cache() -> CatalogCache:
+    global _catalog_cache
+    with _catalog_cache_lock:
+        if _catalog_cache is None:
+            _catalog_cache = CatalogCache(ttl_seconds=CATALOG_CACHE_TTL_SECONDS)
+        return _catalog_cache
+
+
+################################################
+# Tests
+################################################
+
+def test_hits_and_misses():
+    cache = CatalogCache(ttl_seconds=60)
+    loads = []
+    loader = lambda: loads.append(1) or ['A']
+    assert cache.get("tables", loader) == ['A'], "ERROR: miss did not return loaded value"
+    assert cache.get("tables", loader) == ['A'], "ERROR: hit did not return cached value"
+    assert len(loads) == 1, f"ERROR: expected 1 load not {len(loads)}"
+    stats = cache.get_stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1, f"ERROR: unexpected stats {stats}"
+
+def test_ttl_expiry():
+    cache = CatalogCache(ttl_seconds=0.0)
+    cache.get("tables", lambda: ['A'])
+    assert cache.get("tables", lambda: ['B']) == ['B'], "ERROR: expired entry returned"
+    assert cache.get_stats()['expired'] == 1, "ERROR: expiry not counted"
+
+def test_update_in_place():
+    cache = CatalogCache(ttl_seconds=60)
+    assert cache.update("tables", lambda x: x + ['B']) is False, "ERROR: update of missing key succeeded"
+    cache.get("tables", lambda: ['A'])
+    assert cache.update("tables", lambda x: x + ['B']) is True, "ERROR: update of cached key failed"
+    assert cache.get("tables", lambda: None) == ['A', 'B'], "ERROR: update not applied"
+
+def test_none_not_cached():
+    cache = CatalogCache(ttl_seconds=60)
+    assert cache.get("missing", lambda: None) is None, "ERROR: expected None"
+    assert cache.get("missing", lambda: ['A']) == ['A'], "ERROR: None value was cached"
+
+def tests():
+    test_hits_and_misses()
+    test_ttl_expiry()
+    test_update_in_place()
+    test_none_not_cached()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+
+# A pooled connection and the bookkeeping the pool keeps for it
+class PooledConnection():
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.num_uses = 0
+
+
+# Raised when no connection could be acquired within acquire_timeout_seconds
+class PoolTimeoutError(Exception):
+    pass
+
+
+# A thread-safe pool of reusable connections.
+#
+# create_conn: factory that opens a new connection, e.g. query_generator.create_connector
+# max_size: max number of connections open at once (idle + in use)
+# max_idle_seconds: idle connections older than this are closed by evict_idle(),
+#   which every acquire() and release() runs first
+# health_check_seconds: idle connections older than this are checked before reuse
+# acquire_timeout_seconds: max seconds acquire() waits for a free connection
+#
+# Usage:
+#   pool = ConnectionPool(create_connector, max_size=4)
+#   with pool.connection() as conn:
+#       execute_count_query(query, conn=conn)
+#   print(pool.get_stats())
+#
+class ConnectionPool():
+    def __init__(
+        self,
+        create_conn: Callable[[], Any],
+        max_size: int=4,
+        max_idle_seconds: float=300.0,
+        health_check_seconds: float=60.0,
+        acquire_timeout_seconds: float=600.0,
+        verbose: bool=False):
+        assert max_size > 0, f"ERROR: invalid max_size: {max_size}"
+        self.create_conn = create_conn
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.verbose = verbose
+        self.lock = threading.Condition()
+        self.idle: List[PooledConnection] = []
+        self.in_use: Dict[int, PooledConnection] = {}
+        self.num_creating = 0
+        self.stats = {
+            "created": 0,
+            "reused": 0,
+            "acquired": 0,
+            "released": 0,
+            "discarded": 0,
+            "evicted": 0,
+            "health_check_failures": 0,
+            "waits": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    # Returns True if conn is still usable.
+    # Only connections idle longer than health_check_seconds are pinged.
+    def is_healthy(self, pooled: PooledConnection) -> bool:
+        conn = pooled.conn
+        try:
+            if hasattr(conn, "is_closed") and conn.is_closed():
+                return False
+            idle_seconds = time.monotonic() - pooled.last_used_at
+            if idle_seconds < self.health_check_seconds:
+                return True
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            return True
+        except Exception as err:
+            if self.verbose:
+                print(f"connection_pool health check failed: {type(err)} {str(err)}")
+            return False
+
+    # Closes conn and ignores any error from a connection that is already broken
+    def close_conn(self, conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    # Returns an open connection, reusing an idle one when possible.
+    # Blocks while max_size connections are in use.
+    def acquire(self, timeout_seconds: Optional[float]=None) -> Any:
+        timeout_seconds = self.acquire_timeout_seconds if timeout_seconds is None else timeout_seconds
+        self.evict_idle()
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self.lock:
+                while len(self.idle) == 0 and len(self.in_use) + self.num_creating >= self.max_size:
+                    waited = True
+                    remaining = timeout_seconds - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.record_wait(start, waited)
+                        raise PoolTimeoutError(f"no connection available after {timeout_seconds} seconds")
+                    self.lock.wait(remaining)
+                self.record_wait(start, waited)
+                if len(self.idle) > 0:
+                    # reuse the most recently used connection
+                    pooled = self.idle.pop()
+                else:
+                    pooled = None
+                    self.num_creating += 1
+
+            if pooled is not None:
+                if self.is_healthy(pooled):
+                    with self.lock:
+                        pooled.num_uses += 1
+                        pooled.last_used_at = time.monotonic()
+                        self.in_use[id(pooled.conn)] = pooled
+                        self.stats["reused"] += 1
+                        self.stats["acquired"] += 1
+                    return pooled.conn
+                # unhealthy: drop it and try again
+                self.close_conn(pooled.conn)
+                with self.lock:
+                    self.stats["health_check_failures"] += 1
+                    self.stats["discarded"] += 1
+                    self.lock.notify()
+                continue
+
+            try:
+                conn = self.create_conn()
+            except Exception:
+                with self.lock:
+                    self.num_creating -= 1
+                    self.lock.notify()
+                raise
+            pooled = PooledConnection(conn)
+            pooled.num_uses = 1
+            with self.lock:
+                self.num_creating -= 1
+                self.in_use[id(conn)] = pooled
+                self.stats["created"] += 1
+                self.stats["acquired"] += 1
+            return conn
+
+    # Accumulates wait-time statistics, must be called with self.lock held
+    def record_wait(self, start: float, waited: bool) -> None:
+        if waited:
+            wait_seconds = time.monotonic() - start
+            self.stats["waits"] += 1
+            self.stats["total_wait_seconds"] += wait_seconds
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait_seconds)
+
+    # Returns conn to the pool, or closes it if discard is True
+    # or if conn was not acquired from this pool
+    def release(self, conn: Any, discard: bool=False) -> None:
+        self.evict_idle()
+        with self.lock:
+            pooled = self.in_use.pop(id(conn), None)
+            self.stats["released"] += 1
+            if pooled is not None and not discard:
+                pooled.last_used_at = time.monotonic()
+                self.idle.append(pooled)
+                self.lock.notify()
+                return
+            self.stats["discarded"] += 1
+            self.lock.notify()
+        self.close_conn(conn)
+
+    # Context manager that acquires a connection and always releases it.
+    # The connection is discarded if the body raises.
+    @contextmanager
+    def connection(self, timeout_seconds: Optional[float]=None):
+        conn = self.acquire(timeout_seconds=timeout_seconds)
+        discard = False
+        try:
+            yield conn
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    # Closes all idle connections that have been idle longer than max_idle_seconds
+    # and returns the number of evicted connections
+    def evict_idle(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            expired = [x for x in self.idle if now - x.last_used_at >= self.max_idle_seconds]
+            self.idle = [x for x in self.idle if now - x.last_used_at < self.max_idle_seconds]
+            self.stats["evicted"] += len(expired)
+            if len(expired) > 0:
+                self.lock.notify_all()
+        for pooled in expired:
+            self.close_conn(pooled.conn)
+        return len(expired)
+
+    # Closes all idle connections. In-use connections are closed when released.
+    def close_all(self) -> None:
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for pooled in idle:
+            self.close_conn(pooled.conn)
+
+    # Returns a copy of the pool statistics with current idle and in_use sizes
+    # and the reuse_ratio of acquired connections that were reused
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = len(self.idle)
+            stats["in_use"] = len(self.in_use)
+            stats["max_size"] = self.max_size
+        stats["reuse_ratio"] = stats["reused"] / stats["acquired"] if stats["acquired"] > 0 else 0.0
+        stats["avg_wait_seconds"] = stats["total_wait_seconds"] / stats["waits"] if stats["waits"] > 0 else 0.0
+        return stats
+
+
+################################################
+# Tests
+################################################
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+    def execute(self, query, timeout=None):
+        if self.conn.broken:
+            raise Exception("connection broken")
+    def fetchone(self):
+        return (1,)
+    def close(self):
+        pass
+
+class FakeConnection():
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+    def cursor(self):
+        return FakeCursor(self)
+    def is_closed(self):
+        return self.closed
+    def close(self):
+        self.closed = True
+
+def test_reuse():
+    pool = ConnectionPool(FakeConnection, max_size=2)
+    conn1 = pool.acquire()
+    pool.release(conn1)
+    conn2 = pool.acquire()
+    assert conn1 is conn2, "ERROR: idle connection not reused"
+    pool.release(conn2)
+    stats = pool.get_stats()
+    assert stats['created'] == 1, f"ERROR: expected 1 created not {stats['created']}"
+    assert stats['reused'] == 1, f"ERROR: expected 1 reused not {stats['reused']}"
+    assert stats['idle'] == 1 and stats['in_use'] == 0, f"ERROR: unexpected stats {stats}"
+
+def test_health_check():
+    pool = ConnectionPool(FakeConnection, max_size=2, health_check_seconds=0.0)
+    conn1 = pool.acquire()
+    pool.release(conn1)
+    conn1.broken = True
+    conn2 = pool.acquire()
+    assert conn2 is not conn1, "ERROR: broken connection reused"
+    assert conn1.closed, "ERROR: broken connection not closed"
+    assert pool.get_stats()['health_check_failures'] == 1, "ERROR: health check failure not counted"
+
+def test_max_size_and_wait():
+    pool = ConnectionPool(FakeConnection, max_size=1)
+    conn1 = pool.acquire()
+    try:
+        pool.acquire(timeout_seconds=0.01)
+        assert False, "ERROR: acquire should time out"
+    except PoolTimeoutError:
+        pass
+    threading.Timer(0.05, pool.release, args=[conn1]).start()
+    with pool.connection() as conn2:
+        assert conn2 is conn1, "ERROR: released connection not handed to waiter"
+    stats = pool.get_stats()
+    assert stats['waits'] == 2 and stats['max_wait_seconds'] > 0, f"ERROR: wait not recorded {stats}"
+
+def test_evict_idle():
+    pool = ConnectionPool(FakeConnection, max_size=2, max_idle_seconds=0.0)
+    conn1 = pool.acquire()
+    pool.release(conn1)
+    assert pool.evict_idle() == 1, "ERROR: idle connection not evicted"
+    assert conn1.closed, "ERROR: evicted connection not closed"
+    assert pool.get_stats()['idle'] == 0, "ERROR: evicted connection still idle"
+
+def test_idle_eviction_on_acquire_and_release():
+    pool = ConnectionPool(FakeConnection, max_size=3, max_idle_seconds=0.05)
+    conn1 = pool.acquire()
+    conn2 = pool.acquire()
+    pool.release(conn1)
+    time.sleep(0.1)
+    pool.release(conn2)
+    assert conn1.closed and not conn2.closed, "ERROR: expired connection not evicted on release"
+    time.sleep(0.1)
+    conn3 = pool.acquire()
+    assert conn3 is not conn2 and conn2.closed, "ERROR: expired connection reused"
+    pool.release(conn3)
+    stats = pool.get_stats()
+    assert stats['evicted'] == 2 and stats['idle'] == 1 and stats['created'] == 3, f"ERROR: unexpected stats {stats}"
+
+def tests():
+    test_reuse()
+    test_health_check()
+    test_max_size_and_wait()
+    test_evict_idle()
+    test_idle_eviction_on_acquire_and_release()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
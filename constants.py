@@ -1,24 +1,56 @@
 import os
 from dotenv import load_dotenv
 from utils import str2bool
+from typing import Optional
 
-if not os.path.isfile(".env"):
-    raise Exception("local .env file not found")
+# The local .env file is loaded if present. It is only required once a
+# connection setting is used, so modules and self tests that never connect
+# start without it.
+if os.path.isfile(".env"):
+    load_dotenv()
 
-load_dotenv()
+# Connection settings, read from the environment on first use by
+# settings.USER_NAME (or constants.USER_NAME) instead of at import.
+# They are not exported by `from constants import *`. A setting that is
+# neither in the process environment nor in a local .env file raises.
+CONNECTION_SETTING_NAMES = ["USER_NAME", "USER_PSWD", "ACCOUNT", "ROLE", "HOST", "PORT", "WAREHOUSE", "DATABASE", "SCHEMA"]
 
-USER_NAME = os.getenv("USER_NAME")
-USER_PSWD = os.getenv("USER_PSWD")
-ACCOUNT = os.getenv("ACCOUNT")
-ROLE = os.getenv("ROLE")
-HOST = os.getenv("HOST")
-PORT = os.getenv("PORT")
-WAREHOUSE = os.getenv("WAREHOUSE")
-DATABASE = os.getenv("DATABASE")
-SCHEMA = os.getenv("SCHEMA")
+class Settings():
+    def __init__(self):
+        self.values = {}
 
-DEFAULT_TIMEOUT_SECONDS = int(os.getenv("DEFAULT_TIMEOUT_SECONDS"))
-DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE"))
+    def __getattr__(self, name: str) -> Optional[str]:
+        if name not in CONNECTION_SETTING_NAMES:
+            raise AttributeError(f"unknown setting: {name}")
+        if name not in self.values:
+            if name not in os.environ and not os.path.isfile(".env"):
+                raise Exception(f"{name} is not set and local .env file not found")
+            self.values[name] = os.getenv(name)
+        return self.values[name]
+
+settings = Settings()
+
+# Serves constants.USER_NAME etc. from settings
+def __getattr__(name: str) -> Optional[str]:
+    if name in CONNECTION_SETTING_NAMES:
+        return getattr(settings, name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+DEFAULT_TIMEOUT_SECONDS = int(os.getenv("DEFAULT_TIMEOUT_SECONDS", "600"))
+DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE", "10000"))
+
+# used by connection_pool.py
+POOL_MAX_SIZE = int(os.getenv("POOL_MAX_SIZE", "4"))
+POOL_MAX_IDLE_SECONDS = float(os.getenv("POOL_MAX_IDLE_SECONDS", "300"))
+POOL_HEALTH_CHECK_SECONDS = float(os.getenv("POOL_HEALTH_CHECK_SECONDS", "60"))
+POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("POOL_ACQUIRE_TIMEOUT_SECONDS", "600"))
+
+# used by async_query_generator.py
+ASYNC_POLL_SECONDS = float(os.getenv("ASYNC_POLL_SECONDS", "0.5"))
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "32"))
+
+# used by catalog_cache.py
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "600"))
 
 # segment_table and columns_set constants
 ALL_KEY_COLUMNS = set(["ID","ANONYMOUS_ID", "USER_ID", "EMAIL"])
@@ -32,6 +64,8 @@ SEARCH_IGNORE_SEGMENT_TABLES_SET = set(["DEV","STAGING","IDENTIFIES_METADATA"])
 
 SEGMENT_TABLE_DICTS_DF_COLUMNS = ["segment_table","metadata_table","columns"]
 SEGMENT_TABLE_DICTS_DF_DEFAULT_BASE_NAME = "segments_table_dicts_df"
+SEGMENT_TABLE_VERSIONS_DF_COLUMNS = ["metadata_table","last_altered","columns"]
+SEGMENT_TABLE_VERSIONS_DF_DEFAULT_BASE_NAME = "segment_table_versions_df"
 
 # used by batch_segment_table_metadata.py
 SEGMENT_METADATA = "SEGMENT.IDENTIFIES_METADATA"
@@ -46,12 +80,72 @@ SEGMENT_QUERY_LIMIT_CLAUSE = ''
 # used by data_frame_utils.py
 CSV_FORMAT = "csv"
 PARQUET_FORMAT = "parquet"
+FEATHER_FORMAT = "feather"
+
+# used by parquet_sink.py
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+# used by snapshot_manifest.py and data_frame_utils.save_data_frame, retention is opt-in:
+# 0 keeps any number of snapshots, 0 days keeps snapshots of any age
+SNAPSHOT_RETENTION_COUNT = int(os.getenv("SNAPSHOT_RETENTION_COUNT", "0"))
+SNAPSHOT_RETENTION_DAYS = float(os.getenv("SNAPSHOT_RETENTION_DAYS", "0"))
+
+# used by query_generator.create_connector, a sqlite file for fake_connector.py
+# instead of a Snowflake account when set
+FAKE_CONNECTOR_DB = os.getenv("FAKE_CONNECTOR_DB", "")
+
+# used by benchmarks.py
+BENCHMARK_BASELINE_FILE = os.getenv("BENCHMARK_BASELINE_FILE", "benchmark_baseline.json")
+BENCHMARK_REGRESSION_TOLERANCE = float(os.getenv("BENCHMARK_REGRESSION_TOLERANCE", "0.25"))
+
+# used by main.py, where tracing.py spans are saved as Chrome trace events
+TRACE_FILE = os.getenv("TRACE_FILE", "/tmp/snowflake_connector_trace.json")
+
+# used by metadata_tables.create_and_run_metadata_tables to resume from a progress_journal.py journal
+PROGRESS_JOURNAL_FILE = os.getenv("PROGRESS_JOURNAL_FILE", "/tmp/metadata_tables_progress.jsonl")
+
+# used by adaptive_batch_sizer.py, batches are sized to stay within both targets
+ADAPTIVE_BATCH_INITIAL_SIZE = int(os.getenv("ADAPTIVE_BATCH_INITIAL_SIZE", str(DEFAULT_BATCH_SIZE)))
+ADAPTIVE_BATCH_MIN_SIZE = int(os.getenv("ADAPTIVE_BATCH_MIN_SIZE", "100"))
+ADAPTIVE_BATCH_MAX_SIZE = int(os.getenv("ADAPTIVE_BATCH_MAX_SIZE", "1000000"))
+ADAPTIVE_BATCH_TARGET_BYTES = int(os.getenv("ADAPTIVE_BATCH_TARGET_BYTES", str(64 * 1024 * 1024)))
+ADAPTIVE_BATCH_TARGET_SECONDS = float(os.getenv("ADAPTIVE_BATCH_TARGET_SECONDS", "1.0"))
+
+# used by partitioned_update.py, ranges are split on timeout down to min range seconds
+PARTITIONED_UPDATE_MAX_WORKERS = int(os.getenv("PARTITIONED_UPDATE_MAX_WORKERS", "4"))
+PARTITIONED_UPDATE_MAX_ROWS = int(os.getenv("PARTITIONED_UPDATE_MAX_ROWS", "5000000"))
+PARTITIONED_UPDATE_MIN_RANGE_SECONDS = float(os.getenv("PARTITIONED_UPDATE_MIN_RANGE_SECONDS", "60"))
+
+# used by metadata_tables.create_and_run_metadata_tables when scheduled as a dag_scheduler.py DAG,
+# the max number of steps and so warehouse queries in flight at once
+DAG_MAX_WORKERS = int(os.getenv("DAG_MAX_WORKERS", str(POOL_MAX_SIZE)))
+
+# used by result_cache.py
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "/tmp/query_result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
 
 ################################################
 # Tests
 ################################################
 
 def test_constants():    
+    assert "USER_NAME" not in globals(), "ERROR: connection settings loaded at import"
+    assert DEFAULT_TIMEOUT_SECONDS > 0 and DEFAULT_BATCH_SIZE > 0, "ERROR: invalid defaults"
+    try:
+        settings.UNKNOWN_SETTING
+        assert False, "ERROR: unknown setting served"
+    except AttributeError:
+        pass
+    # a setting from the process environment needs no .env file
+    saved_schema = os.environ.get("SCHEMA")
+    os.environ["SCHEMA"] = "TEST_SCHEMA"
+    try:
+        assert Settings().SCHEMA == "TEST_SCHEMA", "ERROR: environment setting not served"
+    finally:
+        if saved_schema is None:
+            del os.environ["SCHEMA"]
+        else:
+            os.environ["SCHEMA"] = saved_schema
     print("all tests passed in", os.path.basename(__file__))
 
 def tests():
@@ -0,0 +1,200 @@
+import os
+import time
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional
+from tracing import span
+
+# Runs a DAG of named nodes, each a function of the results of its dependencies,
+# on up to max_workers threads, i.e. at most max_workers warehouse queries in flight.
+#
+# Ready nodes are started in order of their critical path cost, the cost of the
+# node plus the most costly path of nodes that depend on it, so the chains of the
+# largest tables start first and the total runtime shrinks. Nodes whose function
+# raises are failed, and nodes that depend on a failed node are skipped.
+#
+# Usage:
+#   dag = DagScheduler(max_workers=4)
+#   dag.add("T:clone", lambda results: clone(), cost=1000)
+#   dag.add("T:update", lambda results: update(), deps=["T:clone"], cost=5000)
+#   results = dag.run()
+#
+
+# A node of the DAG, func is called with the dict of results of its deps
+class DagNode():
+    def __init__(self, name: str, func: Callable[[Dict[str, Any]], Any], deps: List[str], cost: float):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.cost = cost
+        self.dependents: List[str] = []
+        self.priority = cost
+        self.status = "pending"
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.seconds: Optional[float] = None
+        self.started_at: Optional[float] = None
+
+
+class DagScheduler():
+    def __init__(self, max_workers: int=4):
+        assert max_workers > 0, f"ERROR: invalid max_workers: {max_workers}"
+        self.max_workers = max_workers
+        self.nodes: Dict[str, DagNode] = {}
+        self.lock = threading.Lock()
+        self.max_in_flight = 0
+        self.seconds: Optional[float] = None
+
+    # Adds a node that runs func after all deps succeeded, deps must be added first
+    def add(self, name: str, func: Callable[[Dict[str, Any]], Any], deps: Optional[List[str]]=None, cost: float=0) -> DagNode:
+        assert name not in self.nodes, f"ERROR: duplicate node: {name}"
+        deps = [] if deps is None else list(deps)
+        missing = [x for x in deps if x not in self.nodes]
+        assert len(missing) == 0, f"ERROR: unknown deps {missing} of {name}"
+        node = DagNode(name, func, deps, cost)
+        for dep in deps:
+            self.nodes[dep].dependents.append(name)
+        self.nodes[name] = node
+        return node
+
+    # Sets the critical path cost of every node, nodes are added after their deps
+    # so walking them backwards visits dependents first
+    def compute_priorities(self) -> None:
+        for node in reversed(list(self.nodes.values())):
+            node.priority = node.cost + max([self.nodes[x].priority for x in node.dependents], default=0)
+
+    # Marks node and all nodes depending on it as skipped
+    def skip_dependents(self, node: DagNode) -> None:
+        for name in node.dependents:
+            dependent = self.nodes[name]
+            if dependent.status == "pending":
+                dependent.status = "skipped"
+                self.skip_dependents(dependent)
+
+    def run_node(self, node: DagNode) -> Any:
+        with self.lock:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+        start = time.perf_counter()
+        node.started_at = start
+        try:
+            with span(node.name, cat="dag"):
+                return node.func({x: self.nodes[x].result for x in node.deps})
+        finally:
+            node.seconds = time.perf_counter() - start
+            with self.lock:
+                self.num_in_flight -= 1
+
+    # Runs all nodes and returns the results of the succeeded nodes by name
+    def run(self, verbose: bool=False) -> Dict[str, Any]:
+        start = time.perf_counter()
+        self.compute_priorities()
+        self.num_in_flight = 0
+        num_waiting = {name: len(node.deps) for name, node in self.nodes.items()}
+        # ties keep the order the nodes were added in
+        order = {name: i for i, name in enumerate(self.nodes)}
+        ready = [(-node.priority, order[name], name) for name, node in self.nodes.items() if len(node.deps) == 0]
+        heapq.heapify(ready)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(ready) > 0 or len(futures) > 0:
+                while len(ready) > 0 and len(futures) < self.max_workers:
+                    _, _, name = heapq.heappop(ready)
+                    node = self.nodes[name]
+                    if node.status != "pending":
+                        continue
+                    node.status = "running"
+                    futures[executor.submit(self.run_node, node)] = node
+                if len(futures) == 0:
+                    break
+                finished, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = futures.pop(future)
+                    node.error = future.exception()
+                    if node.error is not None:
+                        node.status = "failed"
+                        print(f"ERROR: dag node {node.name} failed with {type(node.error).__name__} {str(node.error)}")
+                        self.skip_dependents(node)
+                        continue
+                    node.status = "done"
+                    node.result = future.result()
+                    if verbose:
+                        print(f"dag node {node.name} done in {node.seconds:.3f} seconds")
+                    for name in node.dependents:
+                        num_waiting[name] -= 1
+                        if num_waiting[name] == 0 and self.nodes[name].status == "pending":
+                            heapq.heappush(ready, (-self.nodes[name].priority, order[name], name))
+        self.seconds = time.perf_counter() - start
+        return {name: node.result for name, node in self.nodes.items() if node.status == "done"}
+
+    def get_stats(self) -> Dict[str, Any]:
+        statuses = [node.status for node in self.nodes.values()]
+        return {
+            "num_nodes": len(self.nodes),
+            "num_done": statuses.count("done"),
+            "num_failed": statuses.count("failed"),
+            "num_skipped": statuses.count("skipped"),
+            "max_in_flight": self.max_in_flight,
+            "seconds": self.seconds,
+        }
+
+
+################################################
+# Tests
+################################################
+
+def test_dependencies_and_order():
+    started = []
+    lock = threading.Lock()
+
+    def step(name: str, seconds: float=0.0) -> Callable[[Dict[str, Any]], Any]:
+        def func(results: Dict[str, Any]) -> str:
+            with lock:
+                started.append(name)
+            time.sleep(seconds)
+            return "+".join([name, *sorted(results.values())])
+        return func
+
+    dag = DagScheduler(max_workers=1)
+    dag.add("small:clone", step("small:clone"), cost=1)
+    dag.add("small:update", step("small:update"), deps=["small:clone"], cost=10)
+    dag.add("large:clone", step("large:clone"), cost=1)
+    dag.add("large:update", step("large:update"), deps=["large:clone"], cost=100)
+    results = dag.run()
+    assert started[0] == "large:clone", f"ERROR: largest chain not started first {started}"
+    assert started.index("large:update") > started.index("large:clone"), f"ERROR: dependency order broken {started}"
+    assert results["small:update"] == "small:update+small:clone", f"ERROR: unexpected result {results['small:update']}"
+
+    dag = DagScheduler(max_workers=3)
+    for i in range(6):
+        dag.add(f"t{i}", step(f"t{i}", 0.05))
+    start = time.perf_counter()
+    dag.run()
+    assert time.perf_counter() - start < 0.25, "ERROR: independent nodes did not run concurrently"
+    assert dag.get_stats()["max_in_flight"] == 3, f"ERROR: unexpected stats {dag.get_stats()}"
+
+def test_failures_skip_dependents():
+    def fail(results: Dict[str, Any]) -> None:
+        raise ValueError("expected")
+
+    dag = DagScheduler(max_workers=2)
+    dag.add("a", fail)
+    dag.add("b", lambda results: 1, deps=["a"])
+    dag.add("c", lambda results: 2, deps=["b"])
+    dag.add("d", lambda results: 3)
+    results = dag.run()
+    assert results == {"d": 3}, f"ERROR: unexpected results {results}"
+    stats = dag.get_stats()
+    assert stats["num_failed"] == 1 and stats["num_skipped"] == 2 and stats["num_done"] == 1, f"ERROR: unexpected stats {stats}"
+
+def tests():
+    test_dependencies_and_order()
+    test_failures_skip_dependents()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
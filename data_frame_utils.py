@@ -1,12 +1,19 @@
+from __future__ import annotations
 import os
 import pandas as pd
-from typing import Set, List, Tuple, Any, Optional
+from typing import Set, List, Tuple, Any, Optional, Union
 import datetime
-import snowflake.connector as connector
-from utils import is_readable_file, find_latest_file, generate_random_string
+from utils import is_readable_file, find_latest_file, generate_random_string, LazyModule
+from snapshot_manifest import SnapshotManifest, get_schema_hash
 from pprint import pprint
 from constants import *
 
+# pyarrow is only imported by the feather, parquet and filter code paths
+pa = LazyModule("pyarrow")
+pc = LazyModule("pyarrow.compute")
+feather = LazyModule("pyarrow.feather")
+pq = LazyModule("pyarrow.parquet")
+
 # Returns True if df is None or has zero rows
 def is_empty_data_frame(df: pd.DataFrame) -> bool:
     return True if df is None or len(df) == 0 else False
@@ -17,29 +24,126 @@ def get_data_frame_len(df: pd.DataFrame) -> int:
 
 # Saves the data_frame (sets column ID as index column) 
 # to a new data_file with the given base_name, current timestamp and 
-# file format extension (CSV_FORMAT | PARQUET_FORMAT) and 
-# returns the name of the new data_file
-def save_data_frame(base_name: str, df: pd.DataFrame, format: str=CSV_FORMAT) -> str:
+# file format extension (CSV_FORMAT | PARQUET_FORMAT | FEATHER_FORMAT) and 
+# returns the name of the new data_file.
+# FEATHER_FORMAT files are uncompressed Arrow IPC files that
+# load_data_frame memory maps without copying.
+# The data_file is written under a temporary name and renamed into place before it is
+# published in the SnapshotManifest of base_name. Only if gc is True, which it is
+# when SNAPSHOT_RETENTION_COUNT or SNAPSHOT_RETENTION_DAYS are set, the manifest then
+# garbage collects the snapshots beyond them.
+def save_data_frame(base_name: str, df: pd.DataFrame, format: str=CSV_FORMAT, gc: bool=SNAPSHOT_RETENTION_COUNT > 0 or SNAPSHOT_RETENTION_DAYS > 0) -> str:
     utc_now = datetime.datetime.utcnow().isoformat()
     data_file = f"/tmp/{base_name}-{utc_now}.{format}"
+    # hidden tmp_file never matches the /tmp/{base_name}-*.* pattern
+    tmp_file = f"/tmp/.{base_name}-{utc_now}.{os.getpid()}.tmp"
+    num_rows = len(df)
+    schema_hash = get_schema_hash(df)
     if format == CSV_FORMAT:
         if "ID" in df.columns:
             df = df.set_index(keys=["ID"])
-        df.to_csv(data_file) 
+        df.to_csv(tmp_file) 
     elif format == PARQUET_FORMAT: 
         df = df.reset_index(level=None)
-        df.to_parquet(data_file)
+        df.to_parquet(tmp_file)
+    elif format == FEATHER_FORMAT:
+        df = df.reset_index(level=None)
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), tmp_file, compression="uncompressed")
+    os.replace(tmp_file, data_file)
+    manifest = SnapshotManifest(base_name)
+    manifest.publish(data_file, format, num_rows, schema_hash)
+    if gc:
+        manifest.gc()
     return data_file
 
-# Uses the data_file's file format extension (CSV_FORMAT | PARQUET_FORMAT)
+# Row filters are given like pyarrow.parquet.read_table filters:
+# a list of (column, op, value) tuples that must all match, or a list of
+# such lists of which any must match. op is one of
+# ==, =, !=, <, <=, >, >=, in, not in
+Filters = Union[List[Tuple[str, str, Any]], List[List[Tuple[str, str, Any]]]]
+
+# The filter ops applied to a pandas column or an arrow compute field
+FILTER_OPS = {
+    "==": lambda c, v: c == v,
+    "=": lambda c, v: c == v,
+    "!=": lambda c, v: c != v,
+    "<": lambda c, v: c < v,
+    "<=": lambda c, v: c <= v,
+    ">": lambda c, v: c > v,
+    ">=": lambda c, v: c >= v,
+    "in": lambda c, v: c.isin(list(v)),
+    "not in": lambda c, v: ~c.isin(list(v)),
+}
+
+# Returns filters as a list of conjunctions
+def get_filter_conjunctions(filters: Filters) -> List[List[Tuple[str, str, Any]]]:
+    return filters if len(filters) > 0 and isinstance(filters[0], list) else [filters]
+
+# Returns the boolean mask of rows of df that match filters
+def get_filters_mask(df: pd.DataFrame, filters: Filters) -> pd.Series:
+    mask = pd.Series(False, index=df.index)
+    for conjunction in get_filter_conjunctions(filters):
+        conjunction_mask = pd.Series(True, index=df.index)
+        for column, op, value in conjunction:
+            assert op in FILTER_OPS, f"ERROR: unsupported filter op: {op}"
+            conjunction_mask &= FILTER_OPS[op](df[column], value)
+        mask |= conjunction_mask
+    return mask
+
+# Returns the arrow compute expression of filters
+def get_filters_expression(filters: Filters) -> pc.Expression:
+    expression = None
+    for conjunction in get_filter_conjunctions(filters):
+        conjunction_expression = None
+        for column, op, value in conjunction:
+            assert op in FILTER_OPS, f"ERROR: unsupported filter op: {op}"
+            term = FILTER_OPS[op](pc.field(column), value)
+            conjunction_expression = term if conjunction_expression is None else conjunction_expression & term
+        expression = conjunction_expression if expression is None else expression | conjunction_expression
+    return expression
+
+# Reads the given columns (all if None) of the rows of an Arrow table data_file
+# that match filters. Parquet files are memory mapped and the projection and
+# filters are pushed down to the reader, which skips row groups by their statistics.
+# Feather files are memory mapped and only the selected columns are touched.
+def read_arrow_table(data_file: str, columns: Optional[List[str]]=None, filters: Optional[Filters]=None) -> pa.Table:
+    if data_file.endswith(PARQUET_FORMAT):
+        if columns is not None:
+            schema_columns = pq.read_schema(data_file).names
+            columns = [x for x in columns if x in schema_columns]
+        return pq.read_table(data_file, columns=columns, filters=filters, memory_map=True)
+    table = feather.read_table(data_file, memory_map=True)
+    if columns is not None:
+        filter_columns = [] if filters is None else [x[0] for conjunction in get_filter_conjunctions(filters) for x in conjunction]
+        table = table.select([x for x in table.column_names if x in columns or x in filter_columns])
+    if filters is not None:
+        table = table.filter(get_filters_expression(filters))
+    if columns is not None:
+        table = table.select([x for x in columns if x in table.column_names])
+    return table
+
+# Uses the data_file's file format extension (CSV_FORMAT | PARQUET_FORMAT | FEATHER_FORMAT)
 # to load the data_frame or None if the given data_file
-# is not found or is not readable
-def load_data_frame(data_file: str) -> Optional[pd.DataFrame]:
+# is not found or is not readable.
+# Only the given columns are loaded (all if None) and only the rows that match
+# filters (see Filters). Projection and filters are pushed down to the
+# Parquet reader, Parquet and Feather files are memory mapped and converted to
+# pandas while their Arrow buffers are released, so resident memory is not doubled.
+def load_data_frame(data_file: str, columns: Optional[List[str]]=None, filters: Optional[Filters]=None) -> Optional[pd.DataFrame]:
+    df = None
     if is_readable_file(data_file):
         if data_file.endswith(CSV_FORMAT):
-            df = pd.read_csv(data_file)
-        elif data_file.endswith(PARQUET_FORMAT):
-            df = pd.read_parquet(data_file)
+            filter_columns = [] if filters is None else [x[0] for conjunction in get_filter_conjunctions(filters) for x in conjunction]
+            usecols = None if columns is None else lambda x: x in columns or x in filter_columns
+            df = pd.read_csv(data_file, usecols=usecols)
+            if filters is not None:
+                df = df[get_filters_mask(df, filters)].reset_index(drop=True)
+            if columns is not None:
+                df = df[[x for x in df.columns if x in columns]]
+        elif data_file.endswith(PARQUET_FORMAT) or data_file.endswith(FEATHER_FORMAT):
+            table = read_arrow_table(data_file, columns=columns, filters=filters)
+            df = table.to_pandas(split_blocks=True, self_destruct=True)
+            del table
     if df is not None:
         if "Unnamed: 0" in df.columns:
             df = df.drop(columns=['Unnamed: 0'])
@@ -52,11 +156,41 @@ def load_data_frame(data_file: str) -> Optional[pd.DataFrame]:
 # Returns the data_file and the data_frame if the latest data_file
 # with the given base_name is found, is readable and is decodablea. 
 # Otherwise returns None
-def load_latest_data_frame(base_name: str) -> Optional[Tuple[str, pd.DataFrame]]:
-    data_file = find_latest_file(f"/tmp/{base_name}-*.*")
-    df = load_data_frame(data_file)
+# See load_data_frame for columns and filters
+# The latest data_file is taken from the SnapshotManifest of base_name,
+# or found by file pattern for snapshots saved before there was a manifest
+def load_latest_data_frame(base_name: str, columns: Optional[List[str]]=None, filters: Optional[Filters]=None) -> Optional[Tuple[str, pd.DataFrame]]:
+    latest_entry = SnapshotManifest(base_name).latest()
+    if latest_entry is not None:
+        data_file = latest_entry["file"]
+    else:
+        data_file = find_latest_file(f"/tmp/{base_name}-*.*")
+    df = load_data_frame(data_file, columns=columns, filters=filters)
     return (data_file, df) if df is not None else None
 
+# Returns a data_frame with columns c0..cN-1 holding the given result rows
+def rows_to_data_frame(rows: List[Tuple]) -> pd.DataFrame:
+    num_cols = len(rows[0]) if len(rows) > 0 else 0
+    return pd.DataFrame.from_records(rows, columns=[f"c{i}" for i in range(num_cols)])
+
+# Returns the rows of df as a list of tuples of python values with None for nulls
+def data_frame_to_rows(df: pd.DataFrame) -> List[Tuple]:
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+# Writes df as is (no index handling) to the given parquet data_file
+# and returns the size of the data_file in bytes
+def write_parquet_file(df: pd.DataFrame, data_file: str) -> int:
+    df.to_parquet(data_file, index=False)
+    return os.path.getsize(data_file)
+
+# Reads a data_frame written by write_parquet_file
+# or returns None if data_file is not found or is not readable
+def read_parquet_file(data_file: str) -> Optional[pd.DataFrame]:
+    if not is_readable_file(data_file):
+        return None
+    return pd.read_parquet(data_file)
+
 # Return a data_frame created as num_rows dicts with num_cols key-value pairs
 def generate_random_dataframe(num_rows: int=3, num_cols: int=3) -> pd.DataFrame:
     cols = []
@@ -89,8 +223,56 @@ def test_save_load_dataframe():
     assert loaded_df_str == saved_df_str, f"ERROR: expected\n{saved_df_str} not\n{loaded_df_str}"
 
 
+def test_rows_parquet_round_trip():
+    rows = [(1, 'a', None), (2, None, 3.5)]
+    data_file = f"/tmp/dataframe_utils_test-{generate_random_string()}.parquet"
+    num_bytes = write_parquet_file(rows_to_data_frame(rows), data_file)
+    assert num_bytes > 0, "ERROR: empty parquet file"
+    loaded_rows = data_frame_to_rows(read_parquet_file(data_file))
+    os.remove(data_file)
+    assert loaded_rows == rows, f"ERROR: expected\n{rows} not\n{loaded_rows}"
+
+def test_projected_filtered_loads():
+    df = pd.DataFrame({
+        "ID": [f"id-{i}" for i in range(100)],
+        "A": list(range(100)),
+        "B": [f"b-{i % 10}" for i in range(100)],
+    })
+    base_name = f"dataframe_utils_test-{generate_random_string()}"
+    for format in [CSV_FORMAT, PARQUET_FORMAT, FEATHER_FORMAT]:
+        data_file = save_data_frame(base_name, df, format)
+        loaded_df = load_data_frame(data_file)
+        assert list(loaded_df.columns) == ["A", "B"] and loaded_df.index.name == "ID", f"ERROR: unexpected {format} columns {list(loaded_df.columns)}"
+        assert len(loaded_df) == 100, f"ERROR: expected 100 {format} rows not {len(loaded_df)}"
+        projected_df = load_data_frame(data_file, columns=["ID", "B"], filters=[("A", ">=", 90), ("B", "in", ["b-1", "b-2"])])
+        assert list(projected_df.columns) == ["B"], f"ERROR: unexpected {format} projection {list(projected_df.columns)}"
+        assert list(projected_df.index) == ["id-91", "id-92"], f"ERROR: unexpected {format} filtered rows {list(projected_df.index)}"
+        any_df = load_data_frame(data_file, columns=["A"], filters=[[("A", "==", 1)], [("A", "==", 2)]])
+        assert list(any_df["A"]) == [1, 2], f"ERROR: unexpected {format} disjunction {list(any_df['A'])}"
+        os.remove(data_file)
+    manifest = SnapshotManifest(base_name)
+    os.remove(manifest.manifest_file)
+    os.remove(manifest.lock_file)
+
+def test_snapshots_kept_by_default():
+    df = pd.DataFrame({"ID": ["id-1"], "A": [1]})
+    base_name = f"dataframe_utils_test-{generate_random_string()}"
+    data_files = [save_data_frame(base_name, df, PARQUET_FORMAT, gc=False) for i in range(3)]
+    assert all([os.path.isfile(x) for x in data_files]), "ERROR: snapshots removed without retention"
+    save_data_frame(base_name, df, PARQUET_FORMAT, gc=True)
+    if SNAPSHOT_RETENTION_COUNT == 0 and SNAPSHOT_RETENTION_DAYS == 0:
+        assert all([os.path.isfile(x) for x in data_files]), "ERROR: snapshots removed by default retention"
+    manifest = SnapshotManifest(base_name)
+    for entry in manifest.entries():
+        os.remove(entry["file"])
+    os.remove(manifest.manifest_file)
+    os.remove(manifest.lock_file)
+
 def tests():
     test_save_load_dataframe()
+    test_rows_parquet_round_trip()
+    test_projected_filtered_loads()
+    test_snapshots_kept_by_default()
     print("all tests passed in", os.path.basename(__file__))
 
 
@@ -13,14 +13,14 @@ def main():
     print("python: ", sys.version)
     
     conn = connector.connect(
-        user=USER_NAME,
-        password=USER_PSWD,
-        account=ACCOUNT,
-        warehouse=WAREHOUSE,
-        database=DATABASE,
-        schema=SCHEMA,
+        user=settings.USER_NAME,
+        password=settings.USER_PSWD,
+        account=settings.ACCOUNT,
+        warehouse=settings.WAREHOUSE,
+        database=settings.DATABASE,
+        schema=settings.SCHEMA,
         protocol='https',
-        port=PORT
+        port=settings.PORT
         )
     cur = conn.cursor()
     try:
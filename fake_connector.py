@@ -0,0 +1,551 @@
+import os
+import re
+import time
+import uuid
+import sqlite3
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from snowflake.connector import ProgrammingError
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# A local stand-in for a Snowflake connection backed by SQLite.
+#
+# It implements the part of the connector that query_generator, async_query_generator,
+# connection_pool and metadata_tables use: cursor(), execute(query, timeout=),
+# fetchmany, fetchall, fetch_arrow_batches, execute_async, sfqid,
+# get_query_status_throw_if_error, is_still_running and get_results_from_sfqid.
+#
+# Snowflake SQL is translated to SQLite before it runs:
+#   DATABASE.SCHEMA.TABLE                   -> DATABASE__SCHEMA__TABLE
+#   CREATE TABLE [IF NOT EXISTS] X CLONE Y   -> CREATE TABLE [IF NOT EXISTS] X AS SELECT * FROM Y
+#   ALTER TABLE X ADD COLUMN A ..., B ...   -> one ALTER TABLE per column
+#   UPDATE X alias SET ...                  -> UPDATE X AS alias SET ...
+#   SHOW TABLES LIKE 'P' IN DB.SCHEMA       -> a sqlite_master lookup
+#   DESCRIBE TABLE X                        -> PRAGMA table_info(X)
+#   COUNT_IF(expr)                          -> a registered aggregate
+#   TO_DATE(expr)                           -> a registered function of the date part
+#   CREATE STAGE, PUT, COPY INTO ... FROM @stage of parquet files and DROP STAGE
+#                                           -> files kept per stage and inserted by column name
+#   MERGE INTO X t USING Y s ON ... WHEN MATCHED THEN UPDATE SET ...
+#     WHEN NOT MATCHED THEN INSERT (...) VALUES (...)
+#                                           -> an UPDATE ... FROM and an INSERT ... SELECT in one transaction
+# execute_async runs the query in a background thread, its status is RUNNING until
+# it is done, and SYSTEM$CANCEL_QUERY('<query id>') interrupts it with errno 604.
+# Statements without a result return a status row like Snowflake does:
+# the number of affected rows for INSERT/UPDATE/DELETE, otherwise a status message.
+# Other MERGE forms and INFORMATION_SCHEMA are not supported and raise ProgrammingError
+# like any other failed query.
+#
+# Every call that would be a network round trip to Snowflake (execute, status poll,
+# result fetch, fetchmany, arrow batch) is counted, see get_fake_connector_stats().
+#
+# Usage:
+#   conn = connect_fake("/tmp/fake_snowflake.db")
+#   conn.load_rows("SEGMENT.APP.IDENTIFIES", ["ID","USER_ID"], rows)
+#   execute_count_query("SELECT count(*) FROM SEGMENT.APP.IDENTIFIES", conn=conn)
+#
+# or set FAKE_CONNECTOR_DB in .env to make create_connector() return one.
+
+THREE_PART_NAME_PATTERN = re.compile(r"\b([A-Za-z_][A-Za-z0-9_$]*)\.([A-Za-z_][A-Za-z0-9_$]*)\.([A-Za-z_][A-Za-z0-9_$]*)\b")
+CLONE_PATTERN = re.compile(r"^CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\S+)\s+CLONE\s+(\S+)\s*$", re.IGNORECASE)
+CREATE_OR_REPLACE_PATTERN = re.compile(r"^CREATE\s+OR\s+REPLACE\s+TABLE\s+(\S+)", re.IGNORECASE)
+ALTER_ADD_COLUMNS_PATTERN = re.compile(r"^ALTER\s+TABLE\s+(\S+)\s+ADD\s+COLUMN\s+(.*)$", re.IGNORECASE)
+UPDATE_ALIAS_PATTERN = re.compile(r"^UPDATE\s+(\S+)\s+(?!SET\b)(?!AS\b)([A-Za-z_][A-Za-z0-9_]*)\s+SET\b", re.IGNORECASE)
+SHOW_TABLES_PATTERN = re.compile(r"^SHOW\s+TABLES\s+LIKE\s+'([^']*)'\s+IN\s+([A-Za-z0-9_$]+)\.([A-Za-z0-9_$]+)\s*$", re.IGNORECASE)
+DESCRIBE_TABLE_PATTERN = re.compile(r"^DESCRIBE\s+TABLE\s+(\S+)\s*$", re.IGNORECASE)
+CREATE_STAGE_PATTERN = re.compile(r"^CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMPORARY\s+)?STAGE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\S+)", re.IGNORECASE)
+DROP_STAGE_PATTERN = re.compile(r"^DROP\s+STAGE\s+(?:IF\s+EXISTS\s+)?(\S+)", re.IGNORECASE)
+PUT_PATTERN = re.compile(r"^PUT\s+'?file://([^'\s]+)'?\s+@(\S+)", re.IGNORECASE)
+COPY_INTO_PATTERN = re.compile(r"^COPY\s+INTO\s+(\S+)\s+FROM\s+@(\S+)", re.IGNORECASE)
+CANCEL_QUERY_PATTERN = re.compile(r"SYSTEM\$CANCEL_QUERY\s*\(\s*'?([^')]*)'?\s*\)", re.IGNORECASE)
+QUOTED_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*')")
+# the MERGE form of query_generator.build_bulk_merge_query
+MERGE_PATTERN = re.compile(r"^MERGE\s+INTO\s+(\S+)\s+(\w+)\s+USING\s+(\S+)\s+(\w+)\s+ON\s+(.*?)"
+    r"(?:\s+WHEN\s+MATCHED\s+THEN\s+UPDATE\s+SET\s+(.*?))?"
+    r"(?:\s+WHEN\s+NOT\s+MATCHED\s+THEN\s+INSERT\s*\(([^)]*)\)\s*VALUES\s*\(([^)]*)\))?\s*$", re.IGNORECASE)
+
+FAKE_QUERY_STATUS_SUCCESS = "SUCCESS"
+FAKE_QUERY_STATUS_RUNNING = "RUNNING"
+
+_fake_stats_lock = threading.Lock()
+_fake_stats = {
+    "connections": 0,
+    "queries": 0,
+    "round_trips": 0,
+    "rows_fetched": 0,
+}
+
+# Adds the given counts to the process-wide fake connector stats
+def add_fake_connector_stats(**counts: int) -> None:
+    with _fake_stats_lock:
+        for key, count in counts.items():
+            _fake_stats[key] += count
+
+# Returns a copy of the process-wide stats of all fake connections
+def get_fake_connector_stats() -> Dict[str, int]:
+    with _fake_stats_lock:
+        return dict(_fake_stats)
+
+# Resets the process-wide stats of all fake connections
+def reset_fake_connector_stats() -> None:
+    with _fake_stats_lock:
+        for key in _fake_stats:
+            _fake_stats[key] = 0
+
+# Returns the sqlite table name of a DATABASE.SCHEMA.TABLE name
+def to_sqlite_table_name(name: str) -> str:
+    return name.upper().replace(".", "__")
+
+# Replaces the DATABASE.SCHEMA.TABLE names outside of quoted literals
+def replace_three_part_names(query: str) -> str:
+    parts = QUOTED_LITERAL_PATTERN.split(query)
+    for i in range(0, len(parts), 2):
+        parts[i] = THREE_PART_NAME_PATTERN.sub(lambda m: to_sqlite_table_name(m.group(0)), parts[i])
+    return "".join(parts)
+
+# Splits the column definitions of ALTER TABLE ADD COLUMN on commas outside of parentheses
+def split_column_definitions(definitions: str) -> List[str]:
+    columns = []
+    depth = 0
+    current = ""
+    for c in definitions:
+        if c == "," and depth == 0:
+            columns.append(current.strip())
+            current = ""
+            continue
+        depth += 1 if c == "(" else -1 if c == ")" else 0
+        current += c
+    if len(current.strip()) > 0:
+        columns.append(current.strip())
+    return columns
+
+# Returns the list of sqlite statements that implement query
+def translate_query(query: str) -> List[str]:
+    query = " ".join(query.strip().rstrip(";").split())
+    upper_query = query.upper()
+    if upper_query.startswith("MERGE ") or "INFORMATION_SCHEMA" in upper_query:
+        raise ProgrammingError(msg=f"fake_connector does not support: {query[:80]}", errno=2003)
+
+    m = SHOW_TABLES_PATTERN.match(query)
+    if m is not None:
+        prefix = f"{m.group(2)}__{m.group(3)}__".upper()
+        return [f"SELECT NULL, substr(name, {len(prefix) + 1}), '{m.group(2).upper()}', '{m.group(3).upper()}', 'TABLE' FROM sqlite_master WHERE type = 'table' AND name LIKE '{prefix}{m.group(1)}'"]
+
+    m = DESCRIBE_TABLE_PATTERN.match(query)
+    if m is not None:
+        return [f"SELECT upper(name), type, 'COLUMN', CASE WHEN \"notnull\" = 1 THEN 'N' ELSE 'Y' END, dflt_value, CASE WHEN pk > 0 THEN 'Y' ELSE 'N' END FROM pragma_table_info('{to_sqlite_table_name(m.group(1))}')"]
+
+    query = CANCEL_QUERY_PATTERN.sub("NULL", query)
+    query = replace_three_part_names(query)
+
+    m = CLONE_PATTERN.match(query)
+    if m is not None:
+        if_not_exists = "IF NOT EXISTS " if m.group(1) else ""
+        statements = [f"CREATE TABLE {if_not_exists}{m.group(2)} AS SELECT * FROM {m.group(3)}"]
+        if upper_query.startswith("CREATE OR REPLACE"):
+            statements.insert(0, f"DROP TABLE IF EXISTS {m.group(2)}")
+        return statements
+
+    m = CREATE_OR_REPLACE_PATTERN.match(query)
+    if m is not None:
+        return [f"DROP TABLE IF EXISTS {m.group(1)}", f"CREATE TABLE {query[m.start(1):]}"]
+
+    m = ALTER_ADD_COLUMNS_PATTERN.match(query)
+    if m is not None:
+        return [f"ALTER TABLE {m.group(1)} ADD COLUMN {x}" for x in split_column_definitions(m.group(2))]
+
+    m = UPDATE_ALIAS_PATTERN.match(query)
+    if m is not None:
+        query = f"UPDATE {m.group(1)} AS {m.group(2)} SET" + query[m.end(0):]
+
+    return [query]
+
+
+# Returns the description and status row of a statement without a result
+def get_status_result(statement: str, rowcount: int) -> List[Any]:
+    first_word = statement.strip().split(None, 1)[0].upper()
+    if first_word in ("INSERT", "UPDATE", "DELETE"):
+        return [[("number of rows", None, None, None, None, None, None)], [(rowcount,)]]
+    return [[("status", None, None, None, None, None, None)], [("Statement executed successfully.",)]]
+
+
+# TO_DATE(expr) of a timestamp string
+def to_date(value: Any) -> Optional[str]:
+    return None if value is None else str(value)[:10]
+
+# COUNT_IF(expr) aggregate
+class CountIf():
+    def __init__(self):
+        self.count = 0
+
+    def step(self, value: Any) -> None:
+        if value:
+            self.count += 1
+
+    def finalize(self) -> int:
+        return self.count
+
+
+# A cursor over the result of the last query run on a FakeConnection
+class FakeCursor():
+    def __init__(self, conn: 'FakeConnection'):
+        self.conn = conn
+        self.sfqid = None
+        self.description = None
+        self.rowcount = -1
+        self.rows: List[Tuple] = []
+        self.position = 0
+        self.arrow_batch_size = 10000
+
+    # Runs query and keeps its result rows, raises ProgrammingError errno 604 after timeout seconds
+    def execute(self, query: str, params: Optional[Sequence[Any]]=None, timeout: Optional[int]=None) -> 'FakeCursor':
+        add_fake_connector_stats(queries=1, round_trips=1)
+        self.sfqid = str(uuid.uuid4())
+        [self.description, self.rows, self.rowcount] = self.conn.run(query, params=params, timeout=timeout)
+        self.position = 0
+        return self
+
+    # Starts query in a background thread and returns right away, its result or
+    # error is kept until picked up with get_results_from_sfqid
+    def execute_async(self, query: str, params: Optional[Sequence[Any]]=None, timeout: Optional[int]=None) -> Dict[str, str]:
+        add_fake_connector_stats(queries=1, round_trips=1)
+        self.sfqid = sfqid = str(uuid.uuid4())
+        conn = self.conn
+
+        def run_query() -> None:
+            try:
+                conn.results[sfqid] = conn.run(query, params=params, timeout=timeout, sfqid=sfqid)
+            except ProgrammingError as err:
+                conn.results[sfqid] = err
+
+        thread = threading.Thread(target=run_query, name=f"fake-query-{sfqid}", daemon=True)
+        conn.running[sfqid] = thread
+        thread.start()
+        return {"queryId": sfqid}
+
+    # Waits for an earlier query of this connection and loads its result,
+    # raises its ProgrammingError if it failed
+    def get_results_from_sfqid(self, sfqid: str) -> None:
+        add_fake_connector_stats(round_trips=1)
+        result = self.conn.wait_for_query(sfqid)
+        self.conn.results.pop(sfqid)
+        if isinstance(result, ProgrammingError):
+            raise result
+        self.sfqid = sfqid
+        [self.description, self.rows, self.rowcount] = result
+        self.position = 0
+
+    def fetchmany(self, size: int=1) -> List[Tuple]:
+        add_fake_connector_stats(round_trips=1)
+        batch_rows = self.rows[self.position:self.position + size]
+        self.position += len(batch_rows)
+        add_fake_connector_stats(rows_fetched=len(batch_rows))
+        return batch_rows
+
+    def fetchall(self) -> List[Tuple]:
+        return self.fetchmany(len(self.rows) - self.position)
+
+    def fetchone(self) -> Optional[Tuple]:
+        batch_rows = self.fetchmany(1)
+        return batch_rows[0] if len(batch_rows) > 0 else None
+
+    # Yields the remaining rows as Arrow tables of at most arrow_batch_size rows
+    def fetch_arrow_batches(self) -> Iterator[pa.Table]:
+        columns = [x[0] for x in (self.description or [])]
+        while self.position < len(self.rows):
+            batch_rows = self.fetchmany(self.arrow_batch_size)
+            yield pa.table({column: [row[i] for row in batch_rows] for i, column in enumerate(columns)})
+
+    def close(self) -> None:
+        self.rows = []
+        self.position = 0
+
+
+# A single SQLite connection that behaves like a Snowflake connection
+class FakeConnection():
+    def __init__(self, db_file: str=":memory:"):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.db.create_aggregate("COUNT_IF", 1, CountIf)
+        self.db.create_function("TO_DATE", 1, to_date)
+        self.lock = threading.Lock()
+        self.results: Dict[str, Any] = {}
+        self.running: Dict[str, threading.Thread] = {}
+        self.cancelled = set()
+        self.stages: Dict[str, List[str]] = {}
+        self.closed = False
+        add_fake_connector_stats(connections=1)
+
+    def cursor(self) -> FakeCursor:
+        if self.closed:
+            raise ProgrammingError(msg="connection is closed", errno=250001)
+        return FakeCursor(self)
+
+    # Returns the description, rows and rowcount of query run with sqlite.
+    # An async query with the given sfqid is interrupted once it is cancelled.
+    def run(self, query: str, params: Optional[Sequence[Any]]=None, timeout: Optional[int]=None, sfqid: Optional[str]=None) -> List[Any]:
+        m = CANCEL_QUERY_PATTERN.search(query)
+        if m is not None:
+            self.cancelled.add(m.group(1))
+        stage_result = self.run_stage_statement(" ".join(query.strip().rstrip(";").split()))
+        if stage_result is not None:
+            return stage_result
+        merge_result = self.run_merge_statement(" ".join(query.strip().rstrip(";").split()))
+        if merge_result is not None:
+            return merge_result
+        statements = translate_query(query)
+        deadline = None if timeout is None or timeout <= 0 else time.monotonic() + timeout
+        with self.lock:
+            if deadline is not None or sfqid is not None:
+                self.db.set_progress_handler(lambda: 1 if sfqid in self.cancelled or (deadline is not None and time.monotonic() > deadline) else 0, 10000)
+            try:
+                description, rows, rowcount = None, [], -1
+                for statement in statements:
+                    cur = self.db.execute(statement, params or [])
+                    description = cur.description
+                    rows = cur.fetchall()
+                    rowcount = cur.rowcount
+                if description is None:
+                    [description, rows] = get_status_result(statements[-1], rowcount)
+                return [description, rows, rowcount]
+            except sqlite3.OperationalError as err:
+                if "interrupted" in str(err) and sfqid in self.cancelled:
+                    raise ProgrammingError(msg=f"query {sfqid} was canceled", errno=604)
+                if "interrupted" in str(err):
+                    raise ProgrammingError(msg=f"statement reached its {timeout} second timeout", errno=604)
+                raise ProgrammingError(msg=f"{str(err)} in: {statements[-1][:200]}", errno=2003)
+            except sqlite3.Error as err:
+                raise ProgrammingError(msg=f"{str(err)} in: {statements[-1][:200]}", errno=2003)
+            finally:
+                self.db.set_progress_handler(None, 0)
+
+    # Runs CREATE STAGE, PUT, COPY INTO and DROP STAGE statements,
+    # returns None for all other statements
+    def run_stage_statement(self, query: str) -> Optional[List[Any]]:
+        m = CREATE_STAGE_PATTERN.match(query)
+        if m is not None:
+            self.stages[m.group(1).upper()] = []
+            return [*get_status_result(query, -1), -1]
+        m = DROP_STAGE_PATTERN.match(query)
+        if m is not None:
+            self.stages.pop(m.group(1).upper(), None)
+            return [*get_status_result(query, -1), -1]
+        m = PUT_PATTERN.match(query)
+        if m is not None:
+            stage = m.group(2).upper()
+            if stage not in self.stages:
+                raise ProgrammingError(msg=f"stage {stage} does not exist", errno=2003)
+            self.stages[stage].append(m.group(1))
+            file_name = os.path.basename(m.group(1))
+            description = [(x, None, None, None, None, None, None) for x in ["source", "target", "status"]]
+            return [description, [(file_name, file_name, "UPLOADED")], 1]
+        m = COPY_INTO_PATTERN.match(query)
+        if m is not None:
+            stage = m.group(2).upper()
+            if stage not in self.stages:
+                raise ProgrammingError(msg=f"stage {stage} does not exist", errno=2003)
+            rows = [self.copy_into(m.group(1), x) for x in self.stages[stage]]
+            if re.search(r"\bPURGE\s*=\s*TRUE\b", query, re.IGNORECASE):
+                self.stages[stage] = []
+            description = [(x, None, None, None, None, None, None) for x in ["file", "status", "rows_parsed", "rows_loaded"]]
+            return [description, rows, sum([x[3] for x in rows])]
+        return None
+
+    # Runs a MERGE of the MERGE_PATTERN form and returns its result row of the
+    # number of rows inserted and updated like Snowflake, or None for other statements.
+    # Like Snowflake it fails if a target row matches more than one source row.
+    def run_merge_statement(self, query: str) -> Optional[List[Any]]:
+        m = MERGE_PATTERN.match(query)
+        if m is None or (m.group(6) is None and m.group(7) is None):
+            return None
+        target = f"{to_sqlite_table_name(m.group(1))} AS {m.group(2)}"
+        source = f"{to_sqlite_table_name(m.group(3))} AS {m.group(4)}"
+        on_str = replace_three_part_names(m.group(5))
+        not_matched = f"NOT EXISTS (SELECT 1 FROM {target} WHERE {on_str})"
+        columns = []
+        counts = []
+        with self.lock:
+            try:
+                self.db.execute("BEGIN")
+                num_duplicates = self.db.execute(f"SELECT COUNT(*) FROM (SELECT {m.group(2)}.rowid FROM {target} JOIN {source} ON {on_str} GROUP BY {m.group(2)}.rowid HAVING COUNT(*) > 1)").fetchone()[0]
+                if num_duplicates > 0:
+                    raise ProgrammingError(msg=f"Duplicate row detected during DML action in: {query[:200]}", errno=100090)
+                num_inserted = 0 if m.group(7) is None else self.db.execute(f"SELECT COUNT(*) FROM {source} WHERE {not_matched}").fetchone()[0]
+                if m.group(6) is not None:
+                    # sqlite does not qualify the columns set by an UPDATE
+                    set_str = ", ".join([re.sub(rf"^{m.group(2)}\.", "", x, flags=re.IGNORECASE) for x in split_column_definitions(m.group(6))])
+                    num_updated = self.db.execute(f"UPDATE {target} SET {set_str} FROM {source} WHERE {on_str}").rowcount
+                if m.group(7) is not None:
+                    self.db.execute(f"INSERT INTO {to_sqlite_table_name(m.group(1))} ({m.group(7)}) SELECT {m.group(8)} FROM {source} WHERE {not_matched}")
+                    columns.append("number of rows inserted")
+                    counts.append(num_inserted)
+                if m.group(6) is not None:
+                    columns.append("number of rows updated")
+                    counts.append(num_updated)
+                self.db.execute("COMMIT")
+            except sqlite3.Error as err:
+                self.db.execute("ROLLBACK")
+                raise ProgrammingError(msg=f"{str(err)} in: {query[:200]}", errno=2003)
+            except ProgrammingError:
+                self.db.execute("ROLLBACK")
+                raise
+        description = [(x, None, None, None, None, None, None) for x in columns]
+        return [description, [tuple(counts)], sum(counts)]
+
+    # Inserts the columns of a parquet data_file that match columns of table by name
+    # and returns a COPY INTO result row
+    def copy_into(self, table: str, data_file: str) -> Tuple:
+        sqlite_table = to_sqlite_table_name(table)
+        with self.lock:
+            table_columns = [x[1] for x in self.db.execute(f"SELECT * FROM pragma_table_info('{sqlite_table}')").fetchall()]
+        if len(table_columns) == 0:
+            raise ProgrammingError(msg=f"table {table} does not exist", errno=2003)
+        data = pq.read_table(data_file)
+        columns_by_upper = {x.upper(): x for x in data.column_names}
+        columns = [x for x in table_columns if x.upper() in columns_by_upper]
+        values = [data.column(columns_by_upper[x.upper()]).to_pylist() for x in columns]
+        placeholders = ", ".join(["?"] * len(columns))
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(f"INSERT INTO {sqlite_table} ({', '.join(columns)}) VALUES ({placeholders})", list(zip(*values)))
+            self.db.execute("COMMIT")
+        return (os.path.basename(data_file), "LOADED", data.num_rows, data.num_rows)
+
+    # Returns RUNNING until the async query is done, raises its ProgrammingError if it failed
+    def get_query_status_throw_if_error(self, sfqid: str) -> str:
+        add_fake_connector_stats(round_trips=1)
+        if sfqid not in self.running:
+            raise ProgrammingError(msg=f"unknown query id {sfqid}", errno=2003)
+        if self.running[sfqid].is_alive():
+            return FAKE_QUERY_STATUS_RUNNING
+        if isinstance(self.results.get(sfqid), ProgrammingError):
+            raise self.results[sfqid]
+        return FAKE_QUERY_STATUS_SUCCESS
+
+    # Returns the result or ProgrammingError of an async query once it is done
+    def wait_for_query(self, sfqid: str) -> Any:
+        if sfqid not in self.running:
+            raise ProgrammingError(msg=f"unknown query id {sfqid}", errno=2003)
+        self.running[sfqid].join()
+        del self.running[sfqid]
+        return self.results[sfqid]
+
+    def is_still_running(self, status: str) -> bool:
+        return status != FAKE_QUERY_STATUS_SUCCESS
+
+    # Creates DATABASE.SCHEMA.TABLE if needed and bulk inserts rows, for setting up test data
+    def load_rows(self, table: str, columns: List[str], rows: Sequence[Sequence[Any]]) -> int:
+        sqlite_table = to_sqlite_table_name(table)
+        columns_str = ", ".join([f"{x} VARCHAR" for x in columns])
+        placeholders = ", ".join(["?"] * len(columns))
+        with self.lock:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {sqlite_table} ({columns_str})")
+            self.db.execute("BEGIN")
+            self.db.executemany(f"INSERT INTO {sqlite_table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+            self.db.execute("COMMIT")
+        return len(rows)
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        if not self.closed:
+            self.db.close()
+            self.closed = True
+
+
+# Returns a new FakeConnection on db_file, all connections on the same file share its tables
+def connect_fake(db_file: str=":memory:") -> FakeConnection:
+    return FakeConnection(db_file)
+
+
+################################################
+# Tests
+################################################
+
+def test_translate_query():
+    statements = translate_query("create table if not exists SEGMENT.IDENTIFIES_METADATA.T1 clone SEGMENT.APP.IDENTIFIES")
+    assert statements == ["CREATE TABLE IF NOT EXISTS SEGMENT__IDENTIFIES_METADATA__T1 AS SELECT * FROM SEGMENT__APP__IDENTIFIES"], f"ERROR: unexpected clone {statements}"
+    statements = translate_query("ALTER TABLE A.B.C ADD COLUMN X VARCHAR DEFAULT NULL, Y NUMBER(38,0) DEFAULT NULL")
+    assert statements == ["ALTER TABLE A__B__C ADD COLUMN X VARCHAR DEFAULT NULL", "ALTER TABLE A__B__C ADD COLUMN Y NUMBER(38,0) DEFAULT NULL"], f"ERROR: unexpected alter {statements}"
+    statements = translate_query("UPDATE A.B.C id1 set x = 1 WHERE email = 'a.b.c@x.com'")
+    assert statements == ["UPDATE A__B__C AS id1 SET x = 1 WHERE email = 'a.b.c@x.com'"], f"ERROR: unexpected update {statements}"
+
+def test_cursor_surface():
+    conn = connect_fake()
+    conn.load_rows("SEGMENT.APP.IDENTIFIES", ["ID", "USER_ID"], [(str(i), f"u{i % 3}") for i in range(10)])
+    cur = conn.cursor()
+    cur.execute("SELECT ID, USER_ID FROM SEGMENT.APP.IDENTIFIES ORDER BY CAST(ID AS INTEGER)", timeout=10)
+    assert cur.fetchmany(4) == [('0', 'u0'), ('1', 'u1'), ('2', 'u2'), ('3', 'u0')], "ERROR: unexpected fetchmany"
+    assert len(cur.fetchall()) == 6, "ERROR: unexpected fetchall"
+    cur.execute("SELECT COUNT_IF(USER_ID = 'u0') FROM SEGMENT.APP.IDENTIFIES")
+    assert cur.fetchone() == (4,), "ERROR: unexpected COUNT_IF"
+    cur.execute("SELECT USER_ID FROM SEGMENT.APP.IDENTIFIES")
+    cur.arrow_batch_size = 4
+    tables = list(cur.fetch_arrow_batches())
+    assert [x.num_rows for x in tables] == [4, 4, 2], f"ERROR: unexpected arrow batches {[x.num_rows for x in tables]}"
+    cur.execute("SHOW TABLES LIKE '%IDENTIFIES' IN SEGMENT.APP")
+    assert [x[1] for x in cur.fetchall()] == ['IDENTIFIES'], "ERROR: unexpected show tables"
+    cur.execute("DESCRIBE TABLE SEGMENT.APP.IDENTIFIES")
+    assert [x[0] for x in cur.fetchall()] == ['ID', 'USER_ID'], "ERROR: unexpected describe table"
+    cur.execute_async("SELECT COUNT(*) FROM SEGMENT.APP.IDENTIFIES")
+    while conn.is_still_running(conn.get_query_status_throw_if_error(cur.sfqid)):
+        time.sleep(0.01)
+    cur.get_results_from_sfqid(cur.sfqid)
+    assert cur.fetchall() == [(10,)], "ERROR: unexpected async result"
+    conn.close()
+
+def test_timeout_and_errors():
+    conn = connect_fake()
+    cur = conn.cursor()
+    try:
+        cur.execute("WITH RECURSIVE r(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM r) SELECT COUNT(*) FROM r", timeout=0.2)
+        assert False, "ERROR: expected timeout"
+    except ProgrammingError as err:
+        assert err.errno == 604, f"ERROR: expected errno 604 not {err.errno}"
+    try:
+        cur.execute("SELECT * FROM A.B.MISSING")
+        assert False, "ERROR: expected missing table error"
+    except ProgrammingError as err:
+        assert err.errno != 604, "ERROR: missing table reported as timeout"
+    query_id = cur.execute_async("WITH RECURSIVE r(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM r) SELECT COUNT(*) FROM r")["queryId"]
+    time.sleep(0.05)
+    assert conn.is_still_running(conn.get_query_status_throw_if_error(query_id)), "ERROR: async query not running"
+    cur.execute(f"SELECT SYSTEM$CANCEL_QUERY('{query_id}')")
+    try:
+        cur.get_results_from_sfqid(query_id)
+        assert False, "ERROR: expected canceled query"
+    except ProgrammingError as err:
+        assert err.errno == 604, f"ERROR: expected errno 604 not {err.errno}"
+    conn.close()
+
+def test_merge():
+    conn = connect_fake()
+    conn.load_rows("A.B.T", ["ID", "X"], [("1", "a"), ("2", "b")])
+    conn.load_rows("A.B.S", ["ID", "X"], [("2", "B"), ("3", "C")])
+    cur = conn.cursor()
+    cur.execute("MERGE INTO A.B.T t USING A.B.S s ON t.ID = s.ID WHEN MATCHED THEN UPDATE SET t.X = s.X WHEN NOT MATCHED THEN INSERT (ID, X) VALUES (s.ID, s.X)")
+    assert [x[0] for x in cur.description] == ["number of rows inserted", "number of rows updated"] and cur.fetchall() == [(1, 1)], "ERROR: unexpected merge result"
+    cur.execute("SELECT ID, X FROM A.B.T ORDER BY ID")
+    assert cur.fetchall() == [("1", "a"), ("2", "B"), ("3", "C")], "ERROR: unexpected merged rows"
+    conn.load_rows("A.B.S", ["ID", "X"], [("2", "BB")])
+    try:
+        cur.execute("MERGE INTO A.B.T t USING A.B.S s ON t.ID = s.ID WHEN MATCHED THEN UPDATE SET t.X = s.X")
+        assert False, "ERROR: expected duplicate row error"
+    except ProgrammingError as err:
+        assert err.errno == 100090, f"ERROR: unexpected errno {err.errno}"
+    conn.close()
+
+def tests():
+    test_translate_query()
+    test_cursor_surface()
+    test_timeout_and_errors()
+    test_merge()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import time
+import snowflake.connector as connector
+from snowflake.connector import ProgrammingError
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from typing import Dict, List, Optional
+from constants import *
+from query_generator import query_batch_generator, clean_query
+from segment_tables import get_segment_table_dicts_df, get_segment_table_dicts
+
+# Local alternative to the warehouse UPDATE joins of MetadataTable.add_query_dicts.
+#
+# The reference columns of ELLIS_ISLAND, PERSONAS and WATCHTIME are streamed once
+# and shared by all IDENTIFIES tables. For each IDENTIFIES table only the distinct
+# USER_ID/EMAIL[/RID] keys with their row counts are streamed, and all uuid columns
+# are resolved with Arrow hash joins and set lookups, with the semantics of the
+# set_uuid UPDATEs: each uuid is resolved per USER_ID from all the rows of that
+# USER_ID, and a row whose lookup finds no ellis_island uuid is a NULL candidate.
+# Where a USER_ID has several candidates the UPDATE assigns any one of them, here
+# the candidate that sorts last by EMAIL or by RID is taken, which is also the
+# one the SQLite fake_connector assigns, so both give the same counts.
+
+ELLIS_ISLAND_TABLE = "STITCH_LANDING.ELLIS_ISLAND.USER"
+PERSONA_USERS_TABLE = "SEGMENT.PERSONAS_THE_CHOSEN_WEB.USERS"
+WATCHTIME_TABLE = "STITCH_LANDING.CHOSENHYDRA.WATCHTIME"
+
+# Returns all batches of query as a single Arrow table with upper-case
+# columns, an empty table of string columns if the query returned no rows,
+# or None if the query failed
+def fetch_arrow_table(query: str, columns: List[str], conn: connector=None, timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, verbose: bool=False) -> Optional[pa.Table]:
+    query = clean_query(query)
+    if verbose:
+        print(f"fetch_arrow_table:\n{query};")
+    try:
+        batches = list(query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose, fetch_arrow=True, raise_errors=True))
+    except ProgrammingError:
+        return None
+    if len(batches) == 0:
+        return empty_string_table(columns)
+    table = pa.concat_tables(batches)
+    table = table.rename_columns([x.upper() for x in table.column_names])
+    return table
+
+# Returns table with its columns cast to strings so lookups compare like values
+def to_string_columns(table: pa.Table, columns: List[str]) -> pa.Table:
+    for column in columns:
+        i = table.column_names.index(column)
+        table = table.set_column(i, column, pc.cast(table.column(column), pa.string()))
+    return table
+
+# Returns an empty Arrow table with the given string columns
+def empty_string_table(columns: List[str]) -> pa.Table:
+    return pa.table({x: pa.array([], type=pa.string()) for x in columns})
+
+
+# The reference columns used to resolve the uuids of every IDENTIFIES table
+class IdentityReferenceTables():
+    def __init__(self, ellis_island: pa.Table, persona_ids: pa.Array, watchtime: pa.Table):
+        # ellis_island: UUID, USERNAME
+        self.ellis_island = ellis_island
+        self.ellis_island_uuids = pc.unique(ellis_island.column("UUID").drop_null())
+        self.persona_ids = pc.unique(persona_ids.drop_null())
+        # watchtime: RID, WT_USER_ID, a WT_USER_ID unknown to ellis_island resolves to NULL
+        self.watchtime = watchtime
+
+    # Streams the reference columns once and returns them, or None if any query failed
+    @staticmethod
+    def fetch(conn: connector=None, timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, verbose: bool=True) -> Optional['IdentityReferenceTables']:
+        start = time.perf_counter()
+        ellis_island = fetch_arrow_table(f"SELECT DISTINCT UUID, USERNAME FROM {ELLIS_ISLAND_TABLE}", ["UUID", "USERNAME"], conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+        personas = fetch_arrow_table(f"SELECT DISTINCT ID FROM {PERSONA_USERS_TABLE} WHERE ID IS NOT NULL", ["ID"], conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+        watchtime = fetch_arrow_table(f"SELECT DISTINCT RID, USER_ID AS WT_USER_ID FROM {WATCHTIME_TABLE} WHERE RID IS NOT NULL", ["RID", "WT_USER_ID"], conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+        if ellis_island is None or personas is None or watchtime is None:
+            print("ERROR: failed to fetch identity reference tables")
+            return None
+        refs = IdentityReferenceTables(
+            to_string_columns(ellis_island, ["UUID", "USERNAME"]),
+            pc.cast(personas.column("ID"), pa.string()).combine_chunks(),
+            to_string_columns(watchtime, ["RID", "WT_USER_ID"]))
+        if verbose:
+            print(f"fetched identity reference tables in {time.perf_counter() - start:.2f} seconds {refs.get_stats()}")
+        return refs
+
+    # Returns the number of rows of each reference table
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "ellis_island_rows": self.ellis_island.num_rows,
+            "ellis_island_uuids": len(self.ellis_island_uuids),
+            "persona_ids": len(self.persona_ids),
+            "watchtime_rows": self.watchtime.num_rows,
+        }
+
+
+# Returns the query that streams the distinct keys of segment_table
+# with the number of rows N of each key
+def build_identifies_keys_query(segment_table: str, has_rid: bool) -> str:
+    key_columns = "USER_ID, EMAIL, RID" if has_rid else "USER_ID, EMAIL"
+    return f"SELECT {key_columns}, COUNT(*) AS N FROM {segment_table} GROUP BY {key_columns}"
+
+# Returns the UUID (or NULL) of the candidate of each USER_ID of candidates
+# (USER_ID, *sort_columns, UUID) that sorts last by sort_columns, NULLs first
+def last_uuid_by_user_id(candidates: pa.Table, sort_columns: List[str], uuid_column: str) -> pa.Table:
+    if candidates.num_rows == 0:
+        return empty_string_table(["USER_ID", uuid_column])
+    # a validity column before each sort column puts its NULLs first
+    sort_keys = [("USER_ID", "ascending")]
+    for column in sort_columns:
+        candidates = candidates.append_column(f"{column}_IS_VALID", pc.is_valid(candidates.column(column)))
+        sort_keys.extend([(f"{column}_IS_VALID", "ascending"), (column, "ascending")])
+    candidates = candidates.sort_by(sort_keys)
+    user_ids = candidates.column("USER_ID").combine_chunks()
+    # the last row of each USER_ID is followed by another USER_ID or is the last row
+    is_last = pc.not_equal(user_ids.slice(0, len(user_ids) - 1), user_ids.slice(1))
+    is_last = pa.concat_arrays([is_last, pa.array([True])])
+    last = candidates.filter(is_last)
+    return pa.table({"USER_ID": last.column("USER_ID"), uuid_column: last.column("UUID")})
+
+# Resolves the uuid columns of the distinct USER_IDs of keys (USER_ID, EMAIL[, RID], N).
+# Returns one row per USER_ID with USER_ID_UUID, USERNAME_UUID, PERSONA_UUID
+# and RID_UUID if keys has a RID column, which is what the set_uuid queries
+# assign to every row of that USER_ID.
+def resolve_user_id_uuids(keys: pa.Table, refs: IdentityReferenceTables) -> pa.Table:
+    has_rid = "RID" in keys.column_names
+    keys = keys.filter(pc.is_valid(keys.column("USER_ID")))
+    user_ids = pc.unique(keys.column("USER_ID")) if keys.num_rows > 0 else pa.array([], type=pa.string())
+    null_uuids = pa.nulls(len(user_ids), type=pa.string())
+
+    # USER_ID_UUID: the user_id itself when it is an ellis_island uuid
+    in_ellis_island = pc.is_in(user_ids, value_set=refs.ellis_island_uuids)
+    user_id_uuid = pc.if_else(in_ellis_island, user_ids, null_uuids)
+
+    # PERSONA_UUID: the user_id when it is a persona id and an ellis_island uuid
+    in_personas = pc.is_in(user_ids, value_set=refs.persona_ids)
+    persona_uuid = pc.if_else(pc.and_(in_personas, in_ellis_island), user_ids, null_uuids)
+
+    resolved = pa.table({"USER_ID": user_ids, "USER_ID_UUID": user_id_uuid, "PERSONA_UUID": persona_uuid})
+
+    # USERNAME_UUID: the ellis_island uuid whose username is the email of a row of
+    # the user_id (LEFT JOIN), a row without a matching username is a NULL candidate
+    emails = keys.select(["USER_ID", "EMAIL"])
+    username_matches = emails.join(refs.ellis_island, keys="EMAIL", right_keys="USERNAME", join_type="left outer")
+    resolved = resolved.join(last_uuid_by_user_id(username_matches.select(["USER_ID", "EMAIL", "UUID"]), ["EMAIL", "UUID"], "USERNAME_UUID"), keys="USER_ID", join_type="left outer")
+
+    # RID_UUID: the watchtime user_id of the rid of a row of the user_id (JOIN) if
+    # it is an ellis_island uuid (LEFT JOIN), otherwise a NULL candidate
+    if has_rid:
+        rids = keys.select(["USER_ID", "RID"]).filter(pc.is_valid(keys.column("RID")))
+        rid_matches = rids.join(refs.watchtime, keys="RID", join_type="inner")
+        wt_user_ids = rid_matches.column("WT_USER_ID")
+        rid_uuids = pc.if_else(pc.is_in(wt_user_ids, value_set=refs.ellis_island_uuids), wt_user_ids, pa.nulls(len(wt_user_ids), type=pa.string()))
+        rid_candidates = pa.table({"USER_ID": rid_matches.column("USER_ID"), "RID": rid_matches.column("RID"), "WT_USER_ID": wt_user_ids, "UUID": rid_uuids})
+        resolved = resolved.join(last_uuid_by_user_id(rid_candidates, ["RID", "WT_USER_ID"], "RID_UUID"), keys="USER_ID", join_type="left outer")
+
+    uuid_columns = [x for x in SEGMENT_UUIDS if x in resolved.column_names]
+    return resolved.select(["USER_ID", *uuid_columns])
+
+# Returns the total rows and non-null uuid counts of the IDENTIFIES table with
+# the given keys after resolution, in the same shape as MetadataTable.run_query_dicts
+def count_resolved_uuids(metadata_table: str, keys: pa.Table, resolved: pa.Table) -> pd.DataFrame:
+    uuid_counts = {}
+    uuid_counts['metadata_table'] = metadata_table
+    uuid_counts['total'] = pc.sum(keys.column("N")).as_py() or 0
+    for uuid in SEGMENT_UUIDS:
+        uuid_counts[uuid] = None
+
+    key_rows = keys.select(["USER_ID", "N"]).filter(pc.is_valid(keys.column("USER_ID")))
+    key_rows = key_rows.group_by("USER_ID").aggregate([("N", "sum")]).rename_columns(["USER_ID", "N"])
+    joined = key_rows.join(resolved, keys="USER_ID", join_type="left outer")
+    for uuid in SEGMENT_UUIDS:
+        if uuid in resolved.column_names:
+            counts = joined.filter(pc.is_valid(joined.column(uuid))).column("N")
+            uuid_counts[uuid] = pc.sum(counts).as_py() or 0
+    df = pd.DataFrame.from_dict(data=uuid_counts, orient="index").transpose()
+    return df
+
+# Streams the keys of a single IDENTIFIES table and resolves its uuid columns locally.
+# Returns the counts data_frame and the resolved uuid columns per USER_ID,
+# which can be written back to the cloned metadata_table in bulk.
+def resolve_metadata_table_locally(segment_table_dict: Dict[str,str], refs: IdentityReferenceTables, conn: connector=None, verbose: bool=True) -> List[Optional[pd.DataFrame]]:
+    segment_table = segment_table_dict['segment_table']
+    metadata_table = segment_table_dict['metadata_table']
+    has_rid = "RID" in segment_table_dict['columns'].split("-")
+    start = time.perf_counter()
+    keys_query = build_identifies_keys_query(segment_table, has_rid)
+    key_columns = ["USER_ID", "EMAIL", "RID"] if has_rid else ["USER_ID", "EMAIL"]
+    keys = fetch_arrow_table(keys_query, [*key_columns, "N"], conn=conn, verbose=verbose)
+    if keys is None:
+        print(f"ERROR: failed to fetch keys of {segment_table}")
+        return [None, None]
+    keys = to_string_columns(keys, key_columns)
+    resolved = resolve_user_id_uuids(keys, refs)
+    counts_df = count_resolved_uuids(metadata_table, keys, resolved)
+    if verbose:
+        num_rows = counts_df['total'].iloc[0]
+        seconds = time.perf_counter() - start
+        print(f"resolved {num_rows:,} rows of {segment_table} from {keys.num_rows:,} keys in {seconds:.2f} seconds")
+    return [counts_df, resolved.to_pandas()]
+
+# Local alternative to metadata_tables.create_and_run_metadata_tables.
+# Returns the union of all counts data_frames and a dict of the resolved
+# uuid columns per USER_ID of each metadata_table
+def resolve_metadata_tables_locally(conn: connector=None, verbose: bool=True) -> List[Optional[object]]:
+    refs = IdentityReferenceTables.fetch(conn=conn, verbose=verbose)
+    if refs is None:
+        return [None, {}]
+    union_df = None
+    resolved_dfs = {}
+    [data_file, latest_df] = get_segment_table_dicts_df(load_latest=True)
+    for segment_table_dict in get_segment_table_dicts(latest_df):
+        [counts_df, resolved_df] = resolve_metadata_table_locally(segment_table_dict, refs, conn=conn, verbose=verbose)
+        if counts_df is None:
+            continue
+        resolved_dfs[segment_table_dict['metadata_table']] = resolved_df
+        if union_df is None:
+            union_df = counts_df
+        else:
+            union_df = pd.concat([union_df, counts_df], axis=0)
+    return [union_df, resolved_dfs]
+
+
+################################################
+# Tests
+################################################
+
+def create_test_reference_tables() -> IdentityReferenceTables:
+    ellis_island = pa.table({
+        "UUID": ["u1", "u2", "u3", "u4"],
+        "USERNAME": ["a@x.com", "b@x.com", "c@x.com", "d@x.com"],
+    })
+    persona_ids = pa.array(["u1", "u3", "p9"])
+    watchtime = pa.table({
+        "RID": ["r1", "r2", "r2", "r3"],
+        "WT_USER_ID": ["u2", "u3", "u4", "zz"],
+    })
+    return IdentityReferenceTables(ellis_island, persona_ids, watchtime)
+
+def test_resolve_user_id_uuids():
+    refs = create_test_reference_tables()
+    keys = pa.table({
+        "USER_ID": ["u1", "u1", "p9", "x7", None],
+        "EMAIL": ["a@x.com", "c@x.com", "b@x.com", None, "d@x.com"],
+        "RID": ["r1", None, "r2", "r3", "r1"],
+        "N": [2, 1, 3, 4, 5],
+    })
+    resolved = resolve_user_id_uuids(keys, refs)
+    rows = {x["USER_ID"]: x for x in resolved.to_pylist()}
+    assert sorted(rows) == ["p9", "u1", "x7"], f"ERROR: unexpected user_ids {sorted(rows)}"
+    assert rows["u1"] == {"USER_ID": "u1", "USER_ID_UUID": "u1", "PERSONA_UUID": "u1", "USERNAME_UUID": "u3", "RID_UUID": "u2"}, f"ERROR: unexpected u1 {rows['u1']}"
+    assert rows["p9"] == {"USER_ID": "p9", "USER_ID_UUID": None, "PERSONA_UUID": None, "USERNAME_UUID": "u2", "RID_UUID": "u4"}, f"ERROR: unexpected p9 {rows['p9']}"
+    assert rows["x7"] == {"USER_ID": "x7", "USER_ID_UUID": None, "PERSONA_UUID": None, "USERNAME_UUID": None, "RID_UUID": None}, f"ERROR: unexpected x7 {rows['x7']}"
+
+    counts_df = count_resolved_uuids("T1", keys, resolved)
+    counts = counts_df.iloc[0].to_dict()
+    expected = {'metadata_table': 'T1', 'total': 15, 'USER_ID_UUID': 3, 'USERNAME_UUID': 6, 'PERSONA_UUID': 3, 'RID_UUID': 6}
+    assert counts == expected, f"ERROR: unexpected counts {counts}"
+
+def test_resolve_without_rid():
+    refs = create_test_reference_tables()
+    keys = pa.table({"USER_ID": ["u2"], "EMAIL": ["b@x.com"], "N": [1]})
+    resolved = resolve_user_id_uuids(keys, refs)
+    assert resolved.column_names == ["USER_ID", "USER_ID_UUID", "USERNAME_UUID", "PERSONA_UUID"], f"ERROR: unexpected columns {resolved.column_names}"
+    counts = count_resolved_uuids("T2", keys, resolved).iloc[0].to_dict()
+    assert counts['RID_UUID'] is None and counts['USERNAME_UUID'] == 1, f"ERROR: unexpected counts {counts}"
+
+def test_resolve_null_candidates():
+    refs = create_test_reference_tables()
+    # r3 is watched by zz which is not an ellis_island uuid, the UPDATE can assign it NULL
+    keys = pa.table({"USER_ID": ["u1", "u1"], "EMAIL": ["a@x.com", "z@x.com"], "RID": ["r1", "r3"], "N": [1, 1]})
+    rows = resolve_user_id_uuids(keys, refs).to_pylist()
+    assert rows == [{"USER_ID": "u1", "USER_ID_UUID": "u1", "USERNAME_UUID": None, "PERSONA_UUID": "u1", "RID_UUID": None}], f"ERROR: unexpected rows {rows}"
+
+def test_parity_with_run_query_dicts():
+    from fake_connector import connect_fake
+    from catalog_cache import get_catalog_cache
+    from metadata_tables import MetadataTable
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/identity_resolution_parity_test-{time.time()}.db"
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 2000)
+    get_catalog_cache().invalidate()
+    segment_table_dict = get_benchmark_segment_table_dict()
+    refs = IdentityReferenceTables.fetch(conn=conn, verbose=False)
+    [counts_df, resolved_df] = resolve_metadata_table_locally(segment_table_dict, refs, conn=conn, verbose=False)
+    metadata_table_obj = MetadataTable(segment_table_dict)
+    metadata_table_obj.clone_metadata_table(conn=conn, verbose=False, preview_only=False)
+    metadata_table_obj.add_query_dicts()
+    df = metadata_table_obj.run_query_dicts(conn=conn, verbose=False, preview_only=False)
+    local_counts = {k: int(v) for k, v in counts_df.iloc[0].to_dict().items() if k != 'metadata_table'}
+    update_counts = {k: int(v) for k, v in df.iloc[0].to_dict().items() if k != 'metadata_table'}
+    assert local_counts == update_counts, f"ERROR: local counts {local_counts} not {update_counts}"
+    empty = fetch_arrow_table("SELECT UUID, USERNAME FROM STITCH_LANDING.ELLIS_ISLAND.USER WHERE UUID IS NULL", ["UUID", "USERNAME"], conn=conn)
+    assert empty is not None and empty.num_rows == 0, "ERROR: empty result treated as a failure"
+    assert fetch_arrow_table("SELECT X FROM A.B.MISSING", ["X"], conn=conn) is None, "ERROR: failed query not None"
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
+def tests():
+    test_resolve_user_id_uuids()
+    test_resolve_without_rid()
+    test_resolve_null_candidates()
+    test_parity_with_run_query_dicts()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
 from constants import *   
 from timefunc import timefunc
-from query_generator import create_connector
+from query_generator import create_connector, get_connection_pool, fetch_result_reuse_stats
+from metrics import get_metrics_registry
+from tracing import traced, get_tracer
 from segment_tables import compute_and_save_new_segment_table_dicts_df
-from metadata_tables import create_and_run_metadata_tables
+from metadata_tables import create_and_run_metadata_tables, is_metadata_tables_run_complete
+from progress_journal import ProgressJournal
 from data_frame_utils import save_data_frame, load_data_frame
 
 
 @timefunc
+@traced
 def main():
     
     conn = create_connector()
@@ -15,7 +19,13 @@ def main():
     compute_and_save_new_segment_table_dicts_df(verbose=True)
         
     print("create_and_run_metadata_tables")
-    union_df = create_and_run_metadata_tables(conn=conn, verbose=True, preview_only=True)
+    # completed steps are journaled so a rerun resumes where this one stopped,
+    # the journal is reset once all steps are done so the next run starts over
+    journal = ProgressJournal(PROGRESS_JOURNAL_FILE)
+    union_df = create_and_run_metadata_tables(conn=conn, verbose=True, preview_only=True, journal=journal)
+    if is_metadata_tables_run_complete(journal):
+        journal.reset()
+        print(f"progress journal {PROGRESS_JOURNAL_FILE} reset after a complete run")
 
     if union_df is not None:
         base_name = "union_df"
@@ -27,6 +37,15 @@ def main():
         print(f"loaded_df loaded from {saved_csv_file}:\n", loaded_df)
         print(loaded_df)
 
+    print("connection_pool stats:", get_connection_pool().get_stats())
+    print("result cache repeat stats:", fetch_result_reuse_stats(conn=conn))
+
+    metrics_file = "/tmp/snowflake_connector_metrics.prom"
+    get_metrics_registry().save(metrics_file)
+    print(f"metrics saved to {metrics_file}")
+
 if __name__ == "__main__":
     main()
+    get_tracer().save(TRACE_FILE)
+    print(f"trace saved to {TRACE_FILE}, open it in chrome://tracing or ui.perfetto.dev")
     print("done")
\ No newline at end of file
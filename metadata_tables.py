@@ -1,4 +1,4 @@
-
+import time
 from platform import java_ver
 import snowflake.connector as connector
 from snowflake.connector import ProgrammingError
@@ -10,6 +10,14 @@ from segment_tables import get_segment_table_dicts_df, get_segment_table_dicts
 import pandas as pd
 from data_frame_utils import is_empty_data_frame
 from itertools import combinations
+from catalog_cache import get_catalog_cache
+from tracing import span
+from progress_journal import ProgressJournal, get_query_hash
+from partitioned_update import choose_range_column, run_partitioned_update
+from dag_scheduler import DagScheduler
+from sql_builder import build_count_query, build_information_schema_tables_query
+
+SHOW_METADATA_TABLES_KEY = ("show_tables", "SEGMENT.IDENTIFIES_METADATA", "%IDENTIFIES")
 
 # Given a segment_table_dict with the following example structure:
 # {
@@ -49,24 +57,57 @@ class MetadataTable():
 
     # Return True if the metadata_table was actually cloned
     # otherwise return False if metadata_table already exists
-    # or clone failed.
-    def clone_metadata_table(self, conn: connector=None, verbose: bool=True, preview_only: bool=True) -> bool:
-        if not metadata_table_exists(self.metadata_table, conn=conn, verbose=verbose):
-            return clone_metadata_table(self.segment_table_dict, conn=conn, verbose=verbose, preview_only=preview_only)
-        else:
-            return False       
-    
+    # or clone failed or is done in the journal.
+    # Only an existing or successfully cloned metadata_table is journaled.
+    def clone_metadata_table(self, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None) -> bool:
+        resumable = journal is not None and not preview_only
+        if resumable and journal.is_done(self.metadata_table, None, "clone"):
+            return False
+        exists = metadata_table_exists(self.metadata_table, conn=conn, verbose=verbose)
+        cloned = False
+        if not exists:
+            cloned = clone_metadata_table(self.segment_table_dict, conn=conn, verbose=verbose, preview_only=preview_only)
+        if resumable and (exists or cloned):
+            journal.record(self.metadata_table, None, "clone")
+        return cloned
+
     # Executes a set_uuid_query after adding the new uuid column if needed
     # Returns the updated query_dict with added total and uuid_counts if the query was successfully run
     # otherwise return None
-    def run_query_dict(self, query_dict, conn: connector=None, verbose: bool=True, preview_only: bool=True) -> Optional[Dict[str,Any]]:
+    # With a journal the add column, update and counts steps already done are skipped
+    # and the journaled counts are returned, each step is journaled once it succeeds.
+    # If partitioned is True the update runs over RECEIVED_AT or TIMESTAMP ranges,
+    # see partitioned_update.run_partitioned_update.
+    def run_query_dict(self, query_dict, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None, partitioned: bool=False) -> Optional[Dict[str,Any]]:
         # if not metadata_table_exists(self.metadata_table, conn=conn, verbose=verbose):
         #     return None
+        if not preview_only and self.get_journaled_counts(query_dict, journal) is not None:
+            return query_dict
+        self.add_uuid_column(query_dict, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal)
+        updated = self.update_uuid_column(query_dict, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal, partitioned=partitioned)
+        return self.count_uuid_column(query_dict, updated, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal)
+
+    # Returns query_dict with its journaled counts added, or None if they are not journaled
+    def get_journaled_counts(self, query_dict, journal: Optional[ProgressJournal]=None) -> Optional[Dict[str,Any]]:
+        query_hash = get_query_hash(query_dict['set_uuid_query'])
+        if journal is None or not journal.is_done(self.metadata_table, query_dict['name'], "counts", query_hash):
+            return None
+        counts = journal.get_result(self.metadata_table, query_dict['name'], "counts", query_hash)
+        query_dict['new_uuid_post_total_count'] = counts['total']
+        query_dict['new_uuid_non_null_count'] = counts['non_null']
+        print(f"journaled:{self.identifies_metadata_table} {query_dict['new_uuid']} total:{counts['total']} non-null:{counts['non_null']}")
+        return query_dict
 
-        # add new_uuid column if needed
+    # Adds the new_uuid column of query_dict if needed and returns True if it exists
+    def add_uuid_column(self, query_dict, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None) -> bool:
+        resumable = journal is not None and not preview_only
+        query_name = query_dict['name']
+        if resumable and journal.is_done(self.metadata_table, query_name, "add_column"):
+            return True
         new_uuid = query_dict['new_uuid'].upper()
         existing_columns = get_existing_metadata_table_columns(self.metadata_table, conn=conn, verbose=verbose)
-        if existing_columns is None or new_uuid not in existing_columns:
+        column_added = existing_columns is not None and new_uuid in existing_columns
+        if not column_added:
             add_uuid_column_query = f"\
                 ALTER TABLE {self.identifies_metadata_table} \
                 ADD COLUMN {new_uuid} VARCHAR \
@@ -74,26 +115,67 @@ class MetadataTable():
             if preview_only:
                 print("\nadd_uuid_column_query:\n",clean_query(add_uuid_column_query))
             else:
-                execute_single_query(add_uuid_column_query, conn=conn, verbose=verbose)
-                columns = get_existing_metadata_table_columns(self.metadata_table, conn=conn, verbose=verbose)
-                if columns is not None and len(columns) > 0:
-                    assert new_uuid in columns, f"ERROR: new_uuid:{new_uuid} column not added"
+                exc = execute_single_query(add_uuid_column_query, conn=conn, verbose=verbose, raise_errors=True)
+                column_added = isinstance(exc, StopIteration)
+                if column_added:
+                    # record the new column in the catalog cache instead of describing the table again
+                    add_cached_metadata_table_column(self.metadata_table, new_uuid, "VARCHAR")
+        if resumable and column_added:
+            journal.record(self.metadata_table, query_name, "add_column")
+        return column_added
 
-        # set the new_uuid column value for each row
+    # Sets the new_uuid column value for each row and returns True if the update succeeded
+    def update_uuid_column(self, query_dict, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None, partitioned: bool=False, partition_workers: int=PARTITIONED_UPDATE_MAX_WORKERS) -> bool:
         if preview_only:
             print("\nset_uuid_query:\n", query_dict['set_uuid_query'])
-            return None
-        else:                
-            cloned_table = self.identifies_metadata_table
-            execute_single_query(query_dict['set_uuid_query'], conn=conn, verbose=verbose)
-            query_dict['new_uuid_post_total_count'] = execute_count_query(f"SELECT count(*) from {cloned_table} ", conn=conn, verbose=verbose)
-            query_dict['new_uuid_non_null_count'] = execute_count_query(f"SELECT count(*) from {cloned_table} where {query_dict['new_uuid']} is not NULL", conn=conn, verbose=verbose)
-            
-            print(f"cloned:{cloned_table} {query_dict['new_uuid']} total:{query_dict['new_uuid_post_total_count']} non-null:{query_dict['new_uuid_non_null_count']}")
+            return False
+        query_name = query_dict['name']
+        query_hash = get_query_hash(query_dict['set_uuid_query'])
+        if journal is not None and journal.is_done(self.metadata_table, query_name, "update", query_hash):
+            return True
+        updated = self.run_set_uuid_query(query_dict, conn=conn, verbose=verbose, partitioned=partitioned, partition_workers=partition_workers)
+        if journal is not None and updated:
+            journal.record(self.metadata_table, query_name, "update", query_hash)
+        return updated
 
-            # total and new_uuid counts have been added to this query_dict
+    # Adds the total and new_uuid non-null counts to query_dict and returns it,
+    # or returns None if preview_only or if a count query failed
+    def count_uuid_column(self, query_dict, updated: bool, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None) -> Optional[Dict[str,Any]]:
+        if preview_only:
+            return None
+        if self.get_journaled_counts(query_dict, journal) is not None:
             return query_dict
+        cloned_table = self.identifies_metadata_table
+        try:
+            query_dict['new_uuid_post_total_count'] = execute_count_query(build_count_query(cloned_table)[0], conn=conn, verbose=verbose, raise_errors=True)
+            query_dict['new_uuid_non_null_count'] = execute_count_query(build_count_query(cloned_table, f"{query_dict['new_uuid']} IS NOT NULL")[0], conn=conn, verbose=verbose, raise_errors=True)
+        except ProgrammingError as err:
+            # a failed count is neither journaled nor reported as 0
+            print(f"ERROR: counts of {cloned_table} {query_dict['new_uuid']} failed with {type(err).__name__} {str(err)}")
+            return None
+        
+        print(f"cloned:{cloned_table} {query_dict['new_uuid']} total:{query_dict['new_uuid_post_total_count']} non-null:{query_dict['new_uuid_non_null_count']}")
+
+        # counts of a failed update are not journaled so the update is retried
+        if journal is not None and updated:
+            counts = {'total': query_dict['new_uuid_post_total_count'], 'non_null': query_dict['new_uuid_non_null_count']}
+            journal.record(self.metadata_table, query_dict['name'], "counts", get_query_hash(query_dict['set_uuid_query']), result=counts)
+
+        # total and new_uuid counts have been added to this query_dict
+        return query_dict
     
+    # Runs the set_uuid_query of query_dict and returns True if it succeeded.
+    # If partitioned is True and the table has a range column the update is split
+    # into ranges that run on up to partition_workers threads and are split again
+    # when they time out.
+    def run_set_uuid_query(self, query_dict, conn: connector=None, verbose: bool=True, partitioned: bool=False, partition_workers: int=PARTITIONED_UPDATE_MAX_WORKERS) -> bool:
+        range_column = choose_range_column(self.segment_table_columns) if partitioned else None
+        if range_column is None:
+            exc = execute_single_query(query_dict['set_uuid_query'], conn=conn, verbose=verbose, raise_errors=True)
+            return isinstance(exc, StopIteration)
+        stats = run_partitioned_update(query_dict['set_uuid_query'], self.identifies_metadata_table, range_column, conn=conn, max_workers=partition_workers, verbose=verbose)
+        return stats['num_failed'] == 0
+
     # Returns a dict that packages a set_uuid_query
     def create_query_dict(self, query_name, new_uuid, set_uuid_query):
         query_dict = {}
@@ -168,17 +250,28 @@ class MetadataTable():
             rid_query_dict = self.create_query_dict(query_name, new_uuid, clean_query(set_uuid_query))
             self.query_dicts.append(rid_query_dict)
     
-    def run_query_dicts(self, conn: connector=None, verbose: bool=True, preview_only: bool=True) -> pd.DataFrame:
+    def run_query_dicts(self, conn: connector=None, verbose: bool=True, preview_only: bool=True, journal: Optional[ProgressJournal]=None, partitioned: bool=False) -> pd.DataFrame:
+        results = []
+        for query_dict in self.query_dicts:
+            metadata_table = query_dict['metadata_table']
+            with span("run_query_dict", metadata_table=metadata_table, query_name=query_dict['name']) as query_dict_span:
+                result = self.run_query_dict(query_dict, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal, partitioned=partitioned)
+                if result is not None:
+                    query_dict_span.set(total=result['new_uuid_post_total_count'], non_null=result['new_uuid_non_null_count'])
+            results.append(result)
+        return self.get_uuid_counts_df(results)
+
+    # Returns the one row data_frame of the total and uuid counts of the
+    # run_query_dict results of self.query_dicts, None for a query_dict that did not run
+    def get_uuid_counts_df(self, results: List[Optional[Dict[str,Any]]]) -> pd.DataFrame:
         uuid_counts = {}
         uuid_counts['metadata_table'] = None
         uuid_counts['total'] = None
         for uuid in SEGMENT_UUIDS:
             uuid_counts[uuid] = None
 
-        for query_dict in self.query_dicts:
-            metadata_table = query_dict['metadata_table']
-            uuid_counts['metadata_table'] = metadata_table
-            result = self.run_query_dict(query_dict, conn=conn, verbose=verbose, preview_only=preview_only)
+        for query_dict, result in zip(self.query_dicts, results):
+            uuid_counts['metadata_table'] = query_dict['metadata_table']
             if result is not None:
                 query_dict_with_uuid_counts = result
                 uuid_counts['total'] = query_dict_with_uuid_counts['new_uuid_post_total_count']
@@ -187,52 +280,175 @@ class MetadataTable():
         df = pd.DataFrame.from_dict(data=uuid_counts, orient="index").transpose()
         return df
 
+    # Returns the uuid columns resolved for this metadata_table
+    def get_uuid_columns(self) -> List[str]:
+        uuid_columns = ['USER_ID_UUID','USERNAME_UUID','PERSONA_UUID']
+        if "RID" in self.segment_table_columns:
+            uuid_columns.append('RID_UUID')
+        return uuid_columns
+
+    # Returns a single MERGE statement that resolves all uuid columns at once.
+    # The distinct USER_ID/EMAIL[/RID] keys of the cloned table are read once and
+    # each lookup is pre-aggregated to one uuid per USER_ID, which is what the
+    # separate set_uuid_queries assign to every row sharing that USER_ID.
+    # MAX() makes the choice deterministic where a USER_ID has several matches.
+    def build_fused_merge_query(self) -> str:
+        has_rid = "RID" in self.segment_table_columns
+        key_columns = "user_id, email, rid" if has_rid else "user_id, email"
+        lookups = {
+            'user_id_uuid': f"SELECT k.user_id, MAX(ei.uuid) AS uuid FROM keys k JOIN {self.ellis_island_table} ei ON k.user_id = ei.uuid GROUP BY k.user_id",
+            'username_uuid': f"SELECT k.user_id, MAX(ei.uuid) AS uuid FROM keys k JOIN {self.ellis_island_table} ei ON k.email = ei.username GROUP BY k.user_id",
+            'persona_uuid': f"SELECT k.user_id, MAX(ei.uuid) AS uuid FROM keys k JOIN {self.persona_users_table} pu ON k.user_id = pu.id JOIN {self.ellis_island_table} ei ON pu.id = ei.uuid GROUP BY k.user_id",
+        }
+        if has_rid:
+            lookups['rid_uuid'] = f"SELECT k.user_id, MAX(ei.uuid) AS uuid FROM keys k JOIN {self.watchtime_table} wt ON k.rid = wt.rid JOIN {self.ellis_island_table} ei ON wt.user_id = ei.uuid GROUP BY k.user_id"
+        with_clauses = [f"keys AS (SELECT DISTINCT {key_columns} FROM {self.identifies_metadata_table} WHERE user_id IS NOT NULL)"]
+        with_clauses.extend([f"{uuid}s AS ({lookup_query})" for uuid, lookup_query in lookups.items()])
+        select_columns = ", ".join([f"{uuid}s.uuid AS {uuid}" for uuid in lookups])
+        join_clauses = " ".join([f"LEFT JOIN {uuid}s ON u.user_id = {uuid}s.user_id" for uuid in lookups])
+        set_clauses = ", ".join([f"id1.{uuid} = src.{uuid}" for uuid in lookups])
+        fused_merge_query = f"\
+            MERGE INTO {self.identifies_metadata_table} id1 \
+            USING ( \
+                WITH {', '.join(with_clauses)} \
+                SELECT u.user_id, {select_columns} \
+                FROM (SELECT DISTINCT user_id FROM keys) u {join_clauses} \
+            ) src \
+            ON id1.user_id = src.user_id \
+            WHEN MATCHED THEN UPDATE SET {set_clauses}"
+        return clean_query(fused_merge_query)
+
+    # Returns a query that counts the total rows and the non-null values
+    # of every uuid column of the cloned table in a single scan
+    def build_fused_counts_query(self) -> str:
+        count_columns = ", ".join([f"COUNT({uuid}) AS {uuid}" for uuid in self.get_uuid_columns()])
+        return f"SELECT COUNT(*) AS TOTAL, {count_columns} FROM {self.identifies_metadata_table}"
+
+    # Fused alternative to add_query_dicts + run_query_dicts that
+    # 1. adds all missing uuid columns with one ALTER TABLE
+    # 2. resolves all uuid columns with one MERGE (see build_fused_merge_query)
+    # 3. collects the total and all non-null uuid counts with one count query
+    # Returns a data_frame with the same columns as run_query_dicts, its counts
+    # stay None if the ALTER TABLE or the MERGE failed
+    def run_fused_query(self, conn: connector=None, verbose: bool=True, preview_only: bool=True) -> pd.DataFrame:
+        uuid_counts = {}
+        uuid_counts['metadata_table'] = self.metadata_table
+        uuid_counts['total'] = None
+        for uuid in SEGMENT_UUIDS:
+            uuid_counts[uuid] = None
+
+        uuid_columns = self.get_uuid_columns()
+        existing_columns = get_existing_metadata_table_columns(self.metadata_table, conn=conn, verbose=verbose)
+        new_columns = [x for x in uuid_columns if existing_columns is None or x not in existing_columns]
+        if len(new_columns) > 0:
+            add_columns_str = ", ".join([f"{x} VARCHAR DEFAULT NULL" for x in new_columns])
+            add_uuid_columns_query = f"ALTER TABLE {self.identifies_metadata_table} ADD COLUMN {add_columns_str}"
+            if preview_only:
+                print("\nadd_uuid_columns_query:\n", add_uuid_columns_query)
+            else:
+                exc = execute_single_query(add_uuid_columns_query, conn=conn, verbose=verbose, raise_errors=True)
+                if not isinstance(exc, StopIteration):
+                    print(f"ERROR: adding uuid columns to {self.identifies_metadata_table} failed with {type(exc).__name__} {str(exc)}")
+                    # some columns may have been added, so describe the table again next time
+                    get_catalog_cache().invalidate(("describe", self.metadata_table))
+                    return pd.DataFrame.from_dict(data=uuid_counts, orient="index").transpose()
+                # record the new columns in the catalog cache instead of describing the table again
+                for new_column in new_columns:
+                    add_cached_metadata_table_column(self.metadata_table, new_column, "VARCHAR")
+
+        fused_merge_query = self.build_fused_merge_query()
+        fused_counts_query = self.build_fused_counts_query()
+        if preview_only:
+            print("\nfused_merge_query:\n", fused_merge_query)
+            print("\nfused_counts_query:\n", fused_counts_query)
+        else:
+            exc = execute_single_query(fused_merge_query, conn=conn, verbose=verbose, raise_errors=True)
+            if not isinstance(exc, StopIteration):
+                print(f"ERROR: fused merge into {self.identifies_metadata_table} failed with {type(exc).__name__} {str(exc)}")
+                return pd.DataFrame.from_dict(data=uuid_counts, orient="index").transpose()
+            results = execute_simple_query(fused_counts_query, conn=conn, verbose=verbose)
+            if len(results) > 0:
+                uuid_counts['total'] = results[0][0]
+                for uuid, count in zip(uuid_columns, results[0][1:]):
+                    uuid_counts[uuid] = count
+                counts_str = " ".join([f"{x}:{uuid_counts[x]}" for x in uuid_columns])
+                print(f"cloned:{self.identifies_metadata_table} total:{uuid_counts['total']} non-null {counts_str}")
+        df = pd.DataFrame.from_dict(data=uuid_counts, orient="index").transpose()
+        return df
+
     
 # Returns a list of metadata_tables that end with IDENTIFIES 
 # and already exist in SEGMENT.IDENTIFIES_METADATA
-def find_existing_metadata_tables(conn: connector=None, verbose:bool=True) -> List[str]:
-    existing_metadata_tables = []
-    show_tables_columns = ['created_on','name','database_name','schema_name,kind','comment','cluster_by,rows','bytes','owner','retention_time','automatic_clustering','change_tracking','search_optimization','search_optimization_progress','search_optimization_bytes','is_external']
-    show_tables_query = "show tables like '%IDENTIFIES' in SEGMENT.IDENTIFIES_METADATA"
-    results = execute_simple_query(show_tables_query, conn=conn)
-    for line in results:
-        line_dict = dict(zip(show_tables_columns, line))
-        existing_metadata_tables.append(f"{line_dict['name']}")
-    return existing_metadata_tables
+# The list is served from the catalog cache unless use_cache is False
+def find_existing_metadata_tables(conn: connector=None, verbose:bool=True, use_cache: bool=True) -> List[str]:
+    def show_metadata_tables() -> List[str]:
+        existing_metadata_tables = []
+        show_tables_columns = ['created_on','name','database_name','schema_name,kind','comment','cluster_by,rows','bytes','owner','retention_time','automatic_clustering','change_tracking','search_optimization','search_optimization_progress','search_optimization_bytes','is_external']
+        show_tables_query = "show tables like '%IDENTIFIES' in SEGMENT.IDENTIFIES_METADATA"
+        results = execute_simple_query(show_tables_query, conn=conn)
+        for line in results:
+            line_dict = dict(zip(show_tables_columns, line))
+            existing_metadata_tables.append(f"{line_dict['name']}")
+        return existing_metadata_tables
+
+    if not use_cache:
+        existing_metadata_tables = show_metadata_tables()
+        get_catalog_cache().put(SHOW_METADATA_TABLES_KEY, existing_metadata_tables)
+        return list(existing_metadata_tables)
+    return list(get_catalog_cache().get(SHOW_METADATA_TABLES_KEY, show_metadata_tables))
 
 # Returns True if metadata_table exists under SEGMENT.IDENTIFIES_METADATA
-def metadata_table_exists(metadata_table: str, conn: connector=None, verbose:bool=True):
-    existing_metadata_tables = find_existing_metadata_tables(conn=conn, verbose=verbose)
+def metadata_table_exists(metadata_table: str, conn: connector=None, verbose:bool=True, use_cache: bool=True):
+    existing_metadata_tables = find_existing_metadata_tables(conn=conn, verbose=verbose, use_cache=use_cache)
     return True if metadata_table in existing_metadata_tables else False
 
 # Returns a list of dict lines describing the given metadata_table in snowflake
+# The lines are served from the catalog cache unless use_cache is False
 TABLE_DESCRIBE_COLUMNS = ['name','type','kind','null?','default','primary key','unique key','check','expression','comment','policy name']
-def describe_metadata_table(metadata_table: str, conn: connector=None, verbose: bool=True) -> Dict[str,str]:
-    table_info_dicts = None
-    metadata_table_path = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
-    describe_table_query = f"DESCRIBE TABLE {metadata_table_path}"
-    try:
-        results = execute_simple_query(describe_table_query, conn=conn)
-        for line in results:
-            line_dict = dict(zip(TABLE_DESCRIBE_COLUMNS, line))
-            table_info_dicts = [] if table_info_dicts is None else table_info_dicts 
-            table_info_dicts.append(line_dict)
+def describe_metadata_table(metadata_table: str, conn: connector=None, verbose: bool=True, use_cache: bool=True) -> Dict[str,str]:
+    def describe_table() -> Optional[List[Dict[str,str]]]:
+        table_info_dicts = None
+        metadata_table_path = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
+        describe_table_query = f"DESCRIBE TABLE {metadata_table_path}"
+        try:
+            results = execute_simple_query(describe_table_query, conn=conn)
+            for line in results:
+                line_dict = dict(zip(TABLE_DESCRIBE_COLUMNS, line))
+                table_info_dicts = [] if table_info_dicts is None else table_info_dicts 
+                table_info_dicts.append(line_dict)
+            return table_info_dicts
+        except ProgrammingError as err:
+            print(f"{type(err)} str(err)")
         return table_info_dicts
-    except ProgrammingError as err:
-        print(f"{type(err)} str(err)")
-    return table_info_dicts
+
+    describe_key = ("describe", metadata_table)
+    if not use_cache:
+        get_catalog_cache().invalidate(describe_key)
+    table_info_dicts = get_catalog_cache().get(describe_key, describe_table)
+    return None if table_info_dicts is None else list(table_info_dicts)
 
 # Returns a list of metadata_table columns derived from DESCRIBE TABLE or None if metadata_table not found
-def get_existing_metadata_table_columns(metadata_table: str, conn: connector=None, verbose: bool=True) -> Optional[List[str]]:
-    table_info_dicts = describe_metadata_table(metadata_table, conn=conn, verbose=verbose)
+def get_existing_metadata_table_columns(metadata_table: str, conn: connector=None, verbose: bool=True, use_cache: bool=True) -> Optional[List[str]]:
+    table_info_dicts = describe_metadata_table(metadata_table, conn=conn, verbose=verbose, use_cache=use_cache)
     if table_info_dicts is not None:
         return [table_info_dict['name'] for table_info_dict in table_info_dicts]
     else:
         return None
 
+# Records a metadata_table created or cloned by us in the cached SHOW TABLES result
+def add_cached_metadata_table(metadata_table: str) -> None:
+    get_catalog_cache().update(SHOW_METADATA_TABLES_KEY, lambda tables: tables if metadata_table in tables else [*tables, metadata_table])
+
+# Records a column added by us in the cached DESCRIBE TABLE result of metadata_table
+def add_cached_metadata_table_column(metadata_table: str, column: str, datatype: str) -> None:
+    column_dict = dict(zip(TABLE_DESCRIBE_COLUMNS, [column, datatype, 'COLUMN', 'Y', None, 'N', 'N', None, None, None, None]))
+    get_catalog_cache().update(("describe", metadata_table), lambda dicts: dicts if column in [x['name'] for x in dicts] else [*dicts, column_dict])
+
 # Returns True if metadata_table under SEGMENT.IDENTIFIES_METADATA 
 # has been cloned from segment_table under SEGMENT
 # Otherwise returns False if metadata_table already exists or clone instruction failed.
+# Only a clone with the row count of segment_table is recorded in the catalog cache,
+# after a failed clone the cached SHOW TABLES result is dropped so the next check asks snowflake.
 def clone_metadata_table(segment_table_dict: Dict[str,str], verbose: bool=True, conn: connector=None, preview_only: bool=True) -> bool:
     segment_table = segment_table_dict['segment_table']
     metadata_table = segment_table_dict['metadata_table']
@@ -243,29 +459,45 @@ def clone_metadata_table(segment_table_dict: Dict[str,str], verbose: bool=True,
             print("\nclone_metadata_table_query:\n", clean_query(clone_metadata_table_query))
         if not preview_only:
             try:
-                source_count = execute_count_query(f"select count(*) from {segment_table}", conn=conn, verbose=verbose)
+                source_count = execute_count_query(build_count_query(segment_table)[0], conn=conn, verbose=verbose, raise_errors=True)
                 if verbose:
                     print(f"source_count:{source_count}")
-                execute_single_query(clone_metadata_table_query, conn=conn, verbose=verbose)
-                cloned_count = execute_count_query(f"select count(*) from {cloned_table}")
+                result = execute_single_query(clone_metadata_table_query, conn=conn, verbose=verbose, raise_errors=True)
+                if not isinstance(result, StopIteration):
+                    print(f"ERROR: clone of {cloned_table} failed with {type(result).__name__} {str(result)}")
+                    get_catalog_cache().invalidate(SHOW_METADATA_TABLES_KEY)
+                    return False
+                cloned_count = execute_count_query(build_count_query(cloned_table)[0], conn=conn, verbose=verbose, raise_errors=True)
                 if verbose:
                     print(f"cloned_count:{cloned_count}")
                 if cloned_count != source_count:
                      print(f"ERROR: expected cloned_count:{source_count} not:{cloned_count} for {cloned_table}")
+                     get_catalog_cache().invalidate(SHOW_METADATA_TABLES_KEY)
                      return False
-                else:
-                    return True
+                # record the clone in the catalog cache instead of showing tables again
+                add_cached_metadata_table(metadata_table)
+                return True
             except ProgrammingError as err:
-                print(f"{type(err)} str(err)")
+                print(f"{type(err)} {str(err)}")
+                get_catalog_cache().invalidate(SHOW_METADATA_TABLES_KEY)
     return False    
 
 # create and run a single MetadataTable object
-def create_and_run_metadata_table(segment_table_dict: Dict[str,str], verbose: bool=True, preview_only: bool=True, conn: connector=None) -> pd.DataFrame:
-    metadata_table_obj = MetadataTable(segment_table_dict)
-    metadata_table_obj.clone_metadata_table(conn=conn, verbose=verbose, preview_only=preview_only)
-    metadata_table_obj.add_query_dicts()
-    df = metadata_table_obj.run_query_dicts(conn=conn, verbose=verbose, preview_only=preview_only)
-    return df
+# If fused is True all uuid columns are resolved with a single MERGE statement
+# If a journal is given completed steps are skipped, see create_and_run_metadata_tables
+# If partitioned is True each set_uuid_query runs over ranges of RECEIVED_AT or TIMESTAMP
+def create_and_run_metadata_table(segment_table_dict: Dict[str,str], verbose: bool=True, preview_only: bool=True, conn: connector=None, fused: bool=False, journal: Optional[ProgressJournal]=None, partitioned: bool=False) -> pd.DataFrame:
+    with span("create_and_run_metadata_table", metadata_table=segment_table_dict['metadata_table'], fused=fused) as table_span:
+        metadata_table_obj = MetadataTable(segment_table_dict)
+        with span("clone_metadata_table", metadata_table=segment_table_dict['metadata_table']):
+            metadata_table_obj.clone_metadata_table(conn=conn, verbose=verbose, preview_only=preview_only, journal=journal)
+        if fused:
+            df = metadata_table_obj.run_fused_query(conn=conn, verbose=verbose, preview_only=preview_only)
+        else:
+            metadata_table_obj.add_query_dicts()
+            df = metadata_table_obj.run_query_dicts(conn=conn, verbose=verbose, preview_only=preview_only, journal=journal, partitioned=partitioned)
+        table_span.set(total=df['total'].iloc[0] if len(df) > 0 else None)
+        return df
 
 def get_segment_table_dict(segment_table: str) -> Optional[Dict[str,str]]:
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
@@ -274,27 +506,207 @@ def get_segment_table_dict(segment_table: str) -> Optional[Dict[str,str]]:
             return segment_table_dict
     return None
     
+# Returns the estimated ROW_COUNT of each DATABASE.SCHEMA.TABLE in segment_tables
+# found in its database's INFORMATION_SCHEMA.TABLES
+def fetch_segment_table_row_counts(segment_tables: List[str], conn: connector=None, verbose: bool=False) -> Dict[str,int]:
+    schema_tables_by_database = {}
+    for segment_table in segment_tables:
+        database, schema, table = segment_table.upper().split(".")
+        schema_tables_by_database.setdefault(database, []).append(f"{schema}.{table}")
+    row_counts = {}
+    for database, schema_tables in schema_tables_by_database.items():
+        [query, params] = build_information_schema_tables_query(f"{database}.INFORMATION_SCHEMA", ["TABLE_SCHEMA", "TABLE_NAME", "ROW_COUNT"], schema_tables)
+        for result_row in execute_simple_query(query, conn=conn, verbose=verbose, params=params):
+            row_counts[f"{database}.{result_row[0]}.{result_row[1]}"] = result_row[2] or 0
+    return row_counts
+
+# Returns a DagScheduler of the steps of all segment_table_dicts and their MetadataTable objects.
+# Each table is a chain of nodes: clone, then per query_dict add column, update and
+# counts, where the add columns and the updates of one table run in order since
+# they change the same table, while its counts and all other tables run concurrently.
+# Node costs are the row_counts estimates of the segment tables, so the largest
+# tables start first. If fused is True the query_dicts are one fused node.
+# Partitioned updates run their ranges one at a time inside a node, so max_workers
+# also caps the number of queries in flight.
+def build_metadata_tables_dag(segment_table_dicts: List[Dict[str,str]], row_counts: Dict[str,int], conn: connector=None, verbose: bool=True, preview_only: bool=True, fused: bool=False, journal: Optional[ProgressJournal]=None, partitioned: bool=False, max_workers: int=DAG_MAX_WORKERS) -> Tuple[DagScheduler, List[MetadataTable]]:
+    dag = DagScheduler(max_workers=max_workers)
+    metadata_table_objs = []
+    for segment_table_dict in segment_table_dicts:
+        metadata_table_obj = MetadataTable(segment_table_dict)
+        metadata_table_objs.append(metadata_table_obj)
+        table = metadata_table_obj.metadata_table
+        num_rows = row_counts.get(segment_table_dict['segment_table'].upper(), 0)
+        clone_node = dag.add(f"{table}:clone", lambda results, obj=metadata_table_obj: obj.clone_metadata_table(conn=conn, verbose=verbose, preview_only=preview_only, journal=journal), cost=num_rows * 0.1)
+        if fused:
+            dag.add(f"{table}:fused", lambda results, obj=metadata_table_obj: obj.run_fused_query(conn=conn, verbose=verbose, preview_only=preview_only), deps=[clone_node.name], cost=num_rows)
+            continue
+        metadata_table_obj.add_query_dicts()
+        add_column_node = clone_node
+        update_node = None
+        for query_dict in metadata_table_obj.query_dicts:
+            name = f"{table}:{query_dict['name']}"
+            add_column_node = dag.add(f"{name}:add_column",
+                lambda results, obj=metadata_table_obj, qd=query_dict: obj.add_uuid_column(qd, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal),
+                deps=list(set([clone_node.name, add_column_node.name])), cost=1)
+            update_deps = [add_column_node.name] if update_node is None else [add_column_node.name, update_node.name]
+            update_node = dag.add(f"{name}:update",
+                lambda results, obj=metadata_table_obj, qd=query_dict: obj.update_uuid_column(qd, conn=conn, verbose=verbose, preview_only=preview_only, journal=journal, partitioned=partitioned, partition_workers=1),
+                deps=update_deps, cost=num_rows)
+            dag.add(f"{name}:counts",
+                lambda results, obj=metadata_table_obj, qd=query_dict, update_name=update_node.name: obj.count_uuid_column(qd, results[update_name], conn=conn, verbose=verbose, preview_only=preview_only, journal=journal),
+                deps=[update_node.name], cost=num_rows * 0.1)
+    return [dag, metadata_table_objs]
+
+# Runs all MetadataTable objects as a DAG of their steps on up to max_workers
+# threads and returns the same union_df as the sequential create_and_run_metadata_tables.
+# If conn is None each query of a node borrows its own connection from
+# get_connection_pool(), so up to max_workers connections are in use at once.
+# A passed conn is shared by all worker threads, each query on its own cursor.
+# Pass row_counts of the segment tables to skip fetching them from INFORMATION_SCHEMA.
+def run_metadata_tables_dag(segment_table_dicts: List[Dict[str,str]], conn: connector=None, verbose: bool=True, preview_only: bool=True, fused: bool=False, journal: Optional[ProgressJournal]=None, partitioned: bool=False, max_workers: int=DAG_MAX_WORKERS, row_counts: Optional[Dict[str,int]]=None) -> Optional[pd.DataFrame]:
+    if row_counts is None:
+        row_counts = fetch_segment_table_row_counts([x['segment_table'] for x in segment_table_dicts], conn=conn, verbose=verbose)
+    [dag, metadata_table_objs] = build_metadata_tables_dag(segment_table_dicts, row_counts, conn=conn, verbose=verbose, preview_only=preview_only, fused=fused, journal=journal, partitioned=partitioned, max_workers=max_workers)
+    results = dag.run(verbose=verbose)
+    if verbose:
+        print("dag_scheduler stats:", dag.get_stats())
+    dfs = []
+    for metadata_table_obj in metadata_table_objs:
+        table = metadata_table_obj.metadata_table
+        if fused:
+            df = results.get(f"{table}:fused")
+        else:
+            df = metadata_table_obj.get_uuid_counts_df([results.get(f"{table}:{x['name']}:counts") for x in metadata_table_obj.query_dicts])
+        if df is not None and len(df) > 0:
+            dfs.append(df)
+    return pd.concat(dfs, axis=0) if len(dfs) > 0 else None
+
 # create and run all MetadataTable objects
-def create_and_run_metadata_tables(conn: connector=None, verbose: bool=True, preview_only: bool=True) -> pd.DataFrame:
+# Pass a journal (e.g. ProgressJournal(PROGRESS_JOURNAL_FILE)) to make the run resumable:
+# the clone, add column, update and counts steps of each table and query_dict are
+# journaled as they complete, and a rerun after a crash or timeout skips them and
+# rebuilds their rows of union_df from the journaled counts. Only the clone step
+# is journaled if fused is True. Call journal.reset() to start over, e.g. once
+# is_metadata_tables_run_complete(journal) is True.
+# Pass partitioned=True for tables whose set_uuid_queries exceed the timeout.
+# If scheduled is True independent steps of all tables run concurrently, largest
+# tables first, see run_metadata_tables_dag.
+def create_and_run_metadata_tables(conn: connector=None, verbose: bool=True, preview_only: bool=True, fused: bool=False, journal: Optional[ProgressJournal]=None, partitioned: bool=False, scheduled: bool=False, max_workers: int=DAG_MAX_WORKERS) -> pd.DataFrame:
     union_df = None
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
+    if scheduled:
+        union_df = run_metadata_tables_dag(get_segment_table_dicts(latest_df), conn=conn, verbose=verbose, preview_only=preview_only, fused=fused, journal=journal, partitioned=partitioned, max_workers=max_workers)
+        if verbose and journal is not None:
+            print("progress_journal stats:", journal.get_stats())
+        return union_df
     for segment_table_dict in get_segment_table_dicts(latest_df):
-        df = create_and_run_metadata_table(segment_table_dict, verbose=verbose, preview_only=preview_only, conn=conn)
+        df = create_and_run_metadata_table(segment_table_dict, verbose=verbose, preview_only=preview_only, conn=conn, fused=fused, journal=journal, partitioned=partitioned)
         if len(df) > 0:
             if union_df is None:
                 union_df = df
             else:
                 union_df = pd.concat([union_df, df], axis=0)
+    if verbose and journal is not None:
+        print("progress_journal stats:", journal.get_stats())
     return union_df
 
-def summarize_metadata_tables(conn: connector=None, verbose: bool=True):
+# Returns True if journal has every step of a completed create_and_run_metadata_tables
+# run of segment_table_dicts (all of the latest ones if None): the counts of each
+# query_dict for its current set_uuid_query, or only the clone of each table if fused.
+# Callers reset the journal after a complete run so the next run starts over
+# instead of skipping every step and reporting the journaled counts.
+def is_metadata_tables_run_complete(journal: ProgressJournal, segment_table_dicts: Optional[List[Dict[str,str]]]=None, fused: bool=False) -> bool:
+    if segment_table_dicts is None:
+        [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
+        segment_table_dicts = get_segment_table_dicts(latest_df)
+    for segment_table_dict in segment_table_dicts:
+        metadata_table_obj = MetadataTable(segment_table_dict)
+        if fused:
+            if journal.get_entry(metadata_table_obj.metadata_table, None, "clone") is None:
+                return False
+            continue
+        metadata_table_obj.add_query_dicts()
+        for query_dict in metadata_table_obj.query_dicts:
+            if journal.get_entry(metadata_table_obj.metadata_table, query_dict['name'], "counts", get_query_hash(query_dict['set_uuid_query'])) is None:
+                return False
+    return True
+
+BATCHED_SUMMARY_COLUMNS = ['metadata_table','total_count','all_4_equal_count','valid_uuid_count','null_valid_uuid_count','status']
+ALL_4_EQUAL_COLUMNS = ['USER_ID','USER_ID_UUID','USERNAME_UUID','PERSONA_UUID']
+
+# Returns the per-table summary select of cloned_table used in the batched UNION ALL.
+# Counts over columns that metadata_table_columns does not have are NULL.
+def build_summary_select(metadata_table: str, metadata_table_columns: List[str]) -> str:
+    cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
+    columns = [] if metadata_table_columns is None else metadata_table_columns
+    if all([x in columns for x in ALL_4_EQUAL_COLUMNS]):
+        all_4_equal_count = "COUNT_IF(user_id = user_id_uuid and user_id_uuid = username_uuid and username_uuid = persona_uuid)"
+    else:
+        all_4_equal_count = "NULL"
+    if "VALID_UUID" in columns:
+        valid_uuid_count = "COUNT_IF(VALID_UUID IS NOT NULL)"
+        null_valid_uuid_count = "COUNT_IF(VALID_UUID IS NULL)"
+    else:
+        valid_uuid_count = "NULL"
+        null_valid_uuid_count = "NULL"
+    return f"SELECT '{metadata_table}' AS METADATA_TABLE, COUNT(*) AS TOTAL_COUNT, {all_4_equal_count} AS ALL_4_EQUAL_COUNT, {valid_uuid_count} AS VALID_UUID_COUNT, {null_valid_uuid_count} AS NULL_VALID_UUID_COUNT FROM {cloned_table}"
+
+# Returns a data_frame with BATCHED_SUMMARY_COLUMNS for all cloned metadata_tables,
+# computed with a single UNION ALL statement of per-table COUNT_IF selects.
+# Missing tables are left out of the statement with status 'missing'. If the
+# batched statement fails, each table is counted on its own so that one bad
+# table only marks its own row with status 'failed'.
+def summarize_metadata_tables_batched(conn: connector=None, verbose: bool=True) -> pd.DataFrame:
+    [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
+    existing_metadata_tables = find_existing_metadata_tables(conn=conn, verbose=verbose)
+    summary_rows = {}
+    summary_selects = {}
+    for segment_table_dict in get_segment_table_dicts(latest_df):
+        metadata_table = segment_table_dict['metadata_table']
+        if metadata_table not in existing_metadata_tables:
+            summary_rows[metadata_table] = [metadata_table, None, None, None, None, 'missing']
+            continue
+        metadata_table_columns = get_existing_metadata_table_columns(metadata_table, conn=conn, verbose=verbose)
+        summary_selects[metadata_table] = build_summary_select(metadata_table, metadata_table_columns)
+
+    def add_summary_rows(results: List[Tuple]) -> None:
+        for result in results:
+            summary_rows[result[0]] = [*result[0:5], 'ok']
+
+    if len(summary_selects) > 0:
+        union_query = " UNION ALL ".join(summary_selects.values())
+        if verbose:
+            print(f"summarize_metadata_tables_batched.union_query:\n{union_query};")
+        add_summary_rows(execute_simple_query(union_query, conn=conn))
+        for metadata_table, summary_select in summary_selects.items():
+            if metadata_table not in summary_rows:
+                add_summary_rows(execute_simple_query(summary_select, conn=conn))
+            if metadata_table not in summary_rows:
+                summary_rows[metadata_table] = [metadata_table, None, None, None, None, 'failed']
+
+    return pd.DataFrame(data=list(summary_rows.values()), columns=BATCHED_SUMMARY_COLUMNS)
+
+# If batched is True all tables are counted in one round trip by summarize_metadata_tables_batched
+def summarize_metadata_tables(conn: connector=None, verbose: bool=True, batched: bool=False):
+    if batched:
+        summary_df = summarize_metadata_tables_batched(conn=conn, verbose=verbose)
+        for summary_row in summary_df.to_dict(orient="records"):
+            metadata_table = summary_row['metadata_table']
+            ok = summary_row['status'] == 'ok'
+            total_count = int(summary_row['total_count']) if ok else 0
+            all_4_equal_count = int(summary_row['all_4_equal_count']) if ok and pd.notna(summary_row['all_4_equal_count']) else 0
+            all_4_equal_percent = all_4_equal_count * 100 / total_count if total_count > 0 else 0.0
+            failed = "" if ok else "FAILED "
+            print(f"{all_4_equal_percent:5.2f}% {metadata_table} {failed}total_count:{total_count} all_4_equal_count:{all_4_equal_count}")
+        return
+
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
     for segment_table_dict in get_segment_table_dicts(latest_df):
         metadata_table = segment_table_dict['metadata_table']
         cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
         try:
-            total_count = execute_count_query(f"SELECT count(*) from {cloned_table}", conn=conn)
-            all_4_equal_count = execute_count_query(f"SELECT count(*) from {cloned_table} where user_id = user_id_uuid and user_id_uuid = username_uuid and username_uuid = persona_uuid", conn=conn)
+            total_count = execute_count_query(build_count_query(cloned_table)[0], conn=conn)
+            all_4_equal_count = execute_count_query(build_count_query(cloned_table, "user_id = user_id_uuid and user_id_uuid = username_uuid and username_uuid = persona_uuid")[0], conn=conn)
             all_4_equal_percent = all_4_equal_count * 100 / total_count if total_count > 0 else 0.0
             print(f"{all_4_equal_percent:5.2f}% {metadata_table} total_count:{total_count} all_4_equal_count:{all_4_equal_count}")
         except Exception as e:
@@ -303,21 +715,62 @@ def summarize_metadata_tables(conn: connector=None, verbose: bool=True):
             all_4_equal_percent = all_4_equal_count * 100 / total_count if total_count > 0 else 0.0
             print(f"{all_4_equal_percent:5.2f}% {metadata_table} FAILED total_count:{total_count} all_4_equal_count:{all_4_equal_count}")            
 
+# Returns a query that groups the rows of cloned_table by their null/equality
+# pattern across uuid_columns. For each uuid_column i the signature column Si is
+#   -1 if the column is null
+#    j the index of the first uuid_column with an equal value (j <= i)
+# so that two columns have the same label exactly when they are non-null and equal.
+def build_equality_signature_query(cloned_table: str, uuid_columns: List[str]) -> str:
+    signature_columns = []
+    for i, uuid_column in enumerate(uuid_columns):
+        when_clauses = [f"WHEN {uuid_column} IS NULL THEN -1"]
+        when_clauses.extend([f"WHEN {uuid_columns[j]} = {uuid_column} THEN {j}" for j in range(i)])
+        signature_columns.append(f"CASE {' '.join(when_clauses)} ELSE {i} END AS S{i}")
+    group_by_clause = ", ".join([f"S{i}" for i in range(len(uuid_columns))])
+    return f"SELECT {', '.join(signature_columns)}, COUNT(*) AS N FROM {cloned_table} GROUP BY {group_by_clause}"
+
+# Returns a list indexed by column bitmask where entry mask is the number of rows
+# in which all columns of mask are non-null and equal, given the (S0..SN-1, N) rows
+# of build_equality_signature_query over num_columns uuid_columns.
+#
+# Each signature adds its count to the exact mask of each of its equality classes,
+# then a superset-sum transform adds every mask's count to all of its subsets.
+# A row contributes once to each mask that fits inside one of its (disjoint) classes.
+def compute_combo_counts_from_signatures(signature_rows: List[Tuple], num_columns: int) -> List[int]:
+    combo_counts = [0] * (1 << num_columns)
+    for signature_row in signature_rows:
+        labels, count = signature_row[:num_columns], signature_row[num_columns]
+        class_masks = {}
+        for i, label in enumerate(labels):
+            if label is not None and int(label) >= 0:
+                class_masks[int(label)] = class_masks.get(int(label), 0) | (1 << i)
+        for class_mask in class_masks.values():
+            combo_counts[class_mask] += int(count)
+    for i in range(num_columns):
+        for mask in range(1 << num_columns):
+            if not mask & (1 << i):
+                combo_counts[mask] += combo_counts[mask | (1 << i)]
+    return combo_counts
+
 # execute (or if preview_only just print) all combo_queries for the given metadata_table and its columns
-def summarize_metadata_table_combos(metadata_table: str, metadata_table_columns: List[str], preview_only: bool=False, conn: connector=None) -> List[str]:
+# If single_scan is True all counts are derived from one equality signature query
+# instead of one count query per uuid_column and per combination of uuid_columns.
+def summarize_metadata_table_combos(metadata_table: str, metadata_table_columns: List[str], preview_only: bool=False, conn: connector=None, single_scan: bool=True) -> List[str]:
+    if single_scan:
+        return summarize_metadata_table_combos_single_scan(metadata_table, metadata_table_columns, preview_only=preview_only, conn=conn)
     cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
     keep_columns = []
     combo_queries = []
     for uuid_column in SEGMENT_UUIDS:
         if metadata_table_columns is not None and len(metadata_table_columns) > 0 and uuid_column.upper() in metadata_table_columns:
-            query = f"SELECT count(*) from {cloned_table} where {uuid_column} is not null"
+            query = build_count_query(cloned_table, f"{uuid_column} is not null")[0]
             if preview_only:
                 keep_columns.append(uuid_column)
                 combo_queries.append({"count_query":query})
             else:
                 count = 0
                 try:
-                    count = execute_count_query(f"SELECT count(*) from {cloned_table} where {uuid_column} is not null", conn=conn) 
+                    count = execute_count_query(query, conn=conn)
                     if count > 0:
                         keep_columns.append(uuid_column)
                 except Exception as e:
@@ -334,7 +787,7 @@ def summarize_metadata_table_combos(metadata_table: str, metadata_table_columns:
             combo_str = metadata_table + "@" + "-".join([f"{x}" for x in combo])
             all_equals_clause = " and ".join([f"{combo[0]} = {x}" for x in combo[1:]])
             not_null_clause = " and ".join([f"{x} is not null" for x in combo])
-            query = f"SELECT count(*) from {cloned_table} where {all_equals_clause} and {not_null_clause}"
+            query = build_count_query(cloned_table, f"{all_equals_clause} and {not_null_clause}")[0]
             if preview_only:
                 combo_queries.append({combo_str: query})
             else:
@@ -347,6 +800,31 @@ def summarize_metadata_table_combos(metadata_table: str, metadata_table_columns:
                     combo_queries.append({combo_str:query})
     return combo_queries
 
+# Same result as summarize_metadata_table_combos but with a single scan of metadata_table
+def summarize_metadata_table_combos_single_scan(metadata_table: str, metadata_table_columns: List[str], preview_only: bool=False, conn: connector=None) -> List[str]:
+    cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
+    combo_queries = []
+    if metadata_table_columns is None or len(metadata_table_columns) == 0:
+        return combo_queries
+    uuid_columns = [x for x in SEGMENT_UUIDS if x.upper() in metadata_table_columns]
+    if len(uuid_columns) == 0:
+        return combo_queries
+    query = build_equality_signature_query(cloned_table, uuid_columns)
+    if preview_only:
+        combo_queries.append({"signature_query": query})
+        return combo_queries
+
+    signature_rows = execute_simple_query(query, conn=conn)
+    combo_counts = compute_combo_counts_from_signatures(signature_rows, len(uuid_columns))
+    keep_columns = [x for i, x in enumerate(uuid_columns) if combo_counts[1 << i] > 0]
+    N = len(keep_columns)
+    for k in range(2, N+1):
+        for combo in combinations(keep_columns, k):
+            combo_str = metadata_table + "@" + "-".join([f"{x}" for x in combo])
+            combo_mask = sum([1 << uuid_columns.index(x) for x in combo])
+            combo_queries.append({combo_str: f"{combo_counts[combo_mask]:,}"})
+    return combo_queries
+
 # print all queries for metadata_tables that cannot be 
 # queries using snowflake python connector
 def summarize_unqueriable_metadata_table_combinations():
@@ -365,18 +843,18 @@ def summarize_unqueriable_metadata_table_combinations():
     for unqueriable in UNQUERIABLE_METADATA_TABLES:
         metadata_table = unqueriable['metadata_table']
         metadata_columns = unqueriable['metadata_columns']
-        combo_queries = summarize_metadata_table_combos(metadata_table, metadata_columns, preview_only=True)
+        combo_queries = summarize_metadata_table_combos(metadata_table, metadata_columns, preview_only=True, single_scan=False)
         for combo_query in combo_queries:
             print(combo_query)
 
 # execute (or if preview_only just print) all combo_queries for all metadata_tables and their columns                 
-def summarize_metadata_table_combinations(conn: connector=None, verbose: bool=True, preview_only: bool=False) -> List[str]:
+def summarize_metadata_table_combinations(conn: connector=None, verbose: bool=True, preview_only: bool=False, single_scan: bool=True) -> List[str]:
     all_combo_queries = []
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
     for segment_table_dict in get_segment_table_dicts(latest_df):
         metadata_table = segment_table_dict['metadata_table']
         metadata_table_columns = get_existing_metadata_table_columns(metadata_table, conn=conn, verbose=verbose)
-        combo_queries = summarize_metadata_table_combos(metadata_table, metadata_table_columns, preview_only=preview_only, conn=conn)
+        combo_queries = summarize_metadata_table_combos(metadata_table, metadata_table_columns, preview_only=preview_only, conn=conn, single_scan=single_scan)
         all_combo_queries.extend(combo_queries)
     for combo_query in all_combo_queries:
         print(combo_query)
@@ -430,8 +908,20 @@ def add_and_set_valid_uuid_columns(conn: connector=None, verbose: bool=True) ->
             print(f"\nmanual run needed:\n{set_valid_uuid_query};")
 
 # get the uuid counts for each segment_table
-def get_uuid_counts(conn: connector=None) -> List[Dict[str,Any]]:
+# If batched is True all tables are counted in one round trip by summarize_metadata_tables_batched
+def get_uuid_counts(conn: connector=None, batched: bool=False) -> List[Dict[str,Any]]:
     uuid_counts = []
+    if batched:
+        summary_df = summarize_metadata_tables_batched(conn=conn, verbose=False)
+        for summary_row in summary_df.to_dict(orient="records"):
+            cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{summary_row['metadata_table']}"
+            query_name = f"{cloned_table} @ VALID_UUID"
+            count = summary_row['valid_uuid_count']
+            if summary_row['status'] != 'ok' or pd.isna(count) or int(count) == 0:
+                uuid_counts.append({ query_name: f"SELECT COUNT(*) FROM {cloned_table} WHERE VALID_UUID IS NOT NULL" })
+            else:
+                uuid_counts.append({ query_name: int(count) })
+        return uuid_counts
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
     for segment_table_dict in get_segment_table_dicts(latest_df):
         metadata_table = segment_table_dict['metadata_table']
@@ -439,10 +929,10 @@ def get_uuid_counts(conn: connector=None) -> List[Dict[str,Any]]:
         for uuid in ["VALID_UUID"]:
             count = 0
             query_name = f"{cloned_table} @ "
-            query = f"SELECT COUNT(*) FROM {cloned_table}"
+            query = build_count_query(cloned_table)[0]
             if uuid != "blank":
                 query_name = f"{query_name}{uuid}"
-                query = f"{query} WHERE {uuid} IS NOT NULL"
+                query = build_count_query(cloned_table, f"{uuid} IS NOT NULL")[0]
             try:
                 count = execute_count_query(query, conn=conn, verbose=True)
             except Exception as e:
@@ -476,17 +966,26 @@ def set_remainder_valid_uuids(conn: connector=None, verbose: bool=True):
         for cloned_table_pair, count in remainder_dict.items():
             pair = cloned_table_pair.split("@")
             cloned_table, uuid = pair[0].strip(), pair[1].strip()
-            cnt_uuid_query = f"SELECT COUNT(*) FROM {cloned_table} WHERE {uuid} iS NOT NULL AND VALID_UUID IS NULL;"
+            cnt_uuid_query = build_count_query(cloned_table, f"{uuid} IS NOT NULL AND VALID_UUID IS NULL")[0]
             set_uuid_query = f"UPDATE {cloned_table} SET VALID_UUID = {uuid} WHERE {uuid} IS NOT NULL AND VALID_UUID IS NULL;"
             execute_count_query(cnt_uuid_query, conn=conn, verbose=True)
             execute_single_query(set_uuid_query, conn=conn, verbose=True)
    
-def count_null_valid_uuids(conn: connector=None) -> None:
+# If batched is True all tables are counted in one round trip by summarize_metadata_tables_batched
+def count_null_valid_uuids(conn: connector=None, batched: bool=False) -> None:
+    if batched:
+        summary_df = summarize_metadata_tables_batched(conn=conn, verbose=False)
+        for summary_row in summary_df.to_dict(orient="records"):
+            cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{summary_row['metadata_table']}"
+            count = summary_row['null_valid_uuid_count']
+            count_str = f"{int(count):,}" if summary_row['status'] == 'ok' and pd.notna(count) else summary_row['status']
+            print(f"{cloned_table} null VALID_UUID count: {count_str}")
+        return
     [data_file,latest_df] = get_segment_table_dicts_df(load_latest=True)
     for segment_table_dict in get_segment_table_dicts(latest_df):
         metadata_table = segment_table_dict['metadata_table']
         cloned_table = f"SEGMENT.IDENTIFIES_METADATA.{metadata_table}"
-        cnt_query = f"SELECT COUNT(*) FROM {cloned_table} WHERE VALID_UUID IS NULL;"
+        cnt_query = build_count_query(cloned_table, "VALID_UUID IS NULL")[0]
         execute_count_query(cnt_query, conn=conn, verbose=True)
 
               
@@ -494,7 +993,217 @@ def count_null_valid_uuids(conn: connector=None) -> None:
 # Tests
 ################################################
 
+def test_compute_combo_counts_from_signatures():
+    uuid_columns = ['A', 'B', 'C']
+    rows = [
+        ('x', 'x', 'x'),
+        ('x', 'x', 'y'),
+        ('x', None, 'x'),
+        (None, 'y', 'y'),
+        (None, None, None),
+        ('x', 'y', 'z'),
+    ]
+    # local equivalent of the signature query
+    signature_counts = {}
+    for row in rows:
+        signature = []
+        for i, value in enumerate(row):
+            if value is None:
+                signature.append(-1)
+            else:
+                signature.append(next(j for j in range(i+1) if row[j] == value))
+        signature_counts[tuple(signature)] = signature_counts.get(tuple(signature), 0) + 1
+    signature_rows = [(*k, v) for k, v in signature_counts.items()]
+    combo_counts = compute_combo_counts_from_signatures(signature_rows, len(uuid_columns))
+    for mask in range(1, 1 << len(uuid_columns)):
+        columns = [i for i in range(len(uuid_columns)) if mask & (1 << i)]
+        expected = len([r for r in rows if r[columns[0]] is not None and all(r[c] == r[columns[0]] for c in columns)])
+        assert combo_counts[mask] == expected, f"ERROR: mask:{mask} expected {expected} not {combo_counts[mask]}"
+
+def test_build_equality_signature_query():
+    query = build_equality_signature_query("T", ['A', 'B'])
+    expected = "SELECT CASE WHEN A IS NULL THEN -1 ELSE 0 END AS S0, CASE WHEN B IS NULL THEN -1 WHEN A = B THEN 0 ELSE 1 END AS S1, COUNT(*) AS N FROM T GROUP BY S0, S1"
+    assert query == expected, f"ERROR: unexpected query {query}"
+
+def test_build_summary_select():
+    query = build_summary_select("T", ['USER_ID','USER_ID_UUID','USERNAME_UUID'])
+    assert "ALL_4_EQUAL_COUNT" in query and "NULL AS ALL_4_EQUAL_COUNT" in query, f"ERROR: missing PERSONA_UUID not handled {query}"
+    assert "NULL AS VALID_UUID_COUNT" in query, f"ERROR: missing VALID_UUID not handled {query}"
+    query = build_summary_select("T", [*ALL_4_EQUAL_COLUMNS, 'VALID_UUID'])
+    assert "COUNT_IF(VALID_UUID IS NULL) AS NULL_VALID_UUID_COUNT" in query, f"ERROR: unexpected query {query}"
+    assert query.endswith("FROM SEGMENT.IDENTIFIES_METADATA.T"), f"ERROR: unexpected query {query}"
+
+def test_build_fused_queries():
+    segment_table_dict = {
+        'segment_table': 'SEGMENT.ANGEL_APP_IOS.IDENTIFIES',
+        'metadata_table': 'SEGMENT__ANGEL_APP_IOS__IDENTIFIES',
+        'columns': 'ID-RECEIVED_AT-USER_ID-SENT_AT-TIMESTAMP-EMAIL-ANONYMOUS_ID-RID',
+    }
+    metadata_table_obj = MetadataTable(segment_table_dict)
+    merge_query = metadata_table_obj.build_fused_merge_query()
+    assert merge_query.startswith("MERGE INTO SEGMENT.IDENTIFIES_METADATA.SEGMENT__ANGEL_APP_IOS__IDENTIFIES id1"), f"ERROR: unexpected merge {merge_query}"
+    for uuid in SEGMENT_UUIDS:
+        assert f"id1.{uuid.lower()} = src.{uuid.lower()}" in merge_query, f"ERROR: {uuid} not set by {merge_query}"
+    counts_query = metadata_table_obj.build_fused_counts_query()
+    assert counts_query == "SELECT COUNT(*) AS TOTAL, COUNT(USER_ID_UUID) AS USER_ID_UUID, COUNT(USERNAME_UUID) AS USERNAME_UUID, COUNT(PERSONA_UUID) AS PERSONA_UUID, COUNT(RID_UUID) AS RID_UUID FROM SEGMENT.IDENTIFIES_METADATA.SEGMENT__ANGEL_APP_IOS__IDENTIFIES", f"ERROR: unexpected counts query {counts_query}"
+
+def test_resume_from_journal():
+    from fake_connector import connect_fake, get_fake_connector_stats
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_journal_test-{time.time()}.db"
+    journal = ProgressJournal(f"{db_file}.jsonl")
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 200)
+    get_catalog_cache().invalidate()
+    segment_table_dict = get_benchmark_segment_table_dict()
+    assert not is_metadata_tables_run_complete(journal, [segment_table_dict]), "ERROR: empty journal complete"
+    df = create_and_run_metadata_table(segment_table_dict, verbose=False, preview_only=False, conn=conn, journal=journal)
+    assert is_metadata_tables_run_complete(journal, [segment_table_dict]), "ERROR: completed run not complete"
+    num_queries = get_fake_connector_stats()["queries"]
+    resumed_df = create_and_run_metadata_table(segment_table_dict, verbose=False, preview_only=False, conn=conn, journal=ProgressJournal(f"{db_file}.jsonl"))
+    assert get_fake_connector_stats()["queries"] == num_queries, "ERROR: resumed run ran queries"
+    assert df.to_dict() == resumed_df.to_dict(), f"ERROR: resumed df\n{resumed_df}\nnot\n{df}"
+    journal.reset()
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
+def test_failed_clone_not_cached():
+    from fake_connector import connect_fake
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_clone_test-{time.time()}.db"
+    journal = ProgressJournal(f"{db_file}.jsonl")
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 20)
+    get_catalog_cache().invalidate()
+    segment_table_dict = {**get_benchmark_segment_table_dict(), 'segment_table': 'SEGMENT.MISSING_APP.IDENTIFIES', 'metadata_table': 'SEGMENT__MISSING_APP__IDENTIFIES'}
+    metadata_table_obj = MetadataTable(segment_table_dict)
+    assert not metadata_table_obj.clone_metadata_table(conn=conn, verbose=False, preview_only=False, journal=journal), "ERROR: clone of a missing table succeeded"
+    assert not metadata_table_exists(segment_table_dict['metadata_table'], conn=conn, verbose=False), "ERROR: failed clone cached as existing"
+    assert not journal.is_done(segment_table_dict['metadata_table'], None, "clone"), "ERROR: failed clone journaled"
+    journal.reset()
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
+def test_failed_counts_not_journaled():
+    from fake_connector import connect_fake
+    from benchmarks import get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_counts_test-{time.time()}.db"
+    journal = ProgressJournal(f"{db_file}.jsonl")
+    conn = connect_fake(db_file)
+    metadata_table_obj = MetadataTable(get_benchmark_segment_table_dict())
+    metadata_table_obj.add_query_dicts()
+    query_dict = metadata_table_obj.query_dicts[0]
+    # the cloned table does not exist so both count queries fail
+    assert metadata_table_obj.count_uuid_column(query_dict, True, conn=conn, verbose=False, preview_only=False, journal=journal) is None, "ERROR: failed counts returned"
+    assert not journal.is_done(metadata_table_obj.metadata_table, query_dict['name'], "counts", get_query_hash(query_dict['set_uuid_query'])), "ERROR: failed counts journaled"
+    assert not is_metadata_tables_run_complete(journal, [get_benchmark_segment_table_dict()]), "ERROR: failed run complete"
+    journal.reset()
+    conn.close()
+    os.remove(db_file)
+
+def test_failed_fused_query():
+    from fake_connector import connect_fake
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_fused_test-{time.time()}.db"
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 20)
+    get_catalog_cache().invalidate()
+    segment_table_dict = get_benchmark_segment_table_dict()
+    metadata_table_obj = MetadataTable(segment_table_dict)
+    uuid_columns = metadata_table_obj.get_uuid_columns()
+    # the ALTER TABLE fails on a table dropped behind the cached DESCRIBE
+    assert clone_metadata_table(segment_table_dict, verbose=False, conn=conn, preview_only=False), "ERROR: clone failed"
+    assert get_existing_metadata_table_columns(metadata_table_obj.metadata_table, conn=conn, verbose=False) is not None, "ERROR: describe failed"
+    conn.cursor().execute(f"DROP TABLE {metadata_table_obj.identifies_metadata_table}")
+    df = metadata_table_obj.run_fused_query(conn=conn, verbose=False, preview_only=False)
+    assert pd.isna(df['total'][0]), f"ERROR: unexpected df\n{df}"
+    assert get_existing_metadata_table_columns(metadata_table_obj.metadata_table, conn=conn, verbose=False) is None, "ERROR: failed ALTER TABLE cached"
+    # the fake does not support MERGE, so the columns are added but nothing is counted
+    get_catalog_cache().invalidate()
+    assert clone_metadata_table(segment_table_dict, verbose=False, conn=conn, preview_only=False), "ERROR: clone failed"
+    df = metadata_table_obj.run_fused_query(conn=conn, verbose=False, preview_only=False)
+    assert all([pd.isna(df[x][0]) for x in ['total', *uuid_columns]]), f"ERROR: failed MERGE counted\n{df}"
+    existing_columns = get_existing_metadata_table_columns(metadata_table_obj.metadata_table, conn=conn, verbose=False)
+    assert all([x in existing_columns for x in uuid_columns]), f"ERROR: added columns not cached {existing_columns}"
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
+def test_partitioned_update():
+    from fake_connector import connect_fake
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_partitioned_test-{time.time()}.db"
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 200)
+    segment_table_dict = get_benchmark_segment_table_dict()
+    dfs = []
+    for partitioned in [False, True]:
+        conn.cursor().execute(f"DROP TABLE IF EXISTS SEGMENT.IDENTIFIES_METADATA.{segment_table_dict['metadata_table']}")
+        get_catalog_cache().invalidate()
+        dfs.append(create_and_run_metadata_table(segment_table_dict, verbose=False, preview_only=False, conn=conn, partitioned=partitioned))
+    assert dfs[0].to_dict() == dfs[1].to_dict(), f"ERROR: partitioned df\n{dfs[1]}\nnot\n{dfs[0]}"
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
+def test_metadata_tables_dag():
+    from fake_connector import connect_fake
+    from benchmarks import create_synthetic_tables, get_benchmark_segment_table_dict
+    db_file = f"/tmp/metadata_tables_dag_test-{time.time()}.db"
+    conn = connect_fake(db_file)
+    create_synthetic_tables(conn, 200)
+    get_catalog_cache().invalidate()
+    small_dict = get_benchmark_segment_table_dict()
+    large_segment_table = small_dict['segment_table'].replace("BENCH_APP", "BENCH_APP_LARGE")
+    conn.cursor().execute(f"CREATE TABLE {large_segment_table} AS SELECT * FROM {small_dict['segment_table']} UNION ALL SELECT * FROM {small_dict['segment_table']}")
+    large_dict = {**small_dict, 'segment_table': large_segment_table, 'metadata_table': get_metadata_table_from_segment_table(large_segment_table)}
+    row_counts = {small_dict['segment_table']: 200, large_segment_table: 400}
+    [dag, _] = build_metadata_tables_dag([small_dict, large_dict], row_counts, conn=conn, preview_only=False)
+    assert dag.nodes[f"{small_dict['metadata_table']}:rid_query:update"].deps == [f"{small_dict['metadata_table']}:rid_query:add_column", f"{small_dict['metadata_table']}:persona_query:update"], "ERROR: updates of one table not chained"
+    # the ranges of partitioned updates run one at a time inside their dag node
+    partition_workers = []
+    original_run_partitioned_update = run_partitioned_update
+    def recording_run_partitioned_update(*args, **kwargs):
+        partition_workers.append(kwargs['max_workers'])
+        return original_run_partitioned_update(*args, **kwargs)
+    globals()['run_partitioned_update'] = recording_run_partitioned_update
+    try:
+        [dag, _] = build_metadata_tables_dag([small_dict, large_dict], row_counts, conn=conn, verbose=False, preview_only=False, partitioned=True, max_workers=1)
+        dag.run()
+    finally:
+        globals()['run_partitioned_update'] = original_run_partitioned_update
+    assert partition_workers == [1] * 8, f"ERROR: unexpected partition workers {partition_workers}"
+    update_name = "user_id_query:update"
+    large_start = dag.nodes[f"{large_dict['metadata_table']}:{update_name}"].started_at
+    small_start = dag.nodes[f"{small_dict['metadata_table']}:{update_name}"].started_at
+    assert large_start < small_start, "ERROR: update of the larger table not started first"
+    for metadata_table in [small_dict['metadata_table'], large_dict['metadata_table']]:
+        conn.cursor().execute(f"DROP TABLE SEGMENT.IDENTIFIES_METADATA.{metadata_table}")
+    get_catalog_cache().invalidate()
+    union_df = run_metadata_tables_dag([small_dict, large_dict], conn=conn, verbose=False, preview_only=False, max_workers=3, row_counts=row_counts)
+    assert list(union_df['metadata_table']) == [small_dict['metadata_table'], large_dict['metadata_table']], f"ERROR: unexpected union_df\n{union_df}"
+    assert union_df['total'].tolist() == [200, 400], f"ERROR: unexpected totals\n{union_df}"
+    conn.cursor().execute(f"DROP TABLE SEGMENT.IDENTIFIES_METADATA.{small_dict['metadata_table']}")
+    get_catalog_cache().invalidate()
+    df = create_and_run_metadata_table(small_dict, verbose=False, preview_only=False, conn=conn)
+    assert union_df.iloc[[0]].to_dict('records') == df.to_dict('records'), f"ERROR: dag df\n{union_df}\nnot\n{df}"
+    conn.close()
+    os.remove(db_file)
+    get_catalog_cache().invalidate()
+
 def tests():
+    test_compute_combo_counts_from_signatures()
+    test_resume_from_journal()
+    test_failed_clone_not_cached()
+    test_failed_counts_not_journaled()
+    test_failed_fused_query()
+    test_partitioned_update()
+    test_metadata_tables_dag()
+    test_build_fused_queries()
+    test_build_summary_select()
+    test_build_equality_signature_query()
     print("all tests passed in", os.path.basename(__file__))
 
 def main():
@@ -502,6 +1211,7 @@ def main():
     
     count_null_valid_uuids(conn=conn)
     
+    print("catalog_cache stats:", get_catalog_cache().get_stats())
     print("done")
     
 if __name__ == "__main__":
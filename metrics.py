@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import bisect
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Default latency buckets in seconds, from 10ms to 10 minutes
+DEFAULT_SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0]
+
+# Statement keywords that name a query kind, other statements are "other"
+QUERY_KINDS = ["select", "with", "update", "merge", "insert", "delete", "create", "alter", "drop", "describe", "show", "copy", "put"]
+
+# Returns the kind of query used to group its metrics, e.g. "count", "select", "update"
+def query_kind(query: Optional[str]) -> str:
+    if query is None:
+        return "other"
+    words = query.strip().split(None, 2)
+    if len(words) == 0:
+        return "other"
+    kind = words[0].lower()
+    if kind in ("select", "with") and re.match(r"^\s*SELECT\s+COUNT\s*\(", query, re.IGNORECASE):
+        return "count"
+    return kind if kind in QUERY_KINDS else "other"
+
+
+# A cumulative histogram with fixed upper bounds like a Prometheus histogram
+class Histogram():
+    def __init__(self, buckets: Sequence[float]=DEFAULT_SECONDS_BUCKETS):
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Returns the cumulative count of observations <= each bucket bound, ending with +Inf
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        counts = []
+        total = 0
+        for bound, count in zip([*[str(x) for x in self.buckets], "+Inf"], self.bucket_counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(self.cumulative_counts()),
+        }
+
+
+# A process-wide registry of labeled counters and histograms.
+#
+# Metrics are identified by a name and a dict of labels, e.g.
+#   registry.inc("query_rows_total", 1000, kind="select")
+#   registry.observe("query_seconds", 1.5, kind="count")
+# and can be dumped with to_json() or to_prometheus().
+#
+class MetricsRegistry():
+    def __init__(self, prefix: str="snowflake_connector"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Tuple, float]] = {}
+        self.histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self.help: Dict[str, str] = {}
+
+    # Returns the hashable key of labels
+    def labels_key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    # Adds value to the counter name with the given labels
+    def inc(self, name: str, value: float=1, **labels: str) -> None:
+        key = self.labels_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    # Adds value to the histogram name with the given labels
+    def observe(self, name: str, value: float, buckets: Sequence[float]=DEFAULT_SECONDS_BUCKETS, **labels: str) -> None:
+        key = self.labels_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    # Sets the help text of name shown in the Prometheus output
+    def describe(self, name: str, help_text: str) -> None:
+        self.help[name] = help_text
+
+    # Returns the value of the counter name with the given labels
+    def get_counter(self, name: str, **labels: str) -> float:
+        with self.lock:
+            return self.counters.get(name, {}).get(self.labels_key(labels), 0)
+
+    # Returns the count and sum of the histogram name with the given labels
+    def get_histogram(self, name: str, **labels: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            histogram = self.histograms.get(name, {}).get(self.labels_key(labels))
+            return None if histogram is None else histogram.to_dict()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": {name: [{"labels": dict(key), "value": value} for key, value in series.items()] for name, series in self.counters.items()},
+                "histograms": {name: [{"labels": dict(key), **histogram.to_dict()} for key, histogram in series.items()] for name, series in self.histograms.items()},
+            }
+
+    def to_json(self, indent: Optional[int]=2) -> str:
+        return json.dumps(self.to_dict(), indent=indent, sort_keys=True)
+
+    # Returns all metrics in the Prometheus text exposition format
+    def to_prometheus(self) -> str:
+        def labels_str(key: Tuple, extra: Tuple=()) -> str:
+            pairs = [*key, *extra]
+            if len(pairs) == 0:
+                return ""
+            escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs]
+            return "{" + ",".join([f'{k}="{v}"' for k, v in escaped]) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                full_name = f"{self.prefix}_{name}"
+                if name in self.help:
+                    lines.append(f"# HELP {full_name} {self.help[name]}")
+                lines.append(f"# TYPE {full_name} counter")
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append(f"{full_name}{labels_str(key)} {value}")
+            for name in sorted(self.histograms):
+                full_name = f"{self.prefix}_{name}"
+                if name in self.help:
+                    lines.append(f"# HELP {full_name} {self.help[name]}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for key, histogram in sorted(self.histograms[name].items()):
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f"{full_name}_bucket{labels_str(key, (('le', bound),))} {count}")
+                    lines.append(f"{full_name}_sum{labels_str(key)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{labels_str(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    # Writes the metrics to file as json, or in Prometheus format if file ends with .prom
+    def save(self, file: str) -> None:
+        with open(file, "w") as f:
+            f.write(self.to_prometheus() if file.endswith(".prom") else self.to_json())
+
+
+_metrics_registry = None
+_metrics_registry_lock = threading.Lock()
+
+# Returns the process-wide MetricsRegistry that query_generator and timefunc record into
+def get_metrics_registry() -> MetricsRegistry:
+    global _metrics_registry
+    with _metrics_registry_lock:
+        if _metrics_registry is None:
+            _metrics_registry = MetricsRegistry()
+            _metrics_registry.describe("queries_total", "queries run by status and kind")
+            _metrics_registry.describe("query_seconds", "query latency from execute to the last fetched batch")
+            _metrics_registry.describe("query_rows_total", "result rows fetched")
+            _metrics_registry.describe("query_batches_total", "result batches fetched")
+            _metrics_registry.describe("query_bytes_total", "estimated bytes of the fetched result batches")
+            _metrics_registry.describe("query_timeouts_total", "queries that failed with errno 604")
+            _metrics_registry.describe("query_retries_total", "queries that were retried")
+            _metrics_registry.describe("function_seconds", "elapsed time of functions decorated with timefunc")
+        return _metrics_registry
+
+# Records one finished query of the given kind in the process-wide registry.
+# status is "ok", "timeout" or "error".
+def record_query(kind: str, status: str, seconds: float, num_rows: int, num_batches: int, num_bytes: int) -> None:
+    registry = get_metrics_registry()
+    registry.inc("queries_total", kind=kind, status=status)
+    registry.observe("query_seconds", seconds, kind=kind)
+    registry.inc("query_rows_total", num_rows, kind=kind)
+    registry.inc("query_batches_total", num_batches, kind=kind)
+    registry.inc("query_bytes_total", num_bytes, kind=kind)
+    if status == "timeout":
+        registry.inc("query_timeouts_total", kind=kind)
+
+# Records one retry of a query of the given kind in the process-wide registry
+def record_query_retry(kind: str) -> None:
+    get_metrics_registry().inc("query_retries_total", kind=kind)
+
+
+################################################
+# Tests
+################################################
+
+def test_query_kind():
+    assert query_kind("SELECT count(*) from A.B.C") == "count", "ERROR: count kind"
+    assert query_kind("  select ID from A.B.C") == "select", "ERROR: select kind"
+    assert query_kind("UPDATE A.B.C id1 SET x = 1") == "update", "ERROR: update kind"
+    assert query_kind("grant role x") == "other", "ERROR: other kind"
+    assert query_kind("") == "other", "ERROR: empty kind"
+
+def test_registry_json_and_prometheus():
+    registry = MetricsRegistry(prefix="test")
+    registry.inc("queries_total", kind="count", status="ok")
+    registry.inc("queries_total", kind="count", status="ok")
+    registry.observe("query_seconds", 0.2, kind="count")
+    registry.observe("query_seconds", 20.0, kind="count")
+    assert registry.get_counter("queries_total", status="ok", kind="count") == 2, "ERROR: unexpected counter"
+    histogram = registry.get_histogram("query_seconds", kind="count")
+    assert histogram["count"] == 2 and histogram["buckets"]["0.25"] == 1 and histogram["buckets"]["+Inf"] == 2, f"ERROR: unexpected histogram {histogram}"
+    loaded = json.loads(registry.to_json())
+    assert loaded["counters"]["queries_total"][0]["value"] == 2, "ERROR: unexpected json"
+    text = registry.to_prometheus()
+    assert 'test_queries_total{kind="count",status="ok"} 2' in text, f"ERROR: unexpected prometheus counter\n{text}"
+    assert 'test_query_seconds_bucket{kind="count",le="0.25"} 1' in text, f"ERROR: unexpected prometheus bucket\n{text}"
+    assert 'test_query_seconds_count{kind="count"} 2' in text, f"ERROR: unexpected prometheus count\n{text}"
+
+def tests():
+    test_query_kind()
+    test_registry_json_and_prometheus()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
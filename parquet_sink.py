@@ -0,0 +1,216 @@
+import os
+import time
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from constants import DEFAULT_ROW_GROUP_SIZE
+
+# Returns an Arrow table with the given column names from a query_batch_generator
+# batch of row tuples or a pyarrow.Table batch
+def batch_to_arrow_table(batch: Union[List[Sequence[Any]], pa.Table], columns: List[str]) -> pa.Table:
+    if isinstance(batch, pa.Table):
+        return batch.rename_columns(columns)
+    return pa.table({column: pa.array([row[i] for row in batch]) for i, column in enumerate(columns)})
+
+
+# State of the open part file of one partition
+class PartitionWriter():
+    def __init__(self, partition_dir: str):
+        self.partition_dir = partition_dir
+        self.pending: List[pa.Table] = []
+        self.num_pending = 0
+        self.writer: Optional[pq.ParquetWriter] = None
+        self.data_file: Optional[str] = None
+        self.num_file_rows = 0
+        self.num_parts = 0
+
+
+# Streams query result batches to Parquet in constant memory.
+#
+# Batches are buffered until row_group_size rows are pending and then written
+# as one row group, so at most about row_group_size rows per partition are held
+# in memory at once. Without max_rows_per_file and partition_columns a single
+# file is written to path. Otherwise path is a directory of part-NNNNN.parquet
+# files, each holding at most max_rows_per_file rows, in hive-style
+# column=value sub directories per partition_columns values (the partition
+# columns are then stored in the directory names, not in the files).
+#
+# The schema is taken from schema or else from the first batch, with
+# all-null columns stored as strings. Later batches are cast to it.
+#
+# Usage:
+#   sink = ParquetSink("/tmp/identifies.parquet", columns)
+#   for batch in query_batch_generator(query, fetch_arrow=True):
+#       sink.write_batch(batch)
+#   stats = sink.close()
+#
+class ParquetSink():
+    def __init__(
+        self,
+        path: str,
+        columns: List[str],
+        schema: Optional[pa.Schema]=None,
+        row_group_size: int=DEFAULT_ROW_GROUP_SIZE,
+        max_rows_per_file: Optional[int]=None,
+        partition_columns: Optional[List[str]]=None,
+        compression: str="snappy"):
+        assert row_group_size > 0, f"ERROR: invalid row_group_size: {row_group_size}"
+        self.path = path
+        self.columns = columns
+        self.partition_columns = [] if partition_columns is None else partition_columns
+        self.file_columns = [x for x in columns if x not in self.partition_columns]
+        self.schema = None if schema is None else pa.schema([schema.field(x) for x in self.file_columns])
+        self.row_group_size = row_group_size
+        self.max_rows_per_file = max_rows_per_file
+        self.compression = compression
+        self.is_directory = max_rows_per_file is not None or len(self.partition_columns) > 0
+        self.partitions: Dict[Tuple, PartitionWriter] = {}
+        self.data_files: List[str] = []
+        self.start = time.perf_counter()
+        self.stats = {
+            "num_batches": 0,
+            "num_rows": 0,
+            "num_row_groups": 0,
+        }
+        parent_dir = path if self.is_directory else os.path.dirname(path)
+        if len(parent_dir) > 0:
+            os.makedirs(parent_dir, exist_ok=True)
+
+    # Returns the schema of table without partition columns and with null columns as strings
+    def infer_schema(self, table: pa.Table) -> pa.Schema:
+        fields = []
+        for field in table.select(self.file_columns).schema:
+            fields.append(pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field)
+        return pa.schema(fields)
+
+    # Returns the PartitionWriter of the given partition values
+    def get_partition(self, values: Tuple) -> PartitionWriter:
+        if values not in self.partitions:
+            partition_dir = os.path.join(self.path, *[f"{c}={v}" for c, v in zip(self.partition_columns, values)])
+            self.partitions[values] = PartitionWriter(partition_dir)
+        return self.partitions[values]
+
+    # Appends a query_batch_generator batch (row tuples or a pyarrow.Table)
+    def write_batch(self, batch: Union[List[Sequence[Any]], pa.Table]) -> None:
+        table = batch_to_arrow_table(batch, self.columns)
+        if table.num_rows == 0:
+            return
+        if self.schema is None:
+            self.schema = self.infer_schema(table)
+        self.stats["num_batches"] += 1
+        self.stats["num_rows"] += table.num_rows
+        if len(self.partition_columns) == 0:
+            self.add_pending(self.get_partition(()), table.select(self.file_columns))
+            return
+        keys = table.select(self.partition_columns).group_by(self.partition_columns).aggregate([])
+        for values in keys.to_pylist():
+            mask = None
+            for column in self.partition_columns:
+                value = values[column]
+                column_mask = pc.is_null(table.column(column)) if value is None else pc.equal(table.column(column), value)
+                mask = column_mask if mask is None else pc.and_(mask, column_mask)
+            partition = self.get_partition(tuple([values[x] for x in self.partition_columns]))
+            self.add_pending(partition, table.filter(mask).select(self.file_columns))
+
+    def add_pending(self, partition: PartitionWriter, table: pa.Table) -> None:
+        partition.pending.append(table.cast(self.schema))
+        partition.num_pending += table.num_rows
+        while partition.num_pending >= self.row_group_size:
+            self.flush(partition, self.row_group_size)
+
+    # Writes num_rows (all if None) pending rows of partition, starting new part files as needed
+    def flush(self, partition: PartitionWriter, num_rows: Optional[int]=None) -> None:
+        pending = pa.concat_tables(partition.pending)
+        num_rows = pending.num_rows if num_rows is None else num_rows
+        table = pending.slice(0, num_rows)
+        rest = pending.slice(num_rows)
+        partition.pending = [rest] if rest.num_rows > 0 else []
+        partition.num_pending = rest.num_rows
+        while table.num_rows > 0:
+            if partition.writer is None or (self.max_rows_per_file is not None and partition.num_file_rows >= self.max_rows_per_file):
+                self.open_part_file(partition)
+            num_file_rows = table.num_rows
+            if self.max_rows_per_file is not None:
+                num_file_rows = min(num_file_rows, self.max_rows_per_file - partition.num_file_rows)
+            partition.writer.write_table(table.slice(0, num_file_rows), row_group_size=self.row_group_size)
+            partition.num_file_rows += num_file_rows
+            self.stats["num_row_groups"] += 1
+            table = table.slice(num_file_rows)
+
+    # Closes the current part file of partition and opens the next one
+    def open_part_file(self, partition: PartitionWriter) -> None:
+        if partition.writer is not None:
+            partition.writer.close()
+        if self.is_directory:
+            os.makedirs(partition.partition_dir, exist_ok=True)
+            data_file = os.path.join(partition.partition_dir, f"part-{partition.num_parts:05d}.parquet")
+        else:
+            data_file = self.path
+        partition.writer = pq.ParquetWriter(data_file, self.schema, compression=self.compression)
+        partition.data_file = data_file
+        partition.num_file_rows = 0
+        partition.num_parts += 1
+        self.data_files.append(data_file)
+
+    # Writes all pending rows, closes all files and returns the sink stats:
+    # path, data_files, num_files, num_batches, num_rows, num_row_groups, num_bytes, seconds
+    def close(self) -> Dict[str, Any]:
+        for partition in self.partitions.values():
+            if partition.num_pending > 0:
+                self.flush(partition)
+            if partition.writer is not None:
+                partition.writer.close()
+                partition.writer = None
+        stats = dict(self.stats)
+        stats["path"] = self.path
+        stats["data_files"] = list(self.data_files)
+        stats["num_files"] = len(self.data_files)
+        stats["num_bytes"] = sum([os.path.getsize(x) for x in self.data_files])
+        stats["seconds"] = time.perf_counter() - self.start
+        return stats
+
+
+################################################
+# Tests
+################################################
+
+def test_single_file():
+    data_file = f"/tmp/parquet_sink_test-{time.time()}.parquet"
+    sink = ParquetSink(data_file, ["ID", "USER_ID"], row_group_size=4)
+    sink.write_batch([(1, None), (2, None), (3, None)])
+    sink.write_batch([(4, "u4"), (5, "u5")])
+    sink.write_batch(pa.table({"a": [6], "b": ["u6"]}))
+    stats = sink.close()
+    assert stats["num_rows"] == 6 and stats["num_files"] == 1 and stats["num_row_groups"] == 2, f"ERROR: unexpected stats {stats}"
+    table = pq.read_table(data_file)
+    assert table.column("ID").to_pylist() == [1, 2, 3, 4, 5, 6], "ERROR: unexpected ID column"
+    assert table.column("USER_ID").to_pylist() == [None, None, None, "u4", "u5", "u6"], "ERROR: unexpected USER_ID column"
+    assert pq.ParquetFile(data_file).num_row_groups == 2, "ERROR: expected 2 row groups"
+    os.remove(data_file)
+
+def test_parts_and_partitions():
+    path = f"/tmp/parquet_sink_test-{time.time()}"
+    sink = ParquetSink(path, ["ID", "DAY"], row_group_size=2, max_rows_per_file=3, partition_columns=["DAY"])
+    sink.write_batch([(i, f"d{i % 2}") for i in range(10)])
+    stats = sink.close()
+    assert stats["num_rows"] == 10, f"ERROR: unexpected stats {stats}"
+    assert sorted([os.path.relpath(x, path) for x in stats["data_files"]]) == [
+        "DAY=d0/part-00000.parquet", "DAY=d0/part-00001.parquet",
+        "DAY=d1/part-00000.parquet", "DAY=d1/part-00001.parquet"], f"ERROR: unexpected files {stats['data_files']}"
+    table = pq.read_table(path)
+    ids = sorted(zip(table.column("ID").to_pylist(), [str(x) for x in table.column("DAY").to_pylist()]))
+    assert ids == [(i, f"d{i % 2}") for i in range(10)], f"ERROR: unexpected rows {ids}"
+    shutil.rmtree(path)
+
+def tests():
+    test_single_file()
+    test_parts_and_partitions()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
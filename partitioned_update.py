@@ -0,0 +1,281 @@
+import os
+import time
+import datetime
+import threading
+import snowflake.connector as connector
+from snowflake.connector import ProgrammingError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from constants import *
+from query_generator import execute_simple_query, execute_single_query, clean_query
+from metrics import record_query_retry
+from tracing import span
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Runs a large UPDATE as many smaller UPDATEs over ranges of a timestamp column,
+# for set_uuid_queries that exceed DEFAULT_TIMEOUT_SECONDS on the biggest tables.
+#
+# 1. a per-day histogram of the range_column (RECEIVED_AT, else TIMESTAMP) gives
+#    row count estimates, and consecutive days are packed into ranges of about
+#    max_rows_per_range rows, plus one range for rows where range_column is NULL
+# 2. the update is run once per range with "AND id1.{range_column} >= start AND
+#    id1.{range_column} < end" appended to its WHERE clause, on up to max_workers
+#    connections at once
+# 3. a range that times out (errno 604) is split in two, by days or else by time,
+#    and both halves are run again until min_range_seconds is reached
+#
+# The set_uuid_query must alias the updated table as id1 and end with a WHERE clause,
+# like the queries of metadata_tables.MetadataTable.add_query_dicts.
+
+RANGE_COLUMNS = ["RECEIVED_AT", "TIMESTAMP"]
+RANGE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# A half-open [start, end) range of range_column with its estimated number of rows.
+# start and end are None for the range of rows where range_column is NULL.
+class UpdateRange():
+    def __init__(self, start: Optional[datetime.datetime], end: Optional[datetime.datetime], num_rows: int, day_counts: Optional[List[Tuple[datetime.datetime, int]]]=None):
+        self.start = start
+        self.end = end
+        self.num_rows = num_rows
+        self.day_counts = [] if day_counts is None else day_counts
+        self.num_attempts = 0
+
+    def is_null_range(self) -> bool:
+        return self.start is None
+
+    # Returns the predicate of rows of the updated table id1 in this range
+    def get_predicate(self, range_column: str) -> str:
+        if self.is_null_range():
+            return f"id1.{range_column} IS NULL"
+        return f"id1.{range_column} >= '{self.start.strftime(RANGE_TIME_FORMAT)}' AND id1.{range_column} < '{self.end.strftime(RANGE_TIME_FORMAT)}'"
+
+    # Returns two halves of this range split by days if it spans several days
+    # else by time, or None if it is shorter than 2 * min_range_seconds
+    def split(self, min_range_seconds: float) -> Optional[List['UpdateRange']]:
+        if self.is_null_range():
+            return None
+        if len(self.day_counts) > 1:
+            half = self.num_rows / 2
+            total = 0
+            for i, (day, count) in enumerate(self.day_counts[:-1]):
+                total += count
+                if total >= half or i == len(self.day_counts) - 2:
+                    break
+            left_days = self.day_counts[:i + 1]
+            right_days = self.day_counts[i + 1:]
+            middle = right_days[0][0]
+            return [
+                UpdateRange(self.start, middle, sum([x[1] for x in left_days]), left_days),
+                UpdateRange(middle, self.end, sum([x[1] for x in right_days]), right_days),
+            ]
+        if (self.end - self.start).total_seconds() < 2 * min_range_seconds:
+            return None
+        middle = self.start + (self.end - self.start) / 2
+        middle = middle.replace(microsecond=0)
+        return [
+            UpdateRange(self.start, middle, self.num_rows // 2),
+            UpdateRange(middle, self.end, self.num_rows - self.num_rows // 2),
+        ]
+
+    def __repr__(self) -> str:
+        if self.is_null_range():
+            return f"UpdateRange(NULL, rows:{self.num_rows})"
+        return f"UpdateRange({self.start.strftime(RANGE_TIME_FORMAT)}, {self.end.strftime(RANGE_TIME_FORMAT)}, rows:{self.num_rows})"
+
+
+# Returns the first of RANGE_COLUMNS in columns or None
+def choose_range_column(columns: List[str]) -> Optional[str]:
+    upper_columns = [x.upper() for x in columns]
+    for range_column in RANGE_COLUMNS:
+        if range_column in upper_columns:
+            return range_column
+    return None
+
+# Returns a query of the number of rows per day of range_column, NULL days included
+def build_day_histogram_query(table: str, range_column: str) -> str:
+    return f"SELECT TO_DATE({range_column}) AS DAY, COUNT(*) AS N FROM {table} GROUP BY DAY ORDER BY DAY"
+
+# Returns the set_uuid_query restricted to the rows matching predicate
+def add_range_predicate(set_uuid_query: str, predicate: str) -> str:
+    set_uuid_query = clean_query(set_uuid_query)
+    assert " WHERE " in set_uuid_query.upper(), f"ERROR: no WHERE clause in {set_uuid_query}"
+    return f"{set_uuid_query} AND ({predicate})"
+
+# Returns the day histogram rows (day, count) as UpdateRanges of about max_rows_per_range rows,
+# the ranges of consecutive days are adjacent so together they cover all non NULL values
+def build_update_ranges(histogram_rows: List[Tuple], max_rows_per_range: int) -> List[UpdateRange]:
+    ranges = []
+    day_counts = []
+    null_count = 0
+    for day, count in histogram_rows:
+        if day is None:
+            null_count += count
+            continue
+        if not isinstance(day, datetime.date):
+            day = datetime.date.fromisoformat(str(day)[:10])
+        day_counts.append((datetime.datetime(day.year, day.month, day.day), count))
+    current = []
+    for day, count in day_counts:
+        if len(current) > 0 and sum([x[1] for x in current]) + count > max_rows_per_range:
+            ranges.append(current)
+            current = []
+        current.append((day, count))
+    if len(current) > 0:
+        ranges.append(current)
+    update_ranges = []
+    for i, days in enumerate(ranges):
+        start = days[0][0]
+        # the last range is open ended up to the day after its last day
+        end = ranges[i + 1][0][0] if i + 1 < len(ranges) else days[-1][0] + datetime.timedelta(days=1)
+        update_ranges.append(UpdateRange(start, end, sum([x[1] for x in days]), days))
+    if null_count > 0:
+        update_ranges.append(UpdateRange(None, None, null_count))
+    return update_ranges
+
+# Runs run_range(update_range) for all ranges on up to max_workers threads.
+# When run_range raises ProgrammingError errno 604 the range is split and
+# its halves are run instead, other errors and ranges that cannot be split
+# any further are returned as failed.
+# Returns the lists of [done, failed] ranges and the number of splits.
+def run_update_ranges(
+    update_ranges: List[UpdateRange],
+    run_range: Callable[[UpdateRange], Any],
+    max_workers: int=PARTITIONED_UPDATE_MAX_WORKERS,
+    min_range_seconds: float=PARTITIONED_UPDATE_MIN_RANGE_SECONDS,
+    verbose: bool=True) -> Tuple[List[UpdateRange], List[UpdateRange], int]:
+    done = []
+    failed = []
+    num_splits = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+
+        def submit(update_range: UpdateRange) -> None:
+            update_range.num_attempts += 1
+            futures[executor.submit(run_range, update_range)] = update_range
+
+        for update_range in update_ranges:
+            submit(update_range)
+        while len(futures) > 0:
+            finished, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in finished:
+                update_range = futures.pop(future)
+                err = future.exception()
+                if err is None:
+                    done.append(update_range)
+                    continue
+                halves = None
+                if isinstance(err, ProgrammingError) and err.errno == 604:
+                    halves = update_range.split(min_range_seconds)
+                if halves is None:
+                    print(f"ERROR: {update_range} failed with {type(err).__name__} {str(err)}")
+                    failed.append(update_range)
+                    continue
+                num_splits += 1
+                record_query_retry("update")
+                if verbose:
+                    print(f"{update_range} timed out, split into {halves}")
+                for half in halves:
+                    submit(half)
+    return [done, failed, num_splits]
+
+# Runs set_uuid_query on table over ranges of range_column (see the top of this file).
+# Each range runs on conn if given, else on its own connection from the pool.
+# Returns the stats: range_column, num_ranges, num_done, num_failed, num_splits, seconds,
+# the update succeeded if num_failed is 0. If the histogram query fails no range is
+# run and num_failed is 1, so a timed out histogram never passes for an empty table.
+def run_partitioned_update(
+    set_uuid_query: str,
+    table: str,
+    range_column: str,
+    conn: connector=None,
+    max_rows_per_range: int=PARTITIONED_UPDATE_MAX_ROWS,
+    max_workers: int=PARTITIONED_UPDATE_MAX_WORKERS,
+    min_range_seconds: float=PARTITIONED_UPDATE_MIN_RANGE_SECONDS,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    verbose: bool=True) -> Dict[str, Any]:
+    start = time.perf_counter()
+    with span("run_partitioned_update", table=table, range_column=range_column) as s:
+        histogram_failed = False
+        try:
+            histogram_rows = execute_simple_query(build_day_histogram_query(table, range_column), conn=conn, timeout_seconds=timeout_seconds, verbose=verbose, raise_errors=True)
+        except ProgrammingError as err:
+            print(f"ERROR: histogram of {table} by {range_column} failed with {type(err).__name__} {str(err)}")
+            histogram_failed = True
+            histogram_rows = []
+        update_ranges = build_update_ranges(histogram_rows, max_rows_per_range)
+        if verbose:
+            print(f"run_partitioned_update.update_ranges:\n{update_ranges}")
+
+        def run_range(update_range: UpdateRange) -> None:
+            range_query = add_range_predicate(set_uuid_query, update_range.get_predicate(range_column))
+            exc = execute_single_query(range_query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose, raise_errors=True)
+            if not isinstance(exc, StopIteration):
+                raise exc
+
+        [done, failed, num_splits] = run_update_ranges(update_ranges, run_range, max_workers=max_workers, min_range_seconds=min_range_seconds, verbose=verbose)
+        stats = {
+            "range_column": range_column,
+            "num_ranges": len(update_ranges),
+            "num_done": len(done),
+            "num_failed": len(failed) + (1 if histogram_failed else 0),
+            "num_splits": num_splits,
+            "seconds": time.perf_counter() - start,
+        }
+        s.set(**stats)
+    if verbose:
+        print(f"run_partitioned_update.stats:\n{stats}")
+    return stats
+
+
+################################################
+# Tests
+################################################
+
+def test_build_update_ranges():
+    histogram_rows = [(None, 5), ("2022-07-01", 40), ("2022-07-02", 30), ("2022-07-04", 50), ("2022-07-05", 10)]
+    update_ranges = build_update_ranges(histogram_rows, max_rows_per_range=70)
+    assert [x.num_rows for x in update_ranges] == [70, 60, 5], f"ERROR: unexpected ranges {update_ranges}"
+    assert update_ranges[0].end == update_ranges[1].start == datetime.datetime(2022, 7, 4), f"ERROR: ranges not adjacent {update_ranges}"
+    assert update_ranges[1].end == datetime.datetime(2022, 7, 6), f"ERROR: unexpected end {update_ranges[1]}"
+    assert update_ranges[2].get_predicate("RECEIVED_AT") == "id1.RECEIVED_AT IS NULL", "ERROR: unexpected null predicate"
+    query = add_range_predicate("UPDATE T id1 SET X = 1 FROM T id WHERE id1.ID = id.ID", update_ranges[0].get_predicate("RECEIVED_AT"))
+    assert query.endswith("WHERE id1.ID = id.ID AND (id1.RECEIVED_AT >= '2022-07-01 00:00:00' AND id1.RECEIVED_AT < '2022-07-04 00:00:00')"), f"ERROR: unexpected query {query}"
+    assert choose_range_column(["ID", "TIMESTAMP", "RECEIVED_AT"]) == "RECEIVED_AT" and choose_range_column(["ID"]) is None, "ERROR: unexpected range column"
+
+def test_split_on_timeout():
+    update_ranges = build_update_ranges([("2022-07-01", 40), ("2022-07-02", 30), ("2022-07-03", 30)], max_rows_per_range=1000)
+    lock = threading.Lock()
+    attempts = []
+
+    # times out for ranges over 35 rows
+    def run_range(update_range: UpdateRange) -> None:
+        with lock:
+            attempts.append(update_range)
+        if update_range.num_rows > 35:
+            raise ProgrammingError(msg="timeout", errno=604)
+
+    [done, failed, num_splits] = run_update_ranges(update_ranges, run_range, max_workers=2, min_range_seconds=3600, verbose=False)
+    assert len(failed) == 0 and sum([x.num_rows for x in done]) == 100, f"ERROR: unexpected done {done} failed {failed}"
+    assert all([x.num_rows <= 35 for x in done]) and num_splits == 3, f"ERROR: unexpected splits {num_splits} {done}"
+    done = sorted(done, key=lambda x: x.start)
+    assert all([a.end == b.start for a, b in zip(done, done[1:])]), f"ERROR: split ranges not adjacent {done}"
+    [done, failed, num_splits] = run_update_ranges([UpdateRange(None, None, 50)], run_range, verbose=False)
+    assert len(failed) == 1 and num_splits == 0, "ERROR: NULL range split"
+
+def test_histogram_failure():
+    from fake_connector import connect_fake
+    conn = connect_fake()
+    stats = run_partitioned_update("UPDATE A.B.C id1 SET X = 1 WHERE id1.X IS NULL", "A.B.C", "RECEIVED_AT", conn=conn, verbose=False)
+    assert stats["num_ranges"] == 0 and stats["num_failed"] == 1, f"ERROR: failed histogram not reported {stats}"
+    conn.close()
+
+def tests():
+    test_build_update_ranges()
+    test_split_on_timeout()
+    test_histogram_failure()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
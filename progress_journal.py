@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Steps of one query_dict of a metadata_table in the order they are run.
+# "clone" is recorded once per metadata_table with query_name None.
+JOURNAL_STEPS = ["clone", "add_column", "update", "counts"]
+
+# Returns a short hash of query used to detect that a journaled step ran a different query
+def get_query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()[:16]
+
+
+# A durable journal of the completed steps of create_and_run_metadata_tables,
+# so a rerun after a crash or timeout skips what is already done.
+#
+# The journal is a jsonl file with one entry per completed step:
+#   {"metadata_table", "query_name", "step", "query_hash", "result", "created_at"}
+# Entries are appended and fsynced one at a time, so a crash loses at most the
+# entry being written, and a torn last line is ignored when the journal is read.
+# A step recorded with a query_hash is only done for that same query, so editing
+# a set_uuid_query reruns its update and counts.
+#
+# Usage:
+#   journal = ProgressJournal(PROGRESS_JOURNAL_FILE)
+#   if not journal.is_done(metadata_table, query_name, "update", query_hash):
+#       ...
+#       journal.record(metadata_table, query_name, "update", query_hash)
+#
+class ProgressJournal():
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple, Dict[str, Any]] = {}
+        self.num_skipped = 0
+        self.ends_with_torn_line = False
+        self.load()
+
+    def get_key(self, metadata_table: str, query_name: Optional[str], step: str) -> Tuple:
+        return (metadata_table, query_name, step)
+
+    # Reads all complete entries of the journal_file, later entries replace earlier ones
+    def load(self) -> None:
+        self.entries = {}
+        if not os.path.isfile(self.journal_file):
+            return
+        with open(self.journal_file) as f:
+            for line in f:
+                self.ends_with_torn_line = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[self.get_key(entry["metadata_table"], entry["query_name"], entry["step"])] = entry
+
+    # Appends the entry of a completed step to the journal_file
+    def record(self, metadata_table: str, query_name: Optional[str], step: str, query_hash: Optional[str]=None, result: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+        assert step in JOURNAL_STEPS, f"ERROR: invalid step: {step}"
+        entry = {
+            "metadata_table": metadata_table,
+            "query_name": query_name,
+            "step": step,
+            "query_hash": query_hash,
+            "result": result,
+            "created_at": time.time(),
+        }
+        with self.lock:
+            with open(self.journal_file, "a") as f:
+                # start a new line after a torn last line left by a crash
+                f.write(("\n" if self.ends_with_torn_line else "") + json.dumps(entry) + "\n")
+                self.ends_with_torn_line = False
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[self.get_key(metadata_table, query_name, step)] = entry
+        return entry
+
+    # Returns the entry of a completed step, or None if the step is not done
+    # or was done for a different query_hash
+    def get_entry(self, metadata_table: str, query_name: Optional[str], step: str, query_hash: Optional[str]=None) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(self.get_key(metadata_table, query_name, step))
+        if entry is None or (query_hash is not None and entry["query_hash"] != query_hash):
+            return None
+        return entry
+
+    # Returns True if the step is done and counts it as skipped
+    def is_done(self, metadata_table: str, query_name: Optional[str], step: str, query_hash: Optional[str]=None) -> bool:
+        if self.get_entry(metadata_table, query_name, step, query_hash) is None:
+            return False
+        with self.lock:
+            self.num_skipped += 1
+        return True
+
+    # Returns the result recorded with a completed step or None
+    def get_result(self, metadata_table: str, query_name: Optional[str], step: str, query_hash: Optional[str]=None) -> Optional[Dict[str, Any]]:
+        entry = self.get_entry(metadata_table, query_name, step, query_hash)
+        return None if entry is None else entry["result"]
+
+    # Returns the metadata_tables with at least one completed step
+    def get_metadata_tables(self) -> List[str]:
+        with self.lock:
+            return sorted(set([x[0] for x in self.entries]))
+
+    # Removes the journal_file so the next run starts over
+    def reset(self) -> None:
+        with self.lock:
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+            self.entries = {}
+            self.num_skipped = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "journal_file": self.journal_file,
+                "num_entries": len(self.entries),
+                "num_skipped": self.num_skipped,
+            }
+
+
+################################################
+# Tests
+################################################
+
+def test_record_resume_and_torn_line():
+    journal_file = f"/tmp/progress_journal_test-{time.time()}.jsonl"
+    journal = ProgressJournal(journal_file)
+    query_hash = get_query_hash("UPDATE T SET X = 1")
+    journal.record("T", None, "clone")
+    journal.record("T", "user_id_query", "update", query_hash)
+    journal.record("T", "user_id_query", "counts", query_hash, result={"total": 10, "non_null": 7})
+    with open(journal_file, "a") as f:
+        f.write('{"metadata_table": "T", "query_na')
+
+    resumed = ProgressJournal(journal_file)
+    assert resumed.is_done("T", None, "clone"), "ERROR: clone not resumed"
+    assert resumed.is_done("T", "user_id_query", "update", query_hash), "ERROR: update not resumed"
+    assert not resumed.is_done("T", "user_id_query", "update", get_query_hash("UPDATE T SET X = 2")), "ERROR: changed query resumed"
+    assert not resumed.is_done("T", "user_id_query", "add_column"), "ERROR: unexpected add_column"
+    assert resumed.get_result("T", "user_id_query", "counts", query_hash) == {"total": 10, "non_null": 7}, "ERROR: unexpected counts"
+    resumed.record("T", "user_id_query", "add_column")
+    assert ProgressJournal(journal_file).is_done("T", "user_id_query", "add_column"), "ERROR: entry after torn line lost"
+    assert resumed.get_stats()["num_entries"] == 4 and resumed.get_stats()["num_skipped"] == 2, f"ERROR: unexpected stats {resumed.get_stats()}"
+    resumed.reset()
+    assert not os.path.isfile(journal_file) and resumed.get_metadata_tables() == [], "ERROR: journal not reset"
+
+def tests():
+    test_record_resume_and_torn_line()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,76 @@
+from __future__ import annotations
 import sys
-import pandas as pd
-import snowflake.connector as connector
-from snowflake.connector import ProgrammingError
+import time
+import atexit
+import threading
 from constants import *   
 from timefunc import timefunc
-from typing import List, Any, Optional
+from connection_pool import ConnectionPool
+from metrics import query_kind, record_query
+from tracing import get_tracer, span
+from utils import estimate_rows_bytes, LazyModule
+from adaptive_batch_sizer import AdaptiveBatchSizer
+from batch_prefetcher import BatchPrefetcher
+from sql_builder import build_query, build_placeholders, build_information_schema_tables_query, get_statement_key, get_result_reuse_tracker
 
+# heavy dependencies are imported on first use, so importing query_generator
+# for clean_query or the connection pool does not load pandas or the connector
+pd = LazyModule("pandas")
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+connector = LazyModule("snowflake.connector")
+fake_connector = LazyModule("fake_connector")
+streaming_dedupe = LazyModule("streaming_dedupe")
+parquet_sink = LazyModule("parquet_sink")
+data_frame_utils = LazyModule("data_frame_utils")
+result_cache_module = LazyModule("result_cache")
+from typing import List, Any, Optional, Dict, Callable, Union
+
+# Returns a new Snowflake connection, or a fake_connector.FakeConnection
+# on FAKE_CONNECTOR_DB if that is set
 def create_connector(verbose: bool=True):
+    if FAKE_CONNECTOR_DB:
+        if verbose:
+            print(f"new fake connector: {FAKE_CONNECTOR_DB}")
+        return fake_connector.connect_fake(FAKE_CONNECTOR_DB)
+
     conn = connector.connect(
-        user=USER_NAME,
-        password=USER_PSWD,
-        account=ACCOUNT,
-        warehouse=WAREHOUSE,
-        database=DATABASE,
-        schema=SCHEMA,
+        user=settings.USER_NAME,
+        password=settings.USER_PSWD,
+        account=settings.ACCOUNT,
+        warehouse=settings.WAREHOUSE,
+        database=settings.DATABASE,
+        schema=settings.SCHEMA,
         protocol='https',
-        port=PORT)
+        port=settings.PORT,
+        # bind ? parameters on the server so bound queries keep one statement text
+        paramstyle='qmark')
 
     if verbose:
-        print(f"new connector: {WAREHOUSE} {DATABASE} {SCHEMA}")
+        print(f"new connector: {settings.WAREHOUSE} {settings.DATABASE} {settings.SCHEMA}")
 
     return conn
 
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+# Returns the process-wide ConnectionPool that all helpers borrow from
+# when called without conn. The pool is created on first use and sized
+# by POOL_MAX_SIZE, POOL_MAX_IDLE_SECONDS, POOL_HEALTH_CHECK_SECONDS and
+# POOL_ACQUIRE_TIMEOUT_SECONDS
+def get_connection_pool() -> ConnectionPool:
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(
+                lambda: create_connector(verbose=False),
+                max_size=POOL_MAX_SIZE,
+                max_idle_seconds=POOL_MAX_IDLE_SECONDS,
+                health_check_seconds=POOL_HEALTH_CHECK_SECONDS,
+                acquire_timeout_seconds=POOL_ACQUIRE_TIMEOUT_SECONDS)
+            atexit.register(_connection_pool.close_all)
+        return _connection_pool
+
 def clean_query(query: str) -> str:
     # strip external white-spaces and replace multiple 
     # internal white-spaces with single white-space
@@ -34,6 +83,18 @@ def clean_query(query: str) -> str:
 # 4. continues fetching batches until all rows are processed
 # throws StopIteration when all rows have been fetched without error
 # prints timeout error when query execution exceeds timeout_seconds
+# borrows a connection from get_connection_pool() if conn is None
+# or opens and closes a new connection if use_pool is False
+# yields pyarrow.Table result batches sized by the server instead of
+# lists of row tuples if fetch_arrow is True (batch_size is then ignored)
+# records the latency, rows, batches, bytes and status of each query
+# by query_kind in metrics.get_metrics_registry()
+# and as a "query" span with its sfqid in tracing.get_tracer()
+# sizes each fetchmany with batch_sizer instead of batch_size if given,
+# see adaptive_batch_sizer.AdaptiveBatchSizer for the chosen sizes
+# raises ProgrammingError instead of printing it if raise_errors is True
+# binds params to the ? placeholders of query (see sql_builder.build_query)
+# and records the statement in sql_builder.get_result_reuse_tracker()
 #
 # Usage: see test_list_columns() function below
 #  
@@ -42,56 +103,112 @@ def query_batch_generator(
     conn: connector=None, 
     batch_size: int=DEFAULT_BATCH_SIZE, 
     timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, 
-    verbose: bool=False):
+    verbose: bool=False,
+    use_pool: bool=True,
+    fetch_arrow: bool=False,
+    raise_errors: bool=False,
+    batch_sizer: Optional[AdaptiveBatchSizer]=None,
+    params: Optional[List[Any]]=None):
+    cur = None
+    pool = None
+    close_conn = False
+    start = time.perf_counter()
+    status = "ok"
+    num_batches = 0
+    total_rows = 0
+    total_bytes = 0
+    kind = query_kind(query)
+    query_span = get_tracer().start_span("query", cat="query", kind=kind, query=(query or "")[:200])
     try:
-        close_conn = False
         if conn is None:
-            conn = create_connector()
-            close_conn = True
+            if use_pool:
+                pool = get_connection_pool()
+                conn = pool.acquire()
+            else:
+                conn = create_connector()
+                close_conn = True
         cur = conn.cursor()
         
         assert query is not None, "ERROR: undefined query"
         
-        cur.execute(query, timeout=timeout_seconds)
+        cur.execute(query, params, timeout=timeout_seconds)
+        query_span.set(sfqid=cur.sfqid)
+        get_result_reuse_tracker().record(query, params, cur.sfqid)
         
-        num_batches = 0
-        total_rows = 0
-        while True:
-            batch_rows = cur.fetchmany(batch_size)
-            num_batch_rows = len(batch_rows)
-            if num_batch_rows == 0:
-                break
-            
-            yield batch_rows
-            
-            total_rows += num_batch_rows
-            num_batches += 1
+        if fetch_arrow:
+            for batch_table in cur.fetch_arrow_batches():
+                num_batch_rows = batch_table.num_rows
+                if num_batch_rows == 0:
+                    continue
+
+                total_rows += num_batch_rows
+                num_batches += 1
+                total_bytes += batch_table.nbytes
+
+                yield batch_table
+        else:
+            while True:
+                fetch_size = batch_size if batch_sizer is None else batch_sizer.next_size()
+                fetch_start = time.perf_counter()
+                batch_rows = cur.fetchmany(fetch_size)
+                num_batch_rows = len(batch_rows)
+                if num_batch_rows == 0:
+                    break
+                
+                total_rows += num_batch_rows
+                num_batches += 1
+                num_batch_bytes = estimate_rows_bytes(batch_rows)
+                total_bytes += num_batch_bytes
+                if batch_sizer is not None:
+                    batch_sizer.update(num_batch_rows, num_batch_bytes, time.perf_counter() - fetch_start)
+
+                yield batch_rows
         
         if verbose:
             print(f"yielded {total_rows} total_rows in {num_batches} batches")
 
-    except ProgrammingError as err:
+    except connector.ProgrammingError as err:
         if err.errno == 604:
+            status = "timeout"
             print(timeout_seconds, "second timeout for query:\n", query)
         else:
+            status = "error"
             print(f"Error: {type(err)} {str(err)}")
+        if raise_errors:
+            raise
+    except Exception:
+        status = "error"
+        raise
     finally:
-        cur.close()
-        if close_conn:
+        record_query(kind, status, time.perf_counter() - start, total_rows, num_batches, total_bytes)
+        query_span.set(status=status, rows=total_rows, batches=num_batches)
+        if batch_sizer is not None:
+            query_span.set(batch_size=batch_sizer.next_size())
+        query_span.end()
+        if cur is not None:
+            cur.close()
+        if pool is not None:
+            pool.release(conn)
+        elif close_conn:
             conn.close()
 
 # Use this to execute queries with no processed result rows
 # like create, clone, alter, drop
+# Returns StopIteration if the query succeeded. With raise_errors a failed
+# query returns its ProgrammingError instead, otherwise failures also
+# return StopIteration since query_batch_generator only prints them.
 def execute_single_query(
     single_query: str, 
     conn: connector=None, 
     timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, 
-    verbose: bool=False) -> Optional[Any]:
+    verbose: bool=False,
+    raise_errors: bool=False,
+    params: Optional[List[Any]]=None) -> Optional[Any]:
     exc = None
     single_query = clean_query(single_query)
     if verbose:
         print(f"execute_single_query:\n{single_query};")
-    query_batch_iterator = query_batch_generator(single_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose)
+    query_batch_iterator = query_batch_generator(single_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose, raise_errors=raise_errors, params=params)
     while True:
         try:
             next(query_batch_iterator)
@@ -100,16 +217,82 @@ def execute_single_query(
             break
     return exc
 
+# Returns the LAST_ALTERED version of each DATABASE.SCHEMA.TABLE in tables
+# or None if any of them is not found in its database's INFORMATION_SCHEMA.TABLES
+def fetch_table_versions(tables: List[str], conn: connector=None, timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS) -> Optional[Dict[str,str]]:
+    schema_tables_by_database = {}
+    for table in tables:
+        database, schema, table_name = table.upper().split(".")
+        schema_tables_by_database.setdefault(database, []).append(f"{schema}.{table_name}")
+    versions = {}
+    for database, schema_tables in schema_tables_by_database.items():
+        [query, params] = build_information_schema_tables_query(f"{database}.INFORMATION_SCHEMA", ["TABLE_SCHEMA", "TABLE_NAME", "LAST_ALTERED"], schema_tables)
+        for batch_rows in query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1000, params=params):
+            for result_row in batch_rows:
+                last_altered = result_row[2]
+                versions[f"{database}.{result_row[0]}.{result_row[1]}"] = last_altered.isoformat() if hasattr(last_altered, "isoformat") else str(last_altered)
+    return versions if len(versions) == len(tables) else None
+
+# Returns the stats of sql_builder.get_result_reuse_tracker() with num_zero_scan_repeats,
+# the number of repeated statements that scanned no bytes in INFORMATION_SCHEMA.QUERY_HISTORY.
+# Metadata-only statements are not tracked, so these are the repeats served from the
+# warehouse result cache. It stays None if the query history can not be read.
+def fetch_result_reuse_stats(conn: connector=None, timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, chunk_size: int=1000) -> Dict[str, Any]:
+    tracker = get_result_reuse_tracker()
+    repeat_sfqids = tracker.get_repeat_sfqids()
+    num_zero_scan_repeats = 0
+    try:
+        for i in range(0, len(repeat_sfqids), chunk_size):
+            sfqids = repeat_sfqids[i:i+chunk_size]
+            [query, params] = build_query(f"SELECT QUERY_ID, BYTES_SCANNED FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY(RESULT_LIMIT => 10000)) WHERE QUERY_ID IN ({build_placeholders(len(sfqids))})", sfqids)
+            for batch_rows in query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, batch_size=chunk_size, raise_errors=True, params=params):
+                num_zero_scan_repeats += len([x for x in batch_rows if x[1] == 0])
+        tracker.set_num_zero_scan_repeats(num_zero_scan_repeats)
+    except connector.ProgrammingError:
+        pass
+    return tracker.get_stats()
+
+# Returns the result rows of query from result_cache if the LAST_ALTERED versions
+# of all tables referenced by query are unchanged, otherwise returns fetch_rows()
+# and stores its rows. Empty results are never stored since the helpers also
+# return no rows when a query fails. The params of query are part of its key.
+def execute_cached_query(query: str, fetch_rows: Callable[[], List[Any]], result_cache: result_cache_module.ResultCache, conn: connector=None, params: Optional[List[Any]]=None) -> List[Any]:
+    query = clean_query(query)
+    if not result_cache_module.is_cacheable_query(query):
+        result_cache.bypass()
+        return fetch_rows()
+    table_versions = fetch_table_versions(result_cache_module.extract_referenced_tables(query), conn=conn)
+    if table_versions is None:
+        result_cache.bypass()
+        return fetch_rows()
+    if params is not None and len(params) > 0:
+        query = get_statement_key(query, params)
+    result_rows = result_cache.get(query, table_versions)
+    if result_rows is None:
+        result_rows = fetch_rows()
+        if len(result_rows) > 0:
+            result_cache.put(query, table_versions, result_rows)
+    return result_rows
+
 # Use this to execute a query and get all result rows at once
+# Pass a result_cache (e.g. result_cache.get_result_cache()) to reuse results across sessions
+# Pass params to bind to the ? placeholders of query
+# Raises ProgrammingError instead of returning the rows fetched so far if raise_errors is True
 def execute_simple_query(
     query: str, 
     conn: connector=None, 
     timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, 
-    verbose: bool=False) -> List[Any]:
+    verbose: bool=False,
+    result_cache: Optional[result_cache_module.ResultCache]=None,
+    params: Optional[List[Any]]=None,
+    raise_errors: bool=False) -> List[Any]:
 
+    if result_cache is not None:
+        fetch_rows = lambda: execute_simple_query(query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose, params=params, raise_errors=raise_errors)
+        return execute_cached_query(query, fetch_rows, result_cache, conn=conn, params=params)
     if verbose:
         print(f"execute_simple_query:\n{query};")
-    query_batch_iterator = query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1000, verbose=verbose)
+    query_batch_iterator = query_batch_generator(query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1000, verbose=verbose, params=params, raise_errors=raise_errors)
     result_rows = []
     while True:
         try:
@@ -120,30 +303,54 @@ def execute_simple_query(
             break
     return result_rows
 
+# Pass a result_cache (e.g. result_cache.get_result_cache()) to reuse counts across sessions
+# Pass params to bind to the ? placeholders of count_query
+# Raises ProgrammingError instead of returning a count of 0 if raise_errors is True
 def execute_count_query(
     count_query: str, 
     conn: connector=None, 
     timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, 
-    verbose: bool=False) -> int:
+    verbose: bool=False,
+    result_cache: Optional[result_cache_module.ResultCache]=None,
+    params: Optional[List[Any]]=None,
+    raise_errors: bool=False) -> int:
 
     count = 0
     if verbose:
         print(f"execute_count_query.count_query:\n{clean_query(count_query)};")
         
-    query_batch_iterator = query_batch_generator(count_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose)
-    while True:
-        try:
-            batch_rows = next(query_batch_iterator)
-            for result_row in batch_rows:
-                count = result_row[0]
-        except StopIteration:
-            break
+    if result_cache is not None:
+        fetch_rows = lambda: execute_simple_query(count_query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose, params=params, raise_errors=raise_errors)
+        for result_row in execute_cached_query(count_query, fetch_rows, result_cache, conn=conn, params=params):
+            count = result_row[0]
+    else:
+        query_batch_iterator = query_batch_generator(count_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=1, verbose=verbose, params=params, raise_errors=raise_errors)
+        while True:
+            try:
+                batch_rows = next(query_batch_iterator)
+                for result_row in batch_rows:
+                    count = result_row[0]
+            except StopIteration:
+                break
     if verbose:
         print(f"execute_count_query.count_query:\n{count_query};")
         print(f"execute_count_query.count:\n{count:,};")
 
     return count
 
+# Returns a data_frame with select_columns of all distinct rows of select_query.
+# Batches are collected in a list and assembled once at the end, so the
+# total cost stays linear in the number of rows.
+# If use_arrow is True the connector's Arrow result batches are collected
+# as pyarrow tables and converted to pandas once with minimal copying.
+# Duplicate rows (or rows with duplicate dedupe_key_columns) are dropped
+# across batches as they stream in. Pass a deduper to read its stats afterwards.
+# Pass a batch_sizer to size the row batches adaptively instead of by batch_size.
+# If prefetch_batches > 0 up to that many batches are fetched on a background
+# thread while the previous ones are converted, see batch_prefetcher.BatchPrefetcher.
+# Pass params to bind to the ? placeholders of select_query.
+# A failed query raises ProgrammingError if raise_errors is True or batches are
+# prefetched, otherwise the rows fetched before the failure are returned.
 def execute_batched_select_query(
     select_query: str, 
     select_columns: List[str], 
@@ -152,31 +359,249 @@ def execute_batched_select_query(
     batch_size: int=DEFAULT_BATCH_SIZE, 
     batch_dot_frequency: int=100,
     batch_dot: str='.',
-    verbose: bool=True) -> pd.DataFrame:
+    verbose: bool=True,
+    use_arrow: bool=False,
+    dedupe_key_columns: Optional[List[str]]=None,
+    deduper: Optional[streaming_dedupe.StreamingDeduper]=None,
+    batch_sizer: Optional[AdaptiveBatchSizer]=None,
+    prefetch_batches: int=0,
+    params: Optional[List[Any]]=None,
+    raise_errors: bool=False) -> pd.DataFrame:
     
     if verbose:
         print(f"execute_batched_select_query.select_query:\n{clean_query(select_query)};")
         print(f"execute_batched_select_query.select_columns:\n{select_columns}")
     
-    union_df = pd.DataFrame(columns=select_columns)
-    query_batch_iterator = query_batch_generator(select_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=batch_size, verbose=verbose)
+    if deduper is None:
+        deduper = streaming_dedupe.StreamingDeduper.for_columns(select_columns, key_columns=dedupe_key_columns)
+    batches = []
+    raise_errors = raise_errors or prefetch_batches > 0
+    query_batch_iterator = query_batch_generator(select_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=batch_size, verbose=verbose, fetch_arrow=use_arrow, raise_errors=raise_errors, batch_sizer=batch_sizer, params=params)
+    if prefetch_batches > 0:
+        query_batch_iterator = iter(BatchPrefetcher(query_batch_iterator, max_prefetch=prefetch_batches))
     num_batches = 0
     while True:
         try:
-            batch_rows = next(query_batch_iterator)
-            batch_df = pd.DataFrame(columns=select_columns, data=batch_rows)
-            batch_df = batch_df.drop_duplicates(keep="first")
-            union_df = pd.concat([union_df, batch_df], axis=0)
+            batch = next(query_batch_iterator)
+            if use_arrow:
+                batches.append(deduper.filter_arrow_table(batch))
+            else:
+                batch_rows = deduper.filter_rows(batch)
+                batches.append(pd.DataFrame(columns=select_columns, data=batch_rows))
             num_batches += 1
             if batch_dot_frequency is not None and batch_dot_frequency>0 and batch_dot is not None and num_batches % batch_dot_frequency == 0:
                 sys.stdout.write(batch_dot)
-                sys.stdout.flush
+                sys.stdout.flush()
                 
         except StopIteration:
             break
-    union_df = union_df.drop_duplicates(keep="first")
+
+    if verbose:
+        print(f"execute_batched_select_query.deduper:\n{deduper.get_stats()}")
+        if batch_sizer is not None:
+            print(f"execute_batched_select_query.batch_sizer:\n{batch_sizer.get_stats()}")
+    if len(batches) == 0:
+        return pd.DataFrame(columns=select_columns)
+    if use_arrow:
+        # concat_tables only references the existing record batches
+        union_table = pa.concat_tables(batches).rename_columns(select_columns)
+        batches = []
+        union_df = union_table.to_pandas(split_blocks=True, self_destruct=True)
+    else:
+        union_df = pd.concat(batches, axis=0, ignore_index=True)
     return union_df
 
+# Streams the result of select_query to Parquet instead of returning a data_frame,
+# so results larger than memory are extracted in constant memory.
+# Writes a single data_file at path, or part files under the path directory
+# if max_rows_per_file or partition_columns are given (see parquet_sink.ParquetSink).
+# Returns the sink stats including path, data_files and num_rows, and the status
+# "ok", or "timeout" or "error" if the query failed after the rows written so far.
+# Only if dedupe_key_columns are given, rows with duplicate dedupe_key_columns are
+# dropped, which keeps one digest per distinct key in memory. Unlike
+# execute_batched_select_query all rows are kept by default.
+# A batch_sizer sizes the row batches when use_arrow is False, its stats are added too.
+# If prefetch_batches > 0 batches are fetched on a background thread while
+# the previous ones are written, like in execute_batched_select_query.
+# A failed query raises ProgrammingError after closing the sink if raise_errors
+# is True or batches are prefetched.
+def execute_streaming_select_query(
+    select_query: str,
+    select_columns: List[str],
+    path: str,
+    conn: connector=None,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    batch_size: int=DEFAULT_BATCH_SIZE,
+    verbose: bool=True,
+    use_arrow: bool=True,
+    row_group_size: int=DEFAULT_ROW_GROUP_SIZE,
+    max_rows_per_file: Optional[int]=None,
+    partition_columns: Optional[List[str]]=None,
+    dedupe_key_columns: Optional[List[str]]=None,
+    batch_sizer: Optional[AdaptiveBatchSizer]=None,
+    prefetch_batches: int=0,
+    raise_errors: bool=False) -> Dict[str, Any]:
+
+    if verbose:
+        print(f"execute_streaming_select_query.select_query:\n{clean_query(select_query)};")
+        print(f"execute_streaming_select_query.path:\n{path}")
+
+    deduper = None
+    if dedupe_key_columns is not None:
+        deduper = streaming_dedupe.StreamingDeduper.for_columns(select_columns, key_columns=dedupe_key_columns)
+    sink = parquet_sink.ParquetSink(path, select_columns, row_group_size=row_group_size, max_rows_per_file=max_rows_per_file, partition_columns=partition_columns)
+    raise_errors = raise_errors or prefetch_batches > 0
+    # errors are always raised here, so a failed query is not reported as ok
+    query_batch_iterator = query_batch_generator(select_query, conn=conn, timeout_seconds=timeout_seconds, batch_size=batch_size, verbose=verbose, fetch_arrow=use_arrow, raise_errors=True, batch_sizer=batch_sizer)
+    if prefetch_batches > 0:
+        query_batch_iterator = iter(BatchPrefetcher(query_batch_iterator, max_prefetch=prefetch_batches))
+    if deduper is not None:
+        query_batch_iterator = streaming_dedupe.dedupe_batch_generator(query_batch_iterator, deduper)
+    status = "ok"
+    try:
+        for batch in query_batch_iterator:
+            sink.write_batch(batch)
+    except connector.ProgrammingError as err:
+        status = "timeout" if err.errno == 604 else "error"
+        if raise_errors:
+            sink.close()
+            raise
+    stats = sink.close()
+    stats["status"] = status
+    if deduper is not None:
+        stats["deduper"] = deduper.get_stats()
+    if batch_sizer is not None:
+        stats["batch_sizer"] = batch_sizer.get_stats()
+
+    if verbose:
+        print(f"execute_streaming_select_query.stats:\n{stats}")
+    return stats
+
+# Returns a MERGE query that upserts all rows of staging_table into target_table
+# by key_columns, updating the other columns of matched rows and inserting
+# unmatched rows if insert_missing is True. A MERGE needs at least one WHEN
+# clause, so columns other than key_columns are required if insert_missing is False.
+def build_bulk_merge_query(target_table: str, staging_table: str, columns: List[str], key_columns: List[str], insert_missing: bool=True) -> str:
+    assert len(key_columns) > 0, "ERROR: undefined key_columns"
+    missing_key_columns = [x for x in key_columns if x not in columns]
+    assert len(missing_key_columns) == 0, f"ERROR: key_columns {missing_key_columns} not in columns"
+    on_str = " AND ".join([f"t.{x} = s.{x}" for x in key_columns])
+    update_columns = [x for x in columns if x not in key_columns]
+    assert len(update_columns) > 0 or insert_missing, f"ERROR: nothing to update or insert into {target_table}"
+    merge_query = f"MERGE INTO {target_table} t USING {staging_table} s ON {on_str}"
+    if len(update_columns) > 0:
+        set_str = ", ".join([f"t.{x} = s.{x}" for x in update_columns])
+        merge_query += f" WHEN MATCHED THEN UPDATE SET {set_str}"
+    if insert_missing:
+        columns_str = ", ".join(columns)
+        values_str = ", ".join([f"s.{x}" for x in columns])
+        merge_query += f" WHEN NOT MATCHED THEN INSERT ({columns_str}) VALUES ({values_str})"
+    return merge_query
+
+# Loads a data_frame (or an existing parquet data_file) into target_table
+# DATABASE.SCHEMA.TABLE with a single bulk statement instead of row-wise UPDATEs.
+#
+# The data is written to a local parquet file, PUT to a temporary stage and
+# loaded with COPY INTO ... MATCH_BY_COLUMN_NAME, so its column names must
+# match columns of target_table. Without key_columns the rows are appended.
+# With key_columns the rows are copied into a temporary staging table and
+# upserted with one MERGE (see build_bulk_merge_query). Rows of a data_frame
+# with duplicate key_columns are dropped, keeping the last one, since MERGE
+# fails on duplicate source keys; a parquet data_file must not have any.
+#
+# All statements run on one session since temporary stages and tables are
+# session scoped, borrowed from the connection pool if conn is None.
+# Returns the load stats:
+#   target_table, mode ("append" or "upsert"), status ("ok" or "error"),
+#   rows_loaded (0 unless the status is "ok"), rows_inserted, rows_updated, seconds
+def bulk_load_data_frame(
+    data: Union[pd.DataFrame, str],
+    target_table: str,
+    key_columns: Optional[List[str]]=None,
+    conn: connector=None,
+    insert_missing: bool=True,
+    timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS,
+    verbose: bool=True) -> Dict[str, Any]:
+
+    start = time.perf_counter()
+    mode = "append" if key_columns is None or len(key_columns) == 0 else "upsert"
+    stats = {
+        "target_table": target_table,
+        "mode": mode,
+        "status": "error",
+        "rows_loaded": 0,
+        "rows_inserted": 0,
+        "rows_updated": 0,
+        "seconds": 0.0,
+    }
+    if conn is None:
+        with get_connection_pool().connection() as pool_conn:
+            return bulk_load_data_frame(data, target_table, key_columns=key_columns, conn=pool_conn,
+                insert_missing=insert_missing, timeout_seconds=timeout_seconds, verbose=verbose)
+
+    database, schema, _ = target_table.upper().split(".")
+    suffix = f"{os.getpid()}_{time.time_ns()}"
+    stage = f"{database}.{schema}.BULK_LOAD_STAGE_{suffix}"
+    staging_table = f"{database}.{schema}.BULK_LOAD_STAGING_{suffix}"
+    data_file = None
+    if isinstance(data, pd.DataFrame):
+        if mode == "upsert":
+            data = data.drop_duplicates(subset=key_columns, keep="last")
+        data_file = f"/tmp/bulk_load-{suffix}.parquet"
+        data_frame_utils.write_parquet_file(data, data_file)
+        columns = [str(x).upper() for x in data.columns]
+    else:
+        columns = [x.upper() for x in pq.read_schema(data).names]
+
+    # each step returns result rows, which are empty if the statement failed
+    def run_step(step: str, query: str) -> List[Any]:
+        result_rows = execute_simple_query(query, conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+        if len(result_rows) == 0:
+            print(f"ERROR: bulk_load_data_frame {step} failed for {target_table}")
+        return result_rows
+
+    with span("bulk_load_data_frame", target_table=target_table, mode=mode) as s:
+        try:
+            copy_table = target_table if mode == "append" else staging_table
+            copy_rows = []
+            ok = len(run_step("create stage", f"CREATE TEMPORARY STAGE {stage} FILE_FORMAT = (TYPE = PARQUET)")) > 0
+            ok = ok and len(run_step("put", f"PUT 'file://{data_file or data}' @{stage} AUTO_COMPRESS = FALSE OVERWRITE = TRUE")) > 0
+            if ok and mode == "upsert":
+                columns_str = ", ".join(columns)
+                ok = len(run_step("create staging table", f"CREATE TEMPORARY TABLE {staging_table} AS SELECT {columns_str} FROM {target_table} WHERE 1 = 0")) > 0
+            if ok:
+                copy_rows = run_step("copy", f"COPY INTO {copy_table} FROM @{stage} FILE_FORMAT = (TYPE = PARQUET) MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE PURGE = TRUE")
+                ok = len(copy_rows) > 0
+            # a COPY without files to load returns a single status column
+            num_copied = sum([x[3] for x in copy_rows if len(x) > 3])
+            if ok and mode == "append":
+                stats["rows_inserted"] = num_copied
+            elif ok:
+                merge_query = build_bulk_merge_query(target_table, staging_table, columns, [x.upper() for x in key_columns], insert_missing=insert_missing)
+                merge_rows = run_step("merge", merge_query)
+                ok = len(merge_rows) > 0
+                if ok:
+                    # the merge result has one count per WHEN clause: inserted, then updated
+                    counts = list(merge_rows[0])
+                    if insert_missing:
+                        stats["rows_inserted"] = counts.pop(0)
+                    if len(counts) > 0:
+                        stats["rows_updated"] = counts[0]
+            stats["status"] = "ok" if ok else "error"
+            stats["rows_loaded"] = num_copied if ok else 0
+        finally:
+            if mode == "upsert":
+                execute_single_query(f"DROP TABLE IF EXISTS {staging_table}", conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+            execute_single_query(f"DROP STAGE IF EXISTS {stage}", conn=conn, timeout_seconds=timeout_seconds, verbose=verbose)
+            if data_file is not None and os.path.exists(data_file):
+                os.remove(data_file)
+            stats["seconds"] = time.perf_counter() - start
+        s.set(status=stats["status"], rows=stats["rows_loaded"])
+
+    if verbose:
+        print(f"bulk_load_data_frame.stats:\n{stats}")
+    return stats
+
 # Adds column if not exists and returns the result of execute_single_query
 def add_column_if_not_exists(schema:str, table:str, column:str, datatype:str, default_value:str, conn: connector=None, timeout_seconds: int=DEFAULT_TIMEOUT_SECONDS, verbose: bool=True) -> Optional[Any]:
     single_query = f"\
@@ -219,13 +644,165 @@ def test_list_columns_2():
     for row in list(df.values):
         print(row)
 
+@timefunc
+def test_list_columns_3():
+    conn = create_connector()
+    select_columns = ['TABLE_NAME', 'COLUMN_NAME']
+    select_query = "SELECT TABLE_NAME, COLUMN_NAME FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS LIMIT 10"
+    row_df = execute_batched_select_query(select_query, select_columns, conn=conn)
+    arrow_df = execute_batched_select_query(select_query, select_columns, conn=conn, use_arrow=True)
+    assert list(arrow_df.columns) == select_columns, f"ERROR: expected columns {select_columns} not {list(arrow_df.columns)}"
+    assert len(arrow_df) == len(row_df), f"ERROR: expected {len(row_df)} arrow rows not {len(arrow_df)}"
+
+def test_streaming_select_query():
+    conn = create_connector()
+    select_columns = ['TABLE_NAME', 'COLUMN_NAME']
+    select_query = "SELECT TABLE_NAME, COLUMN_NAME FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS LIMIT 10"
+    data_file = f"/tmp/streaming_select_query_test-{time.time()}.parquet"
+    stats = execute_streaming_select_query(select_query, select_columns, data_file, conn=conn)
+    df = pd.read_parquet(data_file)
+    os.remove(data_file)
+    assert list(df.columns) == select_columns, f"ERROR: expected columns {select_columns} not {list(df.columns)}"
+    assert len(df) == stats['num_rows'], f"ERROR: expected {stats['num_rows']} rows not {len(df)}"
+
+def test_streaming_select_query_status():
+    conn = fake_connector.connect_fake()
+    conn.load_rows("A.B.T", ["ID", "NAME"], [(i, f"name-{i % 10}") for i in range(100)])
+    data_file = f"/tmp/streaming_select_query_status_test-{time.time()}.parquet"
+    stats = execute_streaming_select_query("SELECT ID, NAME FROM A.B.T", ["ID", "NAME"], data_file, conn=conn, verbose=False)
+    assert stats["status"] == "ok" and stats["num_rows"] == 100, f"ERROR: unexpected stats {stats}"
+    os.remove(data_file)
+    slow_query = "WITH RECURSIVE R(X) AS (SELECT 1 UNION ALL SELECT X + 1 FROM R) SELECT X, X FROM R"
+    stats = execute_streaming_select_query(slow_query, ["ID", "NAME"], data_file, conn=conn, timeout_seconds=0.2, verbose=False)
+    assert stats["status"] == "timeout" and stats["num_rows"] == 0, f"ERROR: timeout reported as {stats}"
+    try:
+        execute_streaming_select_query(slow_query, ["ID", "NAME"], data_file, conn=conn, timeout_seconds=0.2, verbose=False, prefetch_batches=2)
+        assert False, "ERROR: prefetched timeout not raised"
+    except connector.ProgrammingError as err:
+        assert err.errno == 604, f"ERROR: expected errno 604 not {err.errno}"
+    for x in stats["data_files"]:
+        if os.path.exists(x):
+            os.remove(x)
+    conn.close()
+
+def test_build_bulk_merge_query():
+    merge_query = build_bulk_merge_query("A.B.T", "A.B.S", ["ID", "X", "Y"], ["ID"])
+    expected = "MERGE INTO A.B.T t USING A.B.S s ON t.ID = s.ID" \
+        " WHEN MATCHED THEN UPDATE SET t.X = s.X, t.Y = s.Y" \
+        " WHEN NOT MATCHED THEN INSERT (ID, X, Y) VALUES (s.ID, s.X, s.Y)"
+    assert merge_query == expected, f"ERROR: unexpected merge_query {merge_query}"
+    merge_query = build_bulk_merge_query("A.B.T", "A.B.S", ["ID", "X"], ["ID"], insert_missing=False)
+    assert merge_query == "MERGE INTO A.B.T t USING A.B.S s ON t.ID = s.ID WHEN MATCHED THEN UPDATE SET t.X = s.X", f"ERROR: unexpected merge_query {merge_query}"
+    try:
+        build_bulk_merge_query("A.B.T", "A.B.S", ["ID"], ["ID"], insert_missing=False)
+        assert False, "ERROR: MERGE without WHEN clauses built"
+    except AssertionError as err:
+        assert "nothing to update or insert" in str(err), f"ERROR: unexpected {err}"
+
+def test_adaptive_batch_sizes():
+    conn = fake_connector.connect_fake()
+    conn.load_rows("A.B.T", ["ID", "NAME"], [(i, f"name-{i}") for i in range(5000)])
+    batch_sizer = AdaptiveBatchSizer(initial_size=100, min_size=100, max_size=2000)
+    batch_sizes = [len(x) for x in query_batch_generator("SELECT ID, NAME FROM A.B.T", conn=conn, batch_sizer=batch_sizer)]
+    stats = batch_sizer.get_stats()
+    assert sum(batch_sizes) == 5000 and stats["num_rows"] == 5000, f"ERROR: unexpected rows {stats}"
+    assert batch_sizes[:2] == [100, 200] and stats["max_batch_size"] == 2000, f"ERROR: unexpected batch sizes {batch_sizes}"
+    conn.close()
+
+def test_prefetched_select_query():
+    conn = fake_connector.connect_fake()
+    conn.load_rows("A.B.T", ["ID", "NAME"], [(i, f"name-{i % 100}") for i in range(1000)])
+    select_query = "SELECT ID, NAME FROM A.B.T ORDER BY ID"
+    df = execute_batched_select_query(select_query, ["ID", "NAME"], conn=conn, batch_size=100, verbose=False, batch_dot=None)
+    prefetched_df = execute_batched_select_query(select_query, ["ID", "NAME"], conn=conn, batch_size=100, verbose=False, batch_dot=None, prefetch_batches=2)
+    assert df.equals(prefetched_df), f"ERROR: prefetched df\n{prefetched_df}\nnot\n{df}"
+    # a timeout is raised through the prefetcher instead of returning no rows
+    slow_query = "WITH RECURSIVE R(X) AS (SELECT 1 UNION ALL SELECT X + 1 FROM R) SELECT X, X FROM R"
+    try:
+        execute_batched_select_query(slow_query, ["ID", "NAME"], conn=conn, timeout_seconds=0.2, batch_size=100, verbose=False, batch_dot=None, prefetch_batches=2)
+        assert False, "ERROR: prefetched timeout not raised"
+    except connector.ProgrammingError as err:
+        assert err.errno == 604, f"ERROR: expected errno 604 not {err.errno}"
+    conn.close()
+
+def test_bulk_load_data_frame_append():
+    db_file = f"/tmp/bulk_load_test-{time.time()}.db"
+    conn = fake_connector.connect_fake(db_file)
+    execute_single_query("CREATE TABLE A.B.T (ID INTEGER, USER_ID VARCHAR)", conn=conn)
+    df = pd.DataFrame({"id": [1, 2, 3], "user_id": ["u1", None, "u3"]})
+    stats = bulk_load_data_frame(df, "A.B.T", conn=conn, verbose=False)
+    assert stats["status"] == "ok" and stats["rows_loaded"] == 3, f"ERROR: unexpected stats {stats}"
+    rows = execute_simple_query("SELECT ID, USER_ID FROM A.B.T ORDER BY ID", conn=conn)
+    assert rows == [(1, "u1"), (2, None), (3, "u3")], f"ERROR: unexpected rows {rows}"
+    assert len(conn.stages) == 0, "ERROR: stage not dropped"
+    conn.close()
+    os.remove(db_file)
+
+def test_bulk_load_data_frame_upsert():
+    db_file = f"/tmp/bulk_load_upsert_test-{time.time()}.db"
+    conn = fake_connector.connect_fake(db_file)
+    execute_single_query("CREATE TABLE A.B.T (ID INTEGER, USER_ID VARCHAR NOT NULL)", conn=conn)
+    execute_single_query("INSERT INTO A.B.T VALUES (1, 'u1'), (2, 'u2')", conn=conn)
+    # ID 2 is updated with its last duplicate, ID 3 is inserted
+    df = pd.DataFrame({"id": [2, 3, 2], "user_id": ["u2-old", "u3", "u2-new"]})
+    stats = bulk_load_data_frame(df, "A.B.T", key_columns=["id"], conn=conn, verbose=False)
+    assert stats["status"] == "ok" and stats["rows_loaded"] == 2, f"ERROR: unexpected stats {stats}"
+    assert stats["rows_inserted"] == 1 and stats["rows_updated"] == 1, f"ERROR: unexpected stats {stats}"
+    rows = execute_simple_query("SELECT ID, USER_ID FROM A.B.T ORDER BY ID", conn=conn)
+    assert rows == [(1, "u1"), (2, "u2-new"), (3, "u3")], f"ERROR: unexpected rows {rows}"
+    stats = bulk_load_data_frame(pd.DataFrame({"id": [1], "user_id": ["u1-new"]}), "A.B.T", key_columns=["id"], conn=conn, insert_missing=False, verbose=False)
+    assert stats["status"] == "ok" and stats["rows_inserted"] == 0 and stats["rows_updated"] == 1, f"ERROR: unexpected stats {stats}"
+    # the MERGE fails on the NOT NULL column, so nothing is loaded
+    stats = bulk_load_data_frame(pd.DataFrame({"id": [1, 4], "user_id": ["u1", None]}), "A.B.T", key_columns=["id"], conn=conn, verbose=False)
+    assert stats["status"] == "error" and stats["rows_loaded"] == 0, f"ERROR: unexpected stats {stats}"
+    rows = execute_simple_query("SELECT ID, USER_ID FROM A.B.T ORDER BY ID", conn=conn)
+    assert rows == [(1, "u1-new"), (2, "u2-new"), (3, "u3")], f"ERROR: failed merge changed rows {rows}"
+    assert len(conn.stages) == 0, "ERROR: stage not dropped"
+    conn.close()
+    os.remove(db_file)
+
+def test_bound_query_reuse():
+    conn = fake_connector.connect_fake()
+    conn.cursor().execute("CREATE TABLE A.B.C (X INTEGER)")
+    conn.cursor().execute("INSERT INTO A.B.C VALUES (1), (2), (2)")
+    tracker = get_result_reuse_tracker()
+    tracker.reset()
+    [query, params] = build_query("select count(*) from a.b.c where x = ?", [2])
+    assert execute_count_query(query, conn=conn, params=params) == 2, "ERROR: bound count"
+    assert execute_count_query("SELECT COUNT(*)  FROM A.B.C WHERE X=?;", conn=conn, params=[2]) == 2, "ERROR: bound count"
+    assert execute_simple_query(query, conn=conn, params=[1]) == [(1,)], "ERROR: bound select"
+    stats = tracker.get_stats()
+    assert stats["num_statements"] == 3 and stats["num_distinct"] == 2 and stats["num_repeats"] == 1, f"ERROR: unexpected stats {stats}"
+    # the fake has no QUERY_HISTORY
+    assert fetch_result_reuse_stats(conn=conn)["num_zero_scan_repeats"] is None, "ERROR: unexpected num_zero_scan_repeats"
+    tracker.reset()
+    conn.close()
+
 @timefunc
 def tests():
     
+    test_build_bulk_merge_query()
+
+    test_bulk_load_data_frame_append()
+
+    test_bulk_load_data_frame_upsert()
+
+    test_adaptive_batch_sizes()
+
+    test_prefetched_select_query()
+
+    test_streaming_select_query_status()
+
+    test_bound_query_reuse()
+    
     test_list_columns_2()
+
+    test_list_columns_3()
     
     test_list_columns_1()
 
+    test_streaming_select_query()
+
     print("all tests passed in", os.path.basename(__file__))
 
 def main():
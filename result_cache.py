@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from constants import *
+from data_frame_utils import rows_to_data_frame, data_frame_to_rows, write_parquet_file, read_parquet_file
+
+# Fully qualified DATABASE.SCHEMA.TABLE names that a query reads from
+REFERENCED_TABLE_PATTERN = re.compile(r"\b(?:FROM|JOIN|DESCRIBE\s+TABLE)\s+([A-Za-z0-9_$]+\.[A-Za-z0-9_$]+\.[A-Za-z0-9_$]+)\b", re.IGNORECASE)
+
+# Queries whose results change without any table change are never cached
+NON_DETERMINISTIC_PATTERN = re.compile(r"\b(CURRENT_\w+|RANDOM|UUID_STRING|SYSDATE|GETDATE|LOCALTIMESTAMP|SEQ\d)\b", re.IGNORECASE)
+
+# Returns the sorted upper-case DATABASE.SCHEMA.TABLE names referenced by query
+def extract_referenced_tables(query: str) -> List[str]:
+    return sorted(set([x.upper() for x in REFERENCED_TABLE_PATTERN.findall(query)]))
+
+# Returns True if the result of query only depends on the tables it references
+def is_cacheable_query(query: str) -> bool:
+    if NON_DETERMINISTIC_PATTERN.search(query) is not None:
+        return False
+    if "INFORMATION_SCHEMA" in query.upper():
+        return False
+    first_word = query.strip().split(" ")[0].upper()
+    if first_word not in ("SELECT", "WITH", "DESCRIBE"):
+        return False
+    return len(extract_referenced_tables(query)) > 0
+
+
+# An opt-in on-disk cache of query result rows.
+#
+# The key of a result is the normalized query text (see query_generator.clean_query)
+# plus the LAST_ALTERED version of each referenced table, so any change to a
+# referenced table makes old entries unreachable. Results are stored as parquet
+# files under cache_dir, described by an index.json file. When the cached files
+# exceed max_bytes the least recently used entries are evicted.
+#
+# Usage: see query_generator.execute_count_query(..., result_cache=get_result_cache())
+#
+class ResultCache():
+    def __init__(self, cache_dir: str=RESULT_CACHE_DIR, max_bytes: int=RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stored": 0,
+            "evicted": 0,
+            "invalidated": 0,
+        }
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.load_index()
+
+    # Returns the saved index, or an empty index if there is none or it is unreadable
+    def load_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Atomically replaces the saved index, must be called with self.lock held
+    def save_index(self) -> None:
+        tmp_file = f"{self.index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+
+    # Returns the cache key of query given the LAST_ALTERED versions of its tables
+    def get_key(self, query: str, table_versions: Dict[str, str]) -> str:
+        versions_str = "|".join([f"{x}={table_versions[x]}" for x in sorted(table_versions)])
+        return hashlib.sha256(f"{query}|{versions_str}".encode()).hexdigest()
+
+    # Counts a query that could not be served from or stored in the cache
+    def bypass(self) -> None:
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+    # Returns the cached rows of query or None on a miss
+    def get(self, query: str, table_versions: Dict[str, str]) -> Optional[List[Tuple]]:
+        key = self.get_key(query, table_versions)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            df = read_parquet_file(entry["file"])
+            if df is None:
+                # data_file was removed behind our back
+                del self.index[key]
+                self.save_index()
+                self.stats["misses"] += 1
+                return None
+            entry["last_access"] = time.time()
+            entry["hits"] += 1
+            self.save_index()
+            self.stats["hits"] += 1
+        return data_frame_to_rows(df)
+
+    # Stores the rows of query and evicts least recently used entries
+    # until the cache fits in max_bytes
+    def put(self, query: str, table_versions: Dict[str, str], rows: List[Tuple]) -> None:
+        key = self.get_key(query, table_versions)
+        data_file = os.path.join(self.cache_dir, f"{key}.parquet")
+        try:
+            num_bytes = write_parquet_file(rows_to_data_frame(rows), data_file)
+        except Exception as err:
+            # rows with values parquet can not store are simply not cached
+            print(f"result_cache: not caching query: {type(err)} {str(err)}")
+            self.bypass()
+            return
+        with self.lock:
+            self.index[key] = {
+                "file": data_file,
+                "bytes": num_bytes,
+                "query": query,
+                "tables": sorted(table_versions),
+                "last_access": time.time(),
+                "hits": 0,
+            }
+            self.stats["stored"] += 1
+            self.evict()
+            self.save_index()
+
+    # Removes the entry for key and its data_file, must be called with self.lock held
+    def remove(self, key: str) -> None:
+        entry = self.index.pop(key)
+        try:
+            os.remove(entry["file"])
+        except OSError:
+            pass
+
+    # Evicts least recently used entries until the cache fits in max_bytes,
+    # must be called with self.lock held
+    def evict(self) -> None:
+        total_bytes = sum([x["bytes"] for x in self.index.values()])
+        for key in sorted(self.index, key=lambda x: self.index[x]["last_access"]):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= self.index[key]["bytes"]
+            self.remove(key)
+            self.stats["evicted"] += 1
+
+    # Removes all entries of the given (whitespace normalized) query text, all entries that reference
+    # the given DATABASE.SCHEMA.TABLE, or all entries if both are None.
+    # Returns the number of removed entries.
+    def invalidate(self, query: Optional[str]=None, table: Optional[str]=None) -> int:
+        query = None if query is None else " ".join(query.split())
+        with self.lock:
+            keys = []
+            for key, entry in self.index.items():
+                if query is None and table is None:
+                    keys.append(key)
+                elif query is not None and entry["query"] == query:
+                    keys.append(key)
+                elif table is not None and table.upper() in entry["tables"]:
+                    keys.append(key)
+            for key in keys:
+                self.remove(key)
+            self.stats["invalidated"] += len(keys)
+            self.save_index()
+        return len(keys)
+
+    # Returns a copy of the cache counters with the current number of entries,
+    # their total bytes and the hit_ratio of all cacheable lookups
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.index)
+            stats["bytes"] = sum([x["bytes"] for x in self.index.values()])
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+# Returns the process-wide ResultCache under RESULT_CACHE_DIR limited to RESULT_CACHE_MAX_BYTES
+def get_result_cache() -> ResultCache:
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
+
+
+################################################
+# Tests
+################################################
+
+def test_extract_referenced_tables():
+    query = "SELECT count(*) from SEGMENT.IDENTIFIES_METADATA.T1 id JOIN stitch_landing.ellis_island.user ei ON id.user_id = ei.uuid"
+    tables = extract_referenced_tables(query)
+    assert tables == ['SEGMENT.IDENTIFIES_METADATA.T1', 'STITCH_LANDING.ELLIS_ISLAND.USER'], f"ERROR: unexpected tables {tables}"
+    assert is_cacheable_query(query), "ERROR: expected cacheable query"
+    assert not is_cacheable_query("SELECT current_timestamp() FROM A.B.C"), "ERROR: non-deterministic query cached"
+    assert not is_cacheable_query("UPDATE A.B.C SET X = 1"), "ERROR: update query cached"
+    assert not is_cacheable_query("SELECT * FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS"), "ERROR: information_schema query cached"
+
+def test_get_put_and_versions():
+    cache_dir = f"/tmp/result_cache_test-{time.time()}"
+    cache = ResultCache(cache_dir=cache_dir, max_bytes=10 * 1024 * 1024)
+    query = "SELECT count(*) from A.B.C"
+    assert cache.get(query, {'A.B.C': 'v1'}) is None, "ERROR: expected miss"
+    cache.put(query, {'A.B.C': 'v1'}, [(42,)])
+    assert cache.get(query, {'A.B.C': 'v1'}) == [(42,)], "ERROR: expected hit"
+    assert cache.get(query, {'A.B.C': 'v2'}) is None, "ERROR: stale version served"
+    reopened = ResultCache(cache_dir=cache_dir)
+    assert reopened.get(query, {'A.B.C': 'v1'}) == [(42,)], "ERROR: cache not persistent"
+    assert reopened.invalidate(table='a.b.c') == 1, "ERROR: invalidate by table failed"
+    assert reopened.get(query, {'A.B.C': 'v1'}) is None, "ERROR: invalidated entry served"
+    stats = cache.get_stats()
+    assert stats['hits'] == 1 and stats['misses'] == 2, f"ERROR: unexpected stats {stats}"
+    shutil.rmtree(cache_dir)
+
+def test_lru_eviction():
+    cache_dir = f"/tmp/result_cache_test-{time.time()}"
+    cache = ResultCache(cache_dir=cache_dir, max_bytes=10 * 1024 * 1024)
+    cache.put("SELECT 1 FROM A.B.C", {'A.B.C': 'v1'}, [(1,)])
+    entry_bytes = cache.get_stats()['bytes']
+    cache.max_bytes = 2 * entry_bytes
+    cache.put("SELECT 2 FROM A.B.C", {'A.B.C': 'v1'}, [(2,)])
+    cache.get("SELECT 1 FROM A.B.C", {'A.B.C': 'v1'})
+    cache.put("SELECT 3 FROM A.B.C", {'A.B.C': 'v1'}, [(3,)])
+    assert cache.get_stats()['evicted'] == 1, f"ERROR: expected 1 eviction {cache.get_stats()}"
+    assert cache.get("SELECT 2 FROM A.B.C", {'A.B.C': 'v1'}) is None, "ERROR: least recently used entry not evicted"
+    assert cache.get("SELECT 1 FROM A.B.C", {'A.B.C': 'v1'}) == [(1,)], "ERROR: recently used entry evicted"
+    shutil.rmtree(cache_dir)
+
+def tests():
+    test_extract_referenced_tables()
+    test_get_put_and_versions()
+    test_lru_eviction()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
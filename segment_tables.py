@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import pandas as pd
 from requests import get
 from constants import *   
@@ -7,10 +8,12 @@ from typing import Set, List, Dict, Optional, Tuple
 import snowflake.connector as connector
 from snowflake.connector import ProgrammingError
 from query_generator import query_batch_generator, create_connector, execute_batched_select_query
+from sql_builder import build_query
 from utils import matches_any, find_latest_file, is_readable_file
 from functools import cache
 import datetime
 from timefunc import timefunc
+from tracing import traced
 from segment_utils import get_segment_table_from_metadata_table, get_metadata_table_from_segment_table
 from pprint import pprint
 from data_frame_utils import save_data_frame, load_latest_data_frame, is_empty_data_frame
@@ -25,16 +28,39 @@ from pandas.testing import assert_frame_equal
 #     'columns': 'ID-RECEIVED_AT-USER_ID-SENT_AT-TIMESTAMP-EMAIL-ANONYMOUS_ID',
 # }
 
-def compute_segment_table_dicts_df(conn: connector=None, verbose: bool=True) -> pd.DataFrame:
-    segment_table_dicts = []
-        
-    segment_table_column_sets = {} 
-        
-    query = "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS"
+# Returns a where clause that keeps only TABLE_NAMEs matching SEARCH_SEGMENT_TABLES_SET
+# and not matching SEARCH_IGNORE_SEGMENT_TABLES_SET, so that information_schema
+# filtering happens in snowflake instead of in python
+def build_segment_table_name_filter(table_names: Optional[List[str]]=None) -> str:
+    include_clause = " OR ".join([f"CONTAINS(TABLE_NAME, '{x}')" for x in sorted(SEARCH_SEGMENT_TABLES_SET)])
+    exclude_clause = " AND ".join([f"NOT CONTAINS(TABLE_NAME, '{x}')" for x in sorted(SEARCH_IGNORE_SEGMENT_TABLES_SET)])
+    where_clause = f"({include_clause}) AND {exclude_clause}"
+    if table_names is not None:
+        table_names_str = ", ".join([f"'{x}'" for x in table_names])
+        where_clause = f"{where_clause} AND TABLE_NAME IN ({table_names_str})"
+    return where_clause
+
+# Returns the query of the TABLE_NAME, COLUMN_NAME, DATA_TYPE rows of all segment table
+# columns in ALL_SEARCH_COLUMNS, optionally restricted to the given table_names
+def build_segment_table_columns_query(table_names: Optional[List[str]]=None) -> str:
+    column_names_str = ", ".join([f"'{x}'" for x in sorted(ALL_SEARCH_COLUMNS)])
+    return f"SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS WHERE {build_segment_table_name_filter(table_names)} AND COLUMN_NAME IN ({column_names_str})"
+
+# Returns a dict of metadata_table to the set of its ALL_SEARCH_COLUMNS found in the
+# rows of build_segment_table_columns_query. The python filter is kept as a safety net.
+# Raises ProgrammingError instead of returning partial column sets if raise_errors is True.
+def fetch_segment_table_column_sets(
+    table_names: Optional[List[str]]=None,
+    conn: connector=None,
+    timeout_seconds: int=15,
+    verbose: bool=True,
+    raise_errors: bool=False) -> Dict[str, Set[str]]:
+    metadata_table_column_sets = {}
+    query = build_segment_table_columns_query(table_names)
     if verbose:
         print("compute_segment_table_dicts_df query:\n", query)
 
-    query_batch_iterator = query_batch_generator(query, timeout_seconds=15, conn=conn)
+    query_batch_iterator = query_batch_generator(query, timeout_seconds=timeout_seconds, conn=conn, raise_errors=raise_errors)
 
     while True:
         try:
@@ -53,19 +79,23 @@ def compute_segment_table_dicts_df(conn: connector=None, verbose: bool=True) ->
                     not matches_any(segment_table, SEARCH_IGNORE_SEGMENT_TABLES_SET):
                         
                     if column_name in ALL_SEARCH_COLUMNS:
-                        columns_set = segment_table_column_sets.get(segment_table, set())
+                        columns_set = metadata_table_column_sets.get(metadata_table, set())
                         columns_set.add(column_name)
-                        segment_table_column_sets[segment_table] = columns_set
+                        metadata_table_column_sets[metadata_table] = columns_set
                       
         except StopIteration:
             break
-        
-    # add a new segment_table_dict to the list of segment_table_dicts 
-    # if it's columns_set has ALL_KEY_COLUMNS
-    for segment_table, columns_set in segment_table_column_sets.items():
+    return metadata_table_column_sets
+
+# Returns a segment_table_dicts data_frame with a segment_table_dict for
+# each metadata_table whose columns_set has ALL_KEY_COLUMNS
+def build_segment_table_dicts_df(metadata_table_column_sets: Dict[str, Set[str]], verbose: bool=True) -> pd.DataFrame:
+    segment_table_dicts = []
+    for metadata_table, columns_set in metadata_table_column_sets.items():
         if columns_set >= ALL_KEY_COLUMNS:
             
             # create a segment_table_dict
+            segment_table = get_segment_table_from_metadata_table(metadata_table)
             segment_table_dict = {}
             segment_table_dict['segment_table'] = segment_table  
             columns_str = "-".join([x for x in columns_set])
@@ -82,14 +112,81 @@ def compute_segment_table_dicts_df(conn: connector=None, verbose: bool=True) ->
         for segment_table_dict in segment_table_dicts:
             pprint(segment_table_dict)
     
-    # add the metadata_table property to each 
     # create a DataFrame from the list of segment_table dictionaries
     segment_tables_df = pd.DataFrame(data=segment_table_dicts, columns=SEGMENT_TABLE_DICTS_DF_COLUMNS)
     return segment_tables_df
 
+# If incremental is True only the columns of tables altered since the last
+# saved snapshot are re-read, see sync_segment_table_dicts_df
+def compute_segment_table_dicts_df(conn: connector=None, verbose: bool=True, incremental: bool=False) -> pd.DataFrame:
+    if incremental:
+        return sync_segment_table_dicts_df(conn=conn, verbose=verbose)
+    metadata_table_column_sets = fetch_segment_table_column_sets(conn=conn, verbose=verbose)
+    return build_segment_table_dicts_df(metadata_table_column_sets, verbose=verbose)
+
+# Returns a dict of metadata_table to its LAST_ALTERED timestamp string
+# for all tables matching build_segment_table_name_filter
+# Raises ProgrammingError instead of returning partial versions if raise_errors is True.
+def fetch_segment_table_versions(conn: connector=None, timeout_seconds: int=15, verbose: bool=True, raise_errors: bool=False) -> Dict[str, str]:
+    query = f"SELECT TABLE_NAME, LAST_ALTERED FROM LOOKER_SOURCE.INFORMATION_SCHEMA.TABLES WHERE {build_segment_table_name_filter()}"
+    if verbose:
+        print("fetch_segment_table_versions query:\n", query)
+    versions = {}
+    for batch_rows in query_batch_generator(query, timeout_seconds=timeout_seconds, conn=conn, raise_errors=raise_errors):
+        for result_row in batch_rows:
+            last_altered = result_row[1]
+            versions[result_row[0]] = last_altered.isoformat() if hasattr(last_altered, "isoformat") else str(last_altered)
+    return versions
+
+# Returns the segment_table_dicts data_frame after an incremental sync of the catalog:
+# 1. reads LAST_ALTERED of all candidate tables from INFORMATION_SCHEMA.TABLES
+# 2. compares them with the latest saved segment_table_versions_df snapshot
+# 3. re-reads INFORMATION_SCHEMA.COLUMNS only for new or altered tables
+# 4. saves a new segment_table_versions_df snapshot
+# If any fetch fails (e.g. an errno 604 timeout) its ProgrammingError is raised and
+# nothing is saved, so a partial result never poisons the snapshot.
+def sync_segment_table_dicts_df(
+    conn: connector=None,
+    versions_base_name: str=SEGMENT_TABLE_VERSIONS_DF_DEFAULT_BASE_NAME,
+    verbose: bool=True) -> pd.DataFrame:
+    saved_versions = {}
+    loaded = load_latest_data_frame(versions_base_name)
+    if loaded is not None:
+        versions_file, versions_df = loaded
+        for row in versions_df.to_dict(orient="records"):
+            columns_set = set([x for x in str(row['columns']).split("-") if len(x) > 0])
+            saved_versions[row['metadata_table']] = (row['last_altered'], columns_set)
+
+    current_versions = fetch_segment_table_versions(conn=conn, verbose=verbose, raise_errors=True)
+    changed_tables = [x for x, last_altered in current_versions.items() if x not in saved_versions or saved_versions[x][0] != last_altered]
+    if verbose:
+        print(f"sync_segment_table_dicts_df: {len(changed_tables)} of {len(current_versions)} tables changed since last sync")
+
+    changed_column_sets = {}
+    max_tables_per_query = 500
+    for i in range(0, len(changed_tables), max_tables_per_query):
+        table_names = changed_tables[i:i+max_tables_per_query]
+        changed_column_sets.update(fetch_segment_table_column_sets(table_names=table_names, conn=conn, verbose=verbose, raise_errors=True))
+
+    metadata_table_column_sets = {}
+    versions_rows = []
+    for metadata_table, last_altered in current_versions.items():
+        if metadata_table in changed_column_sets or metadata_table in changed_tables:
+            columns_set = changed_column_sets.get(metadata_table, set())
+        else:
+            columns_set = saved_versions[metadata_table][1]
+        if len(columns_set) > 0:
+            metadata_table_column_sets[metadata_table] = columns_set
+        versions_rows.append([metadata_table, last_altered, "-".join(sorted(columns_set))])
+
+    versions_df = pd.DataFrame(data=versions_rows, columns=SEGMENT_TABLE_VERSIONS_DF_COLUMNS)
+    save_data_frame(versions_base_name, versions_df, PARQUET_FORMAT)
+    return build_segment_table_dicts_df(metadata_table_column_sets, verbose=verbose)
+
 # Returns the latest data_file and df of a recomputed and auto-saved segment_tables
-def compute_and_save_new_segment_table_dicts_df(verbose: bool=True) -> Tuple[str, pd.DataFrame]:
-    new_df = compute_segment_table_dicts_df()
+@traced
+def compute_and_save_new_segment_table_dicts_df(verbose: bool=True, incremental: bool=False) -> Tuple[str, pd.DataFrame]:
+    new_df = compute_segment_table_dicts_df(verbose=verbose, incremental=incremental)
     saved_data_file = save_data_frame(SEGMENT_TABLE_DICTS_DF_DEFAULT_BASE_NAME, new_df, PARQUET_FORMAT)
     (latest_data_file,  latest_df) = get_segment_table_dicts_df(load_latest=True)
     assert latest_data_file == saved_data_file, f"ERROR: expected:{saved_data_file} not:{latest_data_file}"
@@ -104,7 +201,7 @@ def get_segment_table_dicts(segment_tables_dicts_df: pd.DataFrame) -> List[Dict[
 # Returns a segment_table_dicts_df either loaded from the latest data_file
 # or a newly computed and saved segments_table_dicts_df
 #  
-def get_segment_table_dicts_df(base_name: str=None, conn: connector=None, load_latest: bool=True, verbose: bool=False) -> Tuple[str,pd.DataFrame]:
+def get_segment_table_dicts_df(base_name: str=None, conn: connector=None, load_latest: bool=True, verbose: bool=False, incremental: bool=False) -> Tuple[str,pd.DataFrame]:
     segment_table_dicts_df = None
     data_file = None
     if base_name is None:
@@ -117,7 +214,7 @@ def get_segment_table_dicts_df(base_name: str=None, conn: connector=None, load_l
 
     # compute and save a new segment_tables_df if needed
     if is_empty_data_frame(segment_table_dicts_df):
-        segment_table_dicts_df = compute_segment_table_dicts_df(conn=conn)
+        segment_table_dicts_df = compute_segment_table_dicts_df(conn=conn, incremental=incremental)
         data_file = save_data_frame(base_name, segment_table_dicts_df, PARQUET_FORMAT)
 
     return [data_file, segment_table_dicts_df]
@@ -131,9 +228,10 @@ def find_segment_table_columns(segment_table: str, conn: connector=None, verbose
     select_columns = ['COLUMN_NAME']
     select_str =  ','.join(select_columns)
 
-    select_query = f"SELECT {select_str} FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS where TABLE_NAME='{metadata_table}'"
+    # metadata_table is bound so all tables share one statement text
+    [select_query, params] = build_query(f"SELECT {select_str} FROM LOOKER_SOURCE.INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?", [metadata_table])
     
-    segment_table_columns_df = execute_batched_select_query(select_query, select_columns, conn=conn, batch_size=100, timeout_seconds=5, verbose=verbose)
+    segment_table_columns_df = execute_batched_select_query(select_query, select_columns, conn=conn, batch_size=100, timeout_seconds=5, verbose=verbose, params=params)
     return list(segment_table_columns_df.values)
 
 ################################################
@@ -152,7 +250,40 @@ def test_find_segment_table_columns():
     for column in columns:
         print(column)
 
+def test_build_segment_table_columns_query():
+    query = build_segment_table_columns_query(table_names=['SEGMENT__ANGEL_WEB__IDENTIFIES'])
+    assert "CONTAINS(TABLE_NAME, 'IDENTIFIES')" in query, f"ERROR: include filter not pushed down {query}"
+    assert "NOT CONTAINS(TABLE_NAME, 'STAGING')" in query, f"ERROR: exclude filter not pushed down {query}"
+    assert "TABLE_NAME IN ('SEGMENT__ANGEL_WEB__IDENTIFIES')" in query, f"ERROR: table_names not pushed down {query}"
+    for column in ALL_SEARCH_COLUMNS:
+        assert f"'{column}'" in query, f"ERROR: column {column} not pushed down {query}"
+
+def test_build_segment_table_dicts_df():
+    column_sets = {
+        'SEGMENT__ANGEL_WEB__IDENTIFIES': set([*ALL_KEY_COLUMNS, 'RECEIVED_AT']),
+        'SEGMENT__ANGEL_TV__IDENTIFIES': set(['ID', 'USER_ID']),
+    }
+    df = build_segment_table_dicts_df(column_sets, verbose=False)
+    assert list(df['segment_table']) == ['SEGMENT.ANGEL_WEB.IDENTIFIES'], f"ERROR: unexpected segment_tables {list(df['segment_table'])}"
+    assert list(df['metadata_table']) == ['SEGMENT__ANGEL_WEB__IDENTIFIES'], f"ERROR: unexpected metadata_tables {list(df['metadata_table'])}"
+
+def test_failed_sync_not_saved():
+    from fake_connector import connect_fake
+    versions_base_name = f"test_failed_sync_versions_{int(time.time() * 1000)}"
+    conn = connect_fake()
+    try:
+        # the fake has no INFORMATION_SCHEMA so the versions fetch fails
+        sync_segment_table_dicts_df(conn=conn, versions_base_name=versions_base_name, verbose=False)
+        assert False, "ERROR: failed sync returned a segment_table_dicts_df"
+    except ProgrammingError:
+        pass
+    assert load_latest_data_frame(versions_base_name) is None, "ERROR: failed sync saved a snapshot"
+    conn.close()
+
 def tests():
+    test_build_segment_table_columns_query()
+    test_build_segment_table_dicts_df()
+    test_failed_sync_not_saved()
     test_compute_and_save_new_segment_table_dicts_df()
     test_find_segment_table_columns()
     
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import pandas as pd
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from constants import *
+
+# Returns a hash of the column names and dtypes of df
+def get_schema_hash(df: pd.DataFrame) -> str:
+    schema_str = "|".join([f"{column}:{dtype}" for column, dtype in zip(df.columns, df.dtypes)])
+    return hashlib.sha256(schema_str.encode()).hexdigest()[:16]
+
+
+# An index of the snapshots saved by data_frame_utils.save_data_frame for one base_name.
+#
+# The manifest is a json file {snapshot_dir}/{base_name}.manifest.json listing one
+# entry (file, format, num_rows, schema_hash, created_at) per snapshot, newest last,
+# so the latest snapshot is found without globbing and stating every file.
+# Updates hold an exclusive flock on {base_name}.manifest.lock and replace the
+# manifest atomically, so readers always see either the old or the new manifest.
+# gc() removes the snapshots beyond retention_count or older than retention_days,
+# the latest snapshot is always kept and a retention of 0 removes nothing.
+#
+# Usage:
+#   manifest = SnapshotManifest("segments_table_dicts_df")
+#   manifest.publish(data_file, PARQUET_FORMAT, len(df), get_schema_hash(df))
+#   latest_entry = manifest.latest()
+#
+class SnapshotManifest():
+    def __init__(self, base_name: str, snapshot_dir: str="/tmp"):
+        self.base_name = base_name
+        self.snapshot_dir = snapshot_dir
+        self.manifest_file = os.path.join(snapshot_dir, f"{base_name}.manifest.json")
+        self.lock_file = os.path.join(snapshot_dir, f"{base_name}.manifest.lock")
+
+    # Holds the exclusive lock of this manifest across processes
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Returns the manifest entries, oldest first, or [] if there is no readable manifest
+    def entries(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)["entries"]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    # Atomically replaces the manifest, must be called with the lock held
+    def save(self, entries: List[Dict[str, Any]]) -> None:
+        tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"base_name": self.base_name, "entries": entries}, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+
+    # Adds the entry of a new snapshot data_file that is already in place
+    def publish(self, data_file: str, format: str, num_rows: int, schema_hash: str) -> Dict[str, Any]:
+        entry = {
+            "file": data_file,
+            "format": format,
+            "num_rows": num_rows,
+            "schema_hash": schema_hash,
+            "created_at": time.time(),
+        }
+        with self.lock():
+            entries = [x for x in self.entries() if x["file"] != data_file]
+            entries.append(entry)
+            self.save(entries)
+        return entry
+
+    # Returns the entry of the latest snapshot whose file still exists, or None
+    def latest(self) -> Optional[Dict[str, Any]]:
+        for entry in reversed(self.entries()):
+            if os.path.isfile(entry["file"]):
+                return entry
+        return None
+
+    # Removes the snapshots beyond the retention_count newest ones and the ones older
+    # than retention_days (if > 0). The latest snapshot is always kept.
+    # Returns the removed data_files.
+    def gc(self, retention_count: int=SNAPSHOT_RETENTION_COUNT, retention_days: float=SNAPSHOT_RETENTION_DAYS) -> List[str]:
+        removed_files = []
+        min_created_at = time.time() - retention_days * 86400 if retention_days > 0 else None
+        with self.lock():
+            entries = [x for x in self.entries() if os.path.isfile(x["file"])]
+            kept = []
+            for i, entry in enumerate(reversed(entries)):
+                too_many = retention_count > 0 and i >= retention_count
+                too_old = i > 0 and min_created_at is not None and entry["created_at"] < min_created_at
+                if too_many or too_old:
+                    try:
+                        os.remove(entry["file"])
+                    except OSError:
+                        pass
+                    removed_files.append(entry["file"])
+                else:
+                    kept.insert(0, entry)
+            self.save(kept)
+        return removed_files
+
+
+################################################
+# Tests
+################################################
+
+def test_publish_latest_and_gc():
+    snapshot_dir = f"/tmp/snapshot_manifest_test-{time.time()}"
+    os.makedirs(snapshot_dir)
+    manifest = SnapshotManifest("test_df", snapshot_dir=snapshot_dir)
+    assert manifest.latest() is None, "ERROR: expected no latest snapshot"
+    df = pd.DataFrame({"A": [1, 2]})
+    data_files = []
+    for i in range(4):
+        data_file = os.path.join(snapshot_dir, f"test_df-{i}.csv")
+        df.to_csv(data_file)
+        manifest.publish(data_file, CSV_FORMAT, len(df), get_schema_hash(df))
+        data_files.append(data_file)
+    latest_entry = manifest.latest()
+    assert latest_entry["file"] == data_files[-1] and latest_entry["num_rows"] == 2, f"ERROR: unexpected latest {latest_entry}"
+    os.remove(data_files[-1])
+    assert manifest.latest()["file"] == data_files[-2], "ERROR: missing latest file not skipped"
+    assert manifest.gc(retention_count=0, retention_days=0) == [], "ERROR: gc without retention removed files"
+    removed_files = manifest.gc(retention_count=2, retention_days=0)
+    assert removed_files == [data_files[0]], f"ERROR: unexpected removed files {removed_files}"
+    assert [x["file"] for x in manifest.entries()] == data_files[1:3], f"ERROR: unexpected entries {manifest.entries()}"
+    assert get_schema_hash(df) != get_schema_hash(pd.DataFrame({"A": ["x"]})), "ERROR: schema hash ignores dtypes"
+    for data_file in os.listdir(snapshot_dir):
+        os.remove(os.path.join(snapshot_dir, data_file))
+    os.rmdir(snapshot_dir)
+
+def tests():
+    test_publish_latest_and_gc()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
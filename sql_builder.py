@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Builds queries with qmark bind parameters and canonical text, so the same
+# logical query always reaches Snowflake as the same statement text and can
+# be served from the warehouse's 24 hour result cache instead of rerun.
+#
+# Values (table names in INFORMATION_SCHEMA filters, IN lists, literals) are
+# passed as ? bind parameters. Identifiers of the tables and columns a query
+# reads are kept inline, but in canonical form: upper case outside quotes,
+# single spaces and ", " separators, no trailing semicolon.
+#
+# Usage:
+#   [query, params] = build_query("select column_name from DB.INFORMATION_SCHEMA.COLUMNS where table_name = ?", [table])
+#   rows = execute_simple_query(query, params=params)
+#   print(get_result_reuse_tracker().get_stats())
+#
+
+# Quoted strings and identifiers, kept as they are
+QUOTED_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+# Comparison operators that get a single space on each side, => first so named arguments stay whole
+OPERATOR_PATTERN = re.compile(r"\s*(=>|<=|>=|<>|!=|=|<|>)\s*")
+
+# A canonical count of all rows of a table, which Snowflake answers from table metadata
+METADATA_COUNT_PATTERN = re.compile(r"^SELECT COUNT\(\*\) FROM [A-Z0-9_$.\"]+$")
+
+# Returns the canonical text of query, equal for queries that only differ in
+# whitespace, the case of unquoted keywords and identifiers, or a trailing semicolon
+def canonical_query(query: str) -> str:
+    parts = []
+    for i, part in enumerate(QUOTED_PATTERN.split(query)):
+        if i % 2 == 1:
+            parts.append(part)
+            continue
+        part = re.sub(r"\s+", " ", part.upper())
+        part = re.sub(r"\s*,\s*", ", ", part)
+        part = re.sub(r"\(\s+", "(", part)
+        part = re.sub(r"\s+\)", ")", part)
+        part = OPERATOR_PATTERN.sub(r" \1 ", part)
+        parts.append(part)
+    return "".join(parts).strip().rstrip(";").rstrip()
+
+# Returns the number of ? placeholders of query outside quotes
+def count_placeholders(query: str) -> int:
+    return sum([part.count("?") for i, part in enumerate(QUOTED_PATTERN.split(query)) if i % 2 == 0])
+
+# Returns a comma separated list of num_values ? placeholders, e.g. for an IN list
+def build_placeholders(num_values: int) -> str:
+    assert num_values > 0, f"ERROR: invalid num_values: {num_values}"
+    return ", ".join(["?"] * num_values)
+
+# Returns the [canonical query, params] of a query template with ? placeholders
+def build_query(template: str, params: Optional[Sequence[Any]]=None) -> Tuple[str, List[Any]]:
+    params = [] if params is None else list(params)
+    query = canonical_query(template)
+    num_placeholders = count_placeholders(query)
+    assert num_placeholders == len(params), f"ERROR: {num_placeholders} placeholders but {len(params)} params in {query}"
+    return [query, params]
+
+# Returns the [canonical query, params] of a query counting the rows of table,
+# optionally only those matching where
+def build_count_query(table: str, where: Optional[str]=None, params: Optional[Sequence[Any]]=None) -> Tuple[str, List[Any]]:
+    template = f"SELECT COUNT(*) FROM {table}" if where is None else f"SELECT COUNT(*) FROM {table} WHERE {where}"
+    return build_query(template, params)
+
+# Returns the [canonical query, params] of a query of the given columns of the
+# INFORMATION_SCHEMA.TABLES rows of tables, all in the database of information_schema
+def build_information_schema_tables_query(information_schema: str, columns: List[str], schema_tables: List[str]) -> Tuple[str, List[Any]]:
+    schema_tables = sorted(set(schema_tables))
+    template = f"SELECT {', '.join(columns)} FROM {information_schema}.TABLES WHERE TABLE_SCHEMA || '.' || TABLE_NAME IN ({build_placeholders(len(schema_tables))})"
+    return build_query(template, schema_tables)
+
+# Returns True if only the warehouse result cache can make a repeat of query cheap.
+# DDL and DML are never served from it, and a whole-table COUNT(*) or an
+# INFORMATION_SCHEMA lookup is answered from metadata and scans no bytes anyway.
+def is_result_cacheable_statement(query: str) -> bool:
+    query = canonical_query(query)
+    if not (query.startswith("SELECT ") or query.startswith("WITH ")):
+        return False
+    if "INFORMATION_SCHEMA" in query:
+        return False
+    return METADATA_COUNT_PATTERN.match(query) is None
+
+# Returns the key of a query and its params, equal for the same logical statement
+def get_statement_key(query: str, params: Optional[Sequence[Any]]=None) -> str:
+    key = canonical_query(query)
+    if params is not None and len(params) > 0:
+        key = f"{key} -- {json.dumps(list(params), default=str)}"
+    return key
+
+
+# Counts how often the same logical statement is executed and keeps the Snowflake
+# query ids of the repeated ones, which the warehouse can serve from its result
+# cache. Statements that are not is_result_cacheable_statement are only counted
+# as num_skipped. query_generator.fetch_result_reuse_stats looks the repeats up in
+# INFORMATION_SCHEMA.QUERY_HISTORY and counts the zero-scan repeats, those that
+# scanned no bytes, which is how a result cache hit shows up there.
+class ResultReuseTracker():
+    def __init__(self, max_repeats: int=10000):
+        self.max_repeats = max_repeats
+        self.lock = threading.Lock()
+        self.statement_counts: Dict[str, int] = {}
+        self.repeat_sfqids: List[str] = []
+        self.num_statements = 0
+        self.num_skipped = 0
+        self.num_repeats = 0
+        self.num_zero_scan_repeats: Optional[int] = None
+
+    # Records one executed statement and its Snowflake query id
+    def record(self, query: str, params: Optional[Sequence[Any]]=None, sfqid: Optional[str]=None) -> None:
+        if not is_result_cacheable_statement(query):
+            with self.lock:
+                self.num_skipped += 1
+            return
+        key = get_statement_key(query, params)
+        with self.lock:
+            self.num_statements += 1
+            count = self.statement_counts.get(key, 0)
+            self.statement_counts[key] = count + 1
+            if count > 0:
+                self.num_repeats += 1
+                if sfqid is not None and len(self.repeat_sfqids) < self.max_repeats:
+                    self.repeat_sfqids.append(sfqid)
+
+    def get_repeat_sfqids(self) -> List[str]:
+        with self.lock:
+            return list(self.repeat_sfqids)
+
+    # Sets the number of looked up repeats that scanned no bytes
+    def set_num_zero_scan_repeats(self, num_zero_scan_repeats: int) -> None:
+        with self.lock:
+            self.num_zero_scan_repeats = num_zero_scan_repeats
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statement_counts = {}
+            self.repeat_sfqids = []
+            self.num_statements = 0
+            self.num_skipped = 0
+            self.num_repeats = 0
+            self.num_zero_scan_repeats = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            num_looked_up = len(self.repeat_sfqids)
+            return {
+                "num_statements": self.num_statements,
+                "num_skipped": self.num_skipped,
+                "num_distinct": len(self.statement_counts),
+                "num_repeats": self.num_repeats,
+                "num_zero_scan_repeats": self.num_zero_scan_repeats,
+                "zero_scan_repeat_percent": None if self.num_zero_scan_repeats is None or num_looked_up == 0 else self.num_zero_scan_repeats * 100 / num_looked_up,
+            }
+
+_result_reuse_tracker = None
+_result_reuse_tracker_lock = threading.Lock()
+
+# Returns the process-wide ResultReuseTracker that query_generator records into
+def get_result_reuse_tracker() -> ResultReuseTracker:
+    global _result_reuse_tracker
+    with _result_reuse_tracker_lock:
+        if _result_reuse_tracker is None:
+            _result_reuse_tracker = ResultReuseTracker()
+        return _result_reuse_tracker
+
+
+################################################
+# Tests
+################################################
+
+def test_canonical_query():
+    a = canonical_query("select count(*)  from  a.b.c\n where  x=1 ;")
+    b = canonical_query("SELECT COUNT( * ) FROM A.B.C WHERE X = 1")
+    assert a == b == "SELECT COUNT(*) FROM A.B.C WHERE X = 1", f"ERROR: not canonical {a} {b}"
+    c = canonical_query("select 'Mixed  Case' as \"q\" ,x from t where y>=? and f(n=>1)")
+    assert c == "SELECT 'Mixed  Case' AS \"q\", X FROM T WHERE Y >= ? AND F(N => 1)", f"ERROR: quotes not kept {c}"
+
+def test_build_query():
+    [query, params] = build_query("select column_name from db.information_schema.columns where table_name = ?", ["T"])
+    assert query == "SELECT COLUMN_NAME FROM DB.INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?" and params == ["T"], f"ERROR: unexpected {query} {params}"
+    [query, params] = build_information_schema_tables_query("DB.INFORMATION_SCHEMA", ["TABLE_NAME"], ["S.B", "S.A", "S.B"])
+    assert query.endswith("IN (?, ?)") and params == ["S.A", "S.B"], f"ERROR: unexpected {query} {params}"
+    assert build_count_query("a.b.c", "x is not null")[0] == canonical_query("SELECT count(*) from a.b.c where x is not NULL "), "ERROR: count queries differ"
+    try:
+        build_query("select ? from t where '?' = ?", [1])
+        assert False, "ERROR: placeholder count not checked"
+    except AssertionError as err:
+        assert "2 placeholders" in str(err), f"ERROR: unexpected {err}"
+
+def test_result_reuse_tracker():
+    tracker = ResultReuseTracker()
+    tracker.record("select x from a.b.c where y is null", None, "q1")
+    tracker.record("SELECT X FROM A.B.C WHERE Y IS NULL;", None, "q2")
+    tracker.record("SELECT COUNT(*) FROM A.B.C WHERE X = ?", [1], "q3")
+    tracker.record("SELECT COUNT(*) FROM A.B.C WHERE X = ?", [2], "q4")
+    # answered from metadata or never cached, so not tracked
+    tracker.record("SELECT COUNT(*) FROM A.B.C", None, "q5")
+    tracker.record("select count(*) from a.b.c", None, "q6")
+    tracker.record("SELECT TABLE_NAME FROM DB.INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?", ["C"], "q7")
+    tracker.record("ALTER TABLE A.B.C ADD COLUMN Z VARCHAR", None, "q8")
+    stats = tracker.get_stats()
+    assert stats["num_statements"] == 4 and stats["num_skipped"] == 4 and stats["num_distinct"] == 3 and stats["num_repeats"] == 1, f"ERROR: unexpected stats {stats}"
+    assert tracker.get_repeat_sfqids() == ["q2"], f"ERROR: unexpected repeats {tracker.get_repeat_sfqids()}"
+    tracker.set_num_zero_scan_repeats(1)
+    assert tracker.get_stats()["zero_scan_repeat_percent"] == 100.0, f"ERROR: unexpected stats {tracker.get_stats()}"
+
+def tests():
+    test_canonical_query()
+    test_build_query()
+    test_result_reuse_tracker()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
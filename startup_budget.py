@@ -0,0 +1,121 @@
+import os
+import sys
+import argparse
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+# Measures the import time of the CLI entry points and module self tests
+# in fresh interpreters with python -X importtime and checks it against
+# a startup budget, so a new eager import of pandas, pyarrow or
+# snowflake.connector in a light module shows up as a failure.
+#
+# Usage:
+#   python startup_budget.py              # measure all entry points
+#   python startup_budget.py --tests      # run the self tests
+#
+
+# Budget in seconds of importing each module, including its dependencies.
+# main and metadata_tables need pandas and the connector, the others should not.
+STARTUP_BUDGETS = {
+    "constants": 0.1,
+    "utils": 0.05,
+    "segment_utils": 0.05,
+    "query_generator": 0.25,
+    "data_frame_utils": 1.5,
+    "metadata_tables": 2.5,
+    "main": 2.5,
+}
+
+# Returns the (module, self_us, cumulative_us, depth) rows of python -X importtime output
+def parse_importtime(output: str) -> List[Tuple[str, int, int, int]]:
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(parts[0]), int(parts[1]), depth))
+    return rows
+
+# Returns the import seconds of module and its heaviest direct dependencies
+# as (name, seconds), measured in a fresh interpreter
+def measure_import(module: str, repo_dir: str, top: int=3) -> Tuple[float, List[Tuple[str, float]]]:
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = parse_importtime(result.stderr)
+    module_rows = [x for x in rows if x[0] == module and x[3] == 0]
+    assert len(module_rows) > 0, f"ERROR: {module} not found in importtime output"
+    seconds = module_rows[-1][2] / 1e6
+    # the direct dependencies of module are listed right before it at depth 1
+    dependencies = []
+    for name, self_us, cumulative_us, depth in reversed(rows[:rows.index(module_rows[-1])]):
+        if depth == 0:
+            break
+        if depth == 1:
+            dependencies.append((name, cumulative_us / 1e6))
+    dependencies = sorted(dependencies, key=lambda x: -x[1])[:top]
+    return [seconds, dependencies]
+
+# Measures each module of budgets (the best of num_runs) and returns the failures
+def check_startup_budget(budgets: Dict[str, float]=STARTUP_BUDGETS, repo_dir: Optional[str]=None, num_runs: int=3, verbose: bool=True) -> List[str]:
+    repo_dir = os.path.dirname(os.path.abspath(__file__)) if repo_dir is None else repo_dir
+    failures = []
+    for module, budget in budgets.items():
+        measurements = [measure_import(module, repo_dir) for _ in range(num_runs)]
+        [seconds, dependencies] = min(measurements, key=lambda x: x[0])
+        status = "ok" if seconds <= budget else "OVER BUDGET"
+        if verbose:
+            dependencies_str = ", ".join([f"{name}:{x:.3f}s" for name, x in dependencies])
+            print(f"{module:20s} {seconds:7.3f}s budget:{budget:.3f}s {status:12s} {dependencies_str}")
+        if seconds > budget:
+            failures.append(f"{module} imports in {seconds:.3f}s over its {budget:.3f}s budget")
+    return failures
+
+
+################################################
+# Tests
+################################################
+
+def test_parse_importtime():
+    output = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       100 |        100 |   json.decoder",
+        "import time:       200 |        300 | json",
+        "import time:        50 |         50 |     pyarrow.lib",
+        "import time:       400 |        450 |   pyarrow",
+        "import time:        10 |        760 | data_frame_utils",
+    ])
+    rows = parse_importtime(output)
+    assert rows[0] == ("json.decoder", 100, 100, 1), f"ERROR: unexpected row {rows[0]}"
+    assert rows[2] == ("pyarrow.lib", 50, 50, 2), f"ERROR: unexpected row {rows[2]}"
+    assert rows[-1] == ("data_frame_utils", 10, 760, 0), f"ERROR: unexpected row {rows[-1]}"
+
+def test_measure_import():
+    [seconds, dependencies] = measure_import("segment_utils", os.path.dirname(os.path.abspath(__file__)))
+    assert 0 < seconds < 1, f"ERROR: unexpected segment_utils import seconds {seconds}"
+
+def tests():
+    test_parse_importtime()
+    test_measure_import()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    parser = argparse.ArgumentParser(description="check the import time of the entry points against their startup budget")
+    parser.add_argument("--runs", type=int, default=3, help="measure each module this many times and keep the best")
+    parser.add_argument("--tests", action="store_true", help="run the self tests")
+    args = parser.parse_args()
+    if args.tests:
+        tests()
+        return
+    failures = check_startup_budget(num_runs=args.runs)
+    for failure in failures:
+        print("ERROR:", failure)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import os
+import decimal
+import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+import pandas as pd
+import pyarrow as pa
+import numpy as np
+
+# The hash of a null value (None, NaN, NaT, pd.NA) in any column
+NULL_HASH = np.uint64(0x9E3779B97F4A7C15)
+# Mixed into the hashes of datetimes and other values, so they do not collide
+# with the numbers and strings of the same bytes
+DATETIME_TAG = np.uint64(0xC2B2AE3D27D4EB4F)
+BYTES_TAG = np.uint64(0x27D4EB2F165667C5)
+OTHER_TAG = np.uint64(0x165667B19E3779F9)
+
+# pandas.api.types.infer_dtype kinds of the columns hashed by type
+NUMBER_KINDS = ("integer", "floating", "mixed-integer-float", "decimal", "boolean", "integer-na")
+STRING_KINDS = ("string", "empty")
+DATETIME_KINDS = ("datetime64", "datetime", "date")
+
+# Returns the int of an integral number, the digits of one beyond int64, or the float of any other
+def canonical_number(value: Any) -> Any:
+    if isinstance(value, (float, np.floating)) and not float(value).is_integer():
+        return float(value)
+    if isinstance(value, decimal.Decimal) and (not value.is_finite() or value != value.to_integral_value()):
+        return float(value)
+    integer = int(value)
+    return integer if -2 ** 63 <= integer < 2 ** 63 else str(integer)
+
+# Returns the uint64 hash of a canonical_number, an int beyond int64 is hashed
+# like any other value, by its repr
+def hash_canonical_number(value: Any) -> np.uint64:
+    if isinstance(value, str):
+        return pd.util.hash_array(np.array([value], dtype=object), categorize=False)[0] ^ OTHER_TAG
+    if isinstance(value, int):
+        return pd.util.hash_array(np.array([value], dtype=np.int64), categorize=False)[0]
+    return hash_floats(np.array([value], dtype=np.float64))[0]
+
+# Returns the uint64 hash of each float of an array, by its int64 value if integral
+def hash_floats(floats: np.ndarray) -> np.ndarray:
+    integral = np.isfinite(floats) & (np.floor(floats) == floats) & (np.abs(floats) < 2.0 ** 63)
+    ints = np.where(integral, floats, 0).astype(np.int64)
+    return np.where(integral, pd.util.hash_array(ints, categorize=False), pd.util.hash_array(floats, categorize=False))
+
+# Returns the uint64 hash of each number of values. Ints, bools and integral
+# floats and Decimals are hashed by their int64 value, so 1, 1.0, True and
+# Decimal('1.00') are equal, all other numbers by their float64 value. Columns
+# of Python objects, such as Decimals, are cast to float64 at once, only the
+# values beyond 2**53, which float64 cannot tell apart, are converted one by one.
+def hash_numbers(values: pd.Series) -> np.ndarray:
+    if values.dtype.kind == "u" and len(values) > 0 and values.max() >= 2 ** 63:
+        values = values.astype(object)
+    if values.dtype.kind in "iub":
+        return pd.util.hash_array(values.to_numpy(dtype=np.int64, na_value=0), categorize=False)
+    floats = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    hashes = hash_floats(floats)
+    if values.dtype == object:
+        big = np.abs(floats) >= 2.0 ** 53
+        if big.any():
+            canonical_values = values[big].map(canonical_number)
+            hashes[big] = [hash_canonical_number(x) for x in canonical_values]
+    return hashes
+
+# Returns the uint64 hash of each str of values
+def hash_strings(values: pd.Series) -> np.ndarray:
+    return pd.util.hash_array(values.to_numpy(dtype=object), categorize=False)
+
+# Returns the uint64 hash of each bytes of values, different from the str of the same characters
+def hash_bytes(values: pd.Series) -> np.ndarray:
+    return hash_strings(values) ^ BYTES_TAG
+
+# Returns the uint64 hash of each date, datetime or Timestamp of values by its
+# UTC nanosecond timestamp, naive values are taken as UTC
+def hash_datetimes(values: pd.Series) -> np.ndarray:
+    timestamps = pd.to_datetime(values, utc=True, cache=False).dt.tz_localize(None)
+    nanoseconds = timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    return pd.util.hash_array(nanoseconds, categorize=False) ^ DATETIME_TAG
+
+# Returns the uint64 hash of each other value of values by its repr
+def hash_others(values: pd.Series) -> np.ndarray:
+    return pd.util.hash_array(values.map(repr).to_numpy(dtype=object), categorize=False) ^ OTHER_TAG
+
+# Returns the kind of hash function of a single value of a mixed column
+def get_value_kind(value: Any) -> str:
+    if isinstance(value, (bool, int, float, decimal.Decimal, np.number, np.bool_)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, bytes):
+        return "bytes"
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return "datetime"
+    return "other"
+
+HASH_FUNCTIONS = {"number": hash_numbers, "string": hash_strings, "bytes": hash_bytes, "datetime": hash_datetimes, "other": hash_others}
+
+# Returns the uint64 hash of each value of a key column, equal for equal values
+# of different types, whether they come from fetchmany, Arrow or pandas:
+# numbers by hash_numbers, dates and times by hash_datetimes, strings by their
+# bytes, and None, NaN, NaT and pd.NA as NULL_HASH. Whole columns of one kind
+# are hashed vectorized, only the values of mixed columns are grouped one by one.
+def hash_column(values: pd.Series) -> np.ndarray:
+    values = values.reset_index(drop=True)
+    nulls = values.isna().to_numpy()
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind in NUMBER_KINDS:
+        hashes = hash_numbers(values)
+    elif kind in STRING_KINDS:
+        hashes = hash_strings(values)
+    elif kind == "bytes":
+        hashes = hash_bytes(values)
+    elif kind in DATETIME_KINDS:
+        hashes = hash_datetimes(values)
+    else:
+        hashes = np.full(len(values), NULL_HASH, dtype=np.uint64)
+        value_kinds = values.map(get_value_kind).to_numpy()
+        for value_kind in set(value_kinds[~nulls]):
+            mask = (value_kinds == value_kind) & ~nulls
+            hashes[mask] = HASH_FUNCTIONS[value_kind](values[mask].astype(object))
+    return np.where(nulls, NULL_HASH, hashes).astype(np.uint64)
+
+
+# Drops duplicate rows across batches as they stream in.
+#
+# Each batch is hashed vectorized with hash_column, one uint64 per value,
+# combined into one uint64 per row (or the subset of the row at key_indices)
+# with pandas.util.hash_pandas_object. The row hashes are kept in a set, so
+# memory grows with the number of distinct keys rather than with the full
+# width of the rows seen so far. The first row of each key is kept. With 64 bit
+# hashes two distinct keys among a billion collide with a probability of about 3%.
+#
+# Usage:
+#   deduper = StreamingDeduper()
+#   for batch_rows in dedupe_batch_generator(query_batch_generator(query), deduper):
+#       ...
+#   print(deduper.get_stats())
+#
+class StreamingDeduper():
+    def __init__(self, key_indices: Optional[Sequence[int]]=None):
+        self.key_indices = None if key_indices is None else list(key_indices)
+        self.digests = set()
+        self.num_seen = 0
+        self.num_dropped = 0
+
+    # Returns a StreamingDeduper keyed on key_columns, given the columns of the rows
+    # it will filter. All columns are used if key_columns is None.
+    @staticmethod
+    def for_columns(columns: List[str], key_columns: Optional[List[str]]=None) -> 'StreamingDeduper':
+        key_indices = None
+        if key_columns is not None:
+            missing = [x for x in key_columns if x not in columns]
+            assert len(missing) == 0, f"ERROR: key_columns {missing} not in columns {columns}"
+            key_indices = [columns.index(x) for x in key_columns]
+        return StreamingDeduper(key_indices=key_indices)
+
+    # Returns the uint64 hash of each row of key_df
+    def hash_rows(self, key_df: pd.DataFrame) -> np.ndarray:
+        column_hashes = pd.DataFrame({i: hash_column(key_df.iloc[:, i]) for i in range(key_df.shape[1])})
+        return pd.util.hash_pandas_object(column_hashes, index=False).to_numpy()
+
+    # Returns a boolean array that is True for each row of key_df whose key is
+    # seen for the first time, in this batch and all batches before
+    def keep_mask(self, key_df: pd.DataFrame) -> np.ndarray:
+        if len(key_df) == 0:
+            return np.zeros(0, dtype=bool)
+        hashes = self.hash_rows(key_df)
+        first_in_batch = ~pd.Series(hashes).duplicated().to_numpy()
+        digests = self.digests
+        unseen = np.fromiter((x not in digests for x in hashes.tolist()), dtype=bool, count=len(hashes))
+        mask = first_in_batch & unseen
+        digests.update(hashes[mask].tolist())
+        self.num_seen += len(mask)
+        self.num_dropped += len(mask) - int(mask.sum())
+        return mask
+
+    # Returns the rows of a query_batch_generator batch that were not seen before
+    def filter_rows(self, rows: List[Sequence[Any]]) -> List[Sequence[Any]]:
+        key_df = pd.DataFrame.from_records(rows, coerce_float=False)
+        if self.key_indices is not None and len(rows) > 0:
+            key_df = key_df.iloc[:, self.key_indices]
+        mask = self.keep_mask(key_df)
+        return [row for row, keep in zip(rows, mask) if keep]
+
+    # Returns the rows of df that were not seen before
+    def filter_data_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        key_df = df if self.key_indices is None else df.iloc[:, self.key_indices]
+        return df[self.keep_mask(key_df)]
+
+    # Returns the rows of an Arrow table that were not seen before
+    def filter_arrow_table(self, table: pa.Table) -> pa.Table:
+        key_table = table if self.key_indices is None else table.select(self.key_indices)
+        key_df = key_table.rename_columns([str(i) for i in range(key_table.num_columns)]).to_pandas()
+        mask = self.keep_mask(key_df)
+        return table.filter(pa.array(mask, type=pa.bool_()))
+
+    # Returns the number of distinct keys, rows seen and duplicate rows dropped
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "num_seen": self.num_seen,
+            "num_kept": self.num_seen - self.num_dropped,
+            "num_dropped": self.num_dropped,
+            "num_digests": len(self.digests),
+        }
+
+
+# Filter stage for the output of query_batch_generator that yields each
+# batch with the rows already seen by deduper removed. Empty batches are skipped.
+def dedupe_batch_generator(query_batch_iterator: Iterator[Any], deduper: StreamingDeduper) -> Iterator[Any]:
+    try:
+        for batch in query_batch_iterator:
+            if isinstance(batch, pa.Table):
+                batch = deduper.filter_arrow_table(batch)
+                num_batch_rows = batch.num_rows
+            else:
+                batch = deduper.filter_rows(batch)
+                num_batch_rows = len(batch)
+            if num_batch_rows > 0:
+                yield batch
+    finally:
+        # release the upstream cursor and connection if closed early
+        if hasattr(query_batch_iterator, "close"):
+            query_batch_iterator.close()
+
+
+################################################
+# Tests
+################################################
+
+def test_filter_rows():
+    deduper = StreamingDeduper()
+    batch1 = [(1, 'a'), (2, 'b'), (1, 'a')]
+    batch2 = [(2, 'b'), (3, 'c')]
+    kept = [*deduper.filter_rows(batch1), *deduper.filter_rows(batch2)]
+    assert kept == [(1, 'a'), (2, 'b'), (3, 'c')], f"ERROR: unexpected kept rows {kept}"
+    stats = deduper.get_stats()
+    assert stats['num_dropped'] == 2, f"ERROR: expected 2 dropped not {stats['num_dropped']}"
+    assert stats['num_kept'] == 3, f"ERROR: expected 3 kept not {stats['num_kept']}"
+
+def test_key_columns():
+    deduper = StreamingDeduper.for_columns(['ID', 'USER_ID'], key_columns=['USER_ID'])
+    kept = deduper.filter_rows([(1, 'u1'), (2, 'u1'), (3, 'u2')])
+    assert kept == [(1, 'u1'), (3, 'u2')], f"ERROR: unexpected kept rows {kept}"
+
+def test_int_keys():
+    # -1 and -2 share a builtin hash, they must not be treated as duplicates
+    deduper = StreamingDeduper()
+    kept = deduper.filter_rows([(-1,), (-2,)])
+    assert len(kept) == 2, f"ERROR: expected 2 kept rows not {kept}"
+
+def test_mixed_value_types():
+    deduper = StreamingDeduper()
+    kept = deduper.filter_rows([(1, 'a'), (1.0, 'a'), (decimal.Decimal('1.00'), 'a'), (np.int64(1), 'a'), ('1', 'a')])
+    assert kept == [(1, 'a'), ('1', 'a')], f"ERROR: unexpected kept rows {kept}"
+    kept = deduper.filter_rows([(decimal.Decimal('1.10'), None), (1.1, float('nan')), (1.2, None)])
+    assert kept == [(decimal.Decimal('1.10'), None), (1.2, None)], f"ERROR: unexpected kept rows {kept}"
+    # the same rows as arrow batches and as a data_frame
+    table = pa.table({'A': pa.array([1, 2], type=pa.int64()), 'B': ['a', 'b']})
+    assert deduper.filter_arrow_table(table).num_rows == 1, "ERROR: arrow int not a duplicate of 1.0"
+    df = pd.DataFrame({'A': [2.0, 3.0], 'B': ['b', 'c']})
+    assert len(deduper.filter_data_frame(df)) == 1, "ERROR: pandas float not a duplicate of arrow int"
+    timestamp = datetime.datetime(2023, 1, 2, 3, 4, 5)
+    assert len(deduper.filter_rows([(timestamp,), (pd.Timestamp(timestamp),)])) == 1, "ERROR: Timestamp not a duplicate of datetime"
+    # ints beyond float64 and int64 precision, and bytes and str of the same characters, stay distinct
+    kept = deduper.filter_rows([(2 ** 60,), (2 ** 60 + 1,), (2 ** 70,), (2 ** 70 + 1,), (decimal.Decimal(2 ** 70),), (b'a',), ('a',)])
+    assert kept == [(2 ** 60,), (2 ** 60 + 1,), (2 ** 70,), (2 ** 70 + 1,), (b'a',), ('a',)], f"ERROR: unexpected kept rows {kept}"
+
+def test_filter_data_frame_and_arrow_table():
+    df = pd.DataFrame(columns=['A', 'B'], data=[(1, 'x'), (1, 'x'), (2, 'y')])
+    deduper = StreamingDeduper()
+    filtered_df = deduper.filter_data_frame(df)
+    assert len(filtered_df) == 2, f"ERROR: expected 2 rows not {len(filtered_df)}"
+    table = pa.Table.from_pandas(pd.DataFrame(columns=['A', 'B'], data=[(2, 'y'), (3, 'z')]), preserve_index=False)
+    filtered_table = deduper.filter_arrow_table(table)
+    assert filtered_table.num_rows == 1, f"ERROR: expected 1 row not {filtered_table.num_rows}"
+    assert deduper.num_dropped == 2, f"ERROR: expected 2 dropped not {deduper.num_dropped}"
+
+def test_dedupe_batch_generator():
+    batches = iter([[(1,), (1,)], [(1,)], [(2,)]])
+    deduper = StreamingDeduper()
+    kept_batches = list(dedupe_batch_generator(batches, deduper))
+    assert kept_batches == [[(1,)], [(2,)]], f"ERROR: unexpected batches {kept_batches}"
+
+def tests():
+    test_filter_rows()
+    test_key_columns()
+    test_int_keys()
+    test_mixed_value_types()
+    test_filter_data_frame_and_arrow_table()
+    test_dedupe_batch_generator()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 
 import time
 import functools
+from metrics import get_metrics_registry
 
 
 def timefunc(func):
@@ -15,6 +16,7 @@ def timefunc(func):
         result = func(*args, **kwargs)
         time_elapsed = time.perf_counter() - start
         print(f"Function: {func.__name__}, Time: {time_elapsed}")
+        get_metrics_registry().observe("function_seconds", time_elapsed, function=func.__name__)
         return result
 
     return time_closure
\ No newline at end of file
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Records spans of the pipeline as Chrome trace events that load directly
+# into chrome://tracing or https://ui.perfetto.dev as a flame chart.
+#
+# Spans are written as complete ("X") events with their start and duration,
+# so the viewer nests them by time on each thread. Spans that overlap on
+# one thread, like the queries of async_query_generator, are written as
+# async ("b"/"e") events on their own track instead.
+#
+# Usage:
+#   with span("create_and_run_metadata_table", metadata_table=metadata_table) as s:
+#       ...
+#       s.set(rows=1000)
+#   get_tracer().save("/tmp/trace.json")
+#
+
+# A running span whose args can be added to until it ends
+class Span():
+    def __init__(self, tracer: 'Tracer', name: str, cat: str, args: Dict[str, Any], async_id: Optional[int]=None):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.async_id = async_id
+        self.tid = threading.get_ident()
+        self.start_us = tracer.now_us()
+        self.ended = False
+
+    # Adds or replaces args of this span, e.g. sfqid or rows
+    def set(self, **args: Any) -> None:
+        self.args.update(args)
+
+    # Records this span with the time elapsed since it started, only once
+    def end(self) -> None:
+        if self.ended:
+            return
+        self.ended = True
+        self.tracer.add_span(self)
+
+
+class Tracer():
+    def __init__(self, max_events: int=200000):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.events: List[Dict[str, Any]] = []
+        self.num_dropped = 0
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns()
+        self.async_ids = itertools.count(1)
+
+    def now_us(self) -> float:
+        return (time.perf_counter_ns() - self.start_ns) / 1000.0
+
+    # Returns a new Span, which must be ended with span.end()
+    def start_span(self, name: str, cat: str="function", is_async: bool=False, **args: Any) -> Span:
+        async_id = next(self.async_ids) if is_async else None
+        return Span(self, name, cat, dict(args), async_id=async_id)
+
+    def add_events(self, events: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            if len(self.events) + len(events) > self.max_events:
+                self.num_dropped += len(events)
+                return
+            self.events.extend(events)
+
+    # Adds the trace events of an ended span
+    def add_span(self, span: Span) -> None:
+        end_us = self.now_us()
+        args = {k: v if isinstance(v, (int, float, bool, str, type(None))) else str(v) for k, v in span.args.items()}
+        base = {"name": span.name, "cat": span.cat, "pid": self.pid, "tid": span.tid}
+        if span.async_id is None:
+            self.add_events([{**base, "ph": "X", "ts": span.start_us, "dur": end_us - span.start_us, "args": args}])
+        else:
+            self.add_events([
+                {**base, "ph": "b", "id": span.async_id, "ts": span.start_us, "args": args},
+                {**base, "ph": "e", "id": span.async_id, "ts": end_us},
+            ])
+
+    def reset(self) -> None:
+        with self.lock:
+            self.events = []
+            self.num_dropped = 0
+
+    # Returns the trace in the Chrome trace event json object format
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            events = list(self.events)
+            num_dropped = self.num_dropped
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"num_dropped_events": num_dropped},
+        }
+
+    def save(self, file: str) -> None:
+        with open(file, "w") as f:
+            json.dump(self.to_dict(), f)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+# Returns the process-wide Tracer
+def get_tracer() -> Tracer:
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+        return _tracer
+
+# Context manager that records the enclosed block as a span of the process-wide tracer
+@contextmanager
+def span(name: str, cat: str="function", **args: Any) -> Iterator[Span]:
+    s = get_tracer().start_span(name, cat=cat, **args)
+    try:
+        yield s
+    except BaseException as err:
+        s.set(error=type(err).__name__)
+        raise
+    finally:
+        s.end()
+
+# Decorator that records each call of the decorated function as a span
+def traced(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def traced_closure(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return traced_closure
+
+
+################################################
+# Tests
+################################################
+
+def test_nested_spans():
+    tracer = get_tracer()
+    tracer.reset()
+
+    @traced
+    def inner():
+        with span("query", cat="query", kind="count") as s:
+            s.set(sfqid="q1", rows=1)
+
+    with span("outer"):
+        inner()
+    events = tracer.to_dict()["traceEvents"]
+    names = [x["name"] for x in events]
+    assert names == ["query", "inner", "outer"], f"ERROR: unexpected span order {names}"
+    query_event, inner_event, outer_event = events
+    assert query_event["args"] == {"kind": "count", "sfqid": "q1", "rows": 1}, f"ERROR: unexpected args {query_event['args']}"
+    assert outer_event["ts"] <= inner_event["ts"] <= query_event["ts"], "ERROR: spans do not nest"
+    assert query_event["ts"] + query_event["dur"] <= outer_event["ts"] + outer_event["dur"], "ERROR: spans do not nest"
+    tracer.reset()
+
+def test_async_span_and_errors():
+    tracer = Tracer(max_events=3)
+    s = tracer.start_span("async_query", cat="query", is_async=True)
+    s.end()
+    s.end()
+    events = tracer.to_dict()["traceEvents"]
+    assert [x["ph"] for x in events] == ["b", "e"], f"ERROR: unexpected async events {events}"
+    tracer.start_span("overflow", is_async=True).end()
+    assert tracer.to_dict()["otherData"]["num_dropped_events"] == 2, "ERROR: max_events not enforced"
+    get_tracer().reset()
+    try:
+        with span("failing"):
+            raise ValueError("expected")
+    except ValueError:
+        pass
+    assert get_tracer().to_dict()["traceEvents"][0]["args"] == {"error": "ValueError"}, "ERROR: error not recorded"
+    get_tracer().reset()
+
+def tests():
+    test_nested_spans()
+    test_async_span_and_errors()
+    print("all tests passed in", os.path.basename(__file__))
+
+def main():
+    tests()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,42 @@
 import os
+import sys
 import glob
-from typing import List, Optional
-import pandas as pd
+import importlib
+import threading
+from typing import Any, List, Optional, Sequence
 import string
 import random
 import pathlib
 
 
+# A module that is only imported on its first attribute access, so modules
+# can refer to heavy dependencies like pandas or snowflake.connector at the
+# top without making every importer pay for them at startup.
+#
+# Usage:
+#   pd = LazyModule("pandas")
+#   df = pd.DataFrame(...)   # pandas is imported here
+#
+class LazyModule():
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    # Returns the imported module, importing it on first use
+    def _load(self) -> Any:
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        return f"LazyModule({self._name}, loaded={self._module is not None})"
+
 # Converts string v to a bool
 def str2bool(v: str) -> bool:
     return v.lower() in ("yes", "true", "t", "1")
@@ -56,6 +86,14 @@ def generate_random_string(N: int=7):
         string.ascii_uppercase + string.digits, k=N))
     return str(res)
 
+# Returns the estimated in-memory bytes of a batch of result rows,
+# extrapolated from the sizes of the values of the first sample_size rows
+def estimate_rows_bytes(rows: Sequence[Sequence[Any]], sample_size: int=100) -> int:
+    if rows is None or len(rows) == 0:
+        return 0
+    sample = rows[:sample_size]
+    sample_bytes = sum([sum([sys.getsizeof(x) for x in row]) for row in sample])
+    return int(sample_bytes * len(rows) / len(sample))
 
 
 ################################################
@@ -126,10 +164,23 @@ def test_matches_any():
         pass
 
 
+def test_estimate_rows_bytes():
+    assert estimate_rows_bytes([]) == 0, "ERROR: empty rows failure"
+    rows = [(1, 'abc')] * 1000
+    assert estimate_rows_bytes(rows) == 1000 * (sys.getsizeof(1) + sys.getsizeof('abc')), "ERROR: estimate_rows_bytes failure"
+
+def test_lazy_module():
+    lazy_json = LazyModule("json")
+    assert "loaded=False" in repr(lazy_json), "ERROR: module loaded before use"
+    assert lazy_json.dumps([1]) == "[1]", "ERROR: unexpected lazy module attribute"
+    assert "loaded=True" in repr(lazy_json), "ERROR: module not loaded on use"
+
 def tests():
     test_str2bool()
+    test_estimate_rows_bytes()
     test_is_empty_list()
     test_matches_any()
+    test_lazy_module()
     print("all tests passed in", os.path.basename(__file__))
 
         
@@ -5,12 +5,12 @@ from constants import *
 
 # Gets the version
 conn = snowflake.connector.connect(
-    user=USER_NAME,
-    password=USER_PSWD,
-    account=ACCOUNT,
-    warehouse=WAREHOUSE,
-    database=DATABASE,
-    schema=SCHEMA
+    user=settings.USER_NAME,
+    password=settings.USER_PSWD,
+    account=settings.ACCOUNT,
+    warehouse=settings.WAREHOUSE,
+    database=settings.DATABASE,
+    schema=settings.SCHEMA
     )
 curs = conn.cursor()
 try: